@@ -0,0 +1,193 @@
+"""
+This module caches the final (tts + rvc) audio of the sentences so a line that was already said is never synthesized nor converted again.
+Entries are content addressed: the key is a hash of everything that changes the audio (text, tts model, voice, voice description, rvc model and params).
+Classes:
+    - AudioCache:
+        Two tier cache, a small in-memory hot tier in front of a size bounded directory of '.npy' files, both evicting the least recently used entries.
+Functions:
+    - audio_key(text, tts_model, voice, voice_description, rvc_voice) -> str:
+        Returns the cache key of a sentence.
+    - get_cache() -> AudioCache:
+        Returns the cache shared by the whole process ('./audio_cache').
+"""
+
+import os
+import re
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+#imports---------------------------------------------------------------
+
+def audio_key(text: str, tts_model: str, voice: str, voice_description: str, rvc_voice=None) -> str:
+    """
+    returns the sha256 of everything that changes the audio of a sentence.
+    'rvc_voice' is the registry key of the rvc voice (model, index, params) or None when the tts audio is not converted.
+    """
+    text = re.sub(r"\s+", " ", text).strip()
+    parts = [text, tts_model, voice, voice_description or "", repr(rvc_voice)]
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+class AudioCache:
+    """
+    Caches audio arrays by key.\n
+    - hot tier: the last used entries kept in memory up to 'hot_bytes'.
+    - disk tier: '{directory}/{key[:2]}/{key}_{sr}.npy' up to 'max_bytes'. A hit touches the file so the order survives restarts.
+    - sentences longer than 'max_text_chars' are not worth caching and are skipped by the callers ('cacheable()').\n
+    exemple_ | cache = AudioCache() | audio = cache.get(key) | if audio is None: ... cache.put(key,audio,sr) | cache.stats()
+    """
+    def __init__(self, directory: str = "./audio_cache", max_bytes: int = 512 * 1024**2, hot_bytes: int = 32 * 1024**2, max_text_chars: int = 300):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hot_bytes = hot_bytes
+        self.max_text_chars = max_text_chars
+
+        self._lock = threading.Lock()
+        self._hot = OrderedDict() #key -> (audio, sr), least recently used first
+        self._hot_size = 0
+        self._disk = OrderedDict() #key -> (path, size), least recently used first
+        self._disk_size = 0
+        self.hits_hot = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self._scan()
+
+    def _scan(self) -> None:
+        """rebuilds the disk index from the files, oldest used first"""
+        entries = []
+        if os.path.isdir(self.directory):
+            for folder in os.scandir(self.directory):
+                if not folder.is_dir():
+                    continue
+                for entry in os.scandir(folder.path):
+                    if entry.name.endswith(".npy"):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, entry.name[:-4].split("_")[0], entry.path, stat.st_size))
+        for _, key, path, size in sorted(entries):
+            previous = self._forget(key)
+            if previous is not None: #the same line at another sample rate, the newest file wins
+                _remove(previous[0])
+            self._disk[key] = (path, size)
+            self._disk_size += size
+
+    def cacheable(self, text: str) -> bool:
+        return len(text) <= self.max_text_chars
+
+    #----------------------------------reads------------------------------------------
+
+    def get(self, key: str):
+        """returns (audio, sr) or None"""
+        with self._lock:
+            item = self._hot.get(key)
+            if item is not None:
+                self._hot.move_to_end(key)
+                self.hits_hot += 1
+                return item
+            entry = self._disk.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._disk.move_to_end(key)
+
+        path, _ = entry
+        try:
+            audio = np.load(path)
+            os.utime(path)
+        except (OSError, ValueError): #deleted or corrupted file
+            with self._lock:
+                self._forget(key)
+                self.misses += 1
+            return None
+        sr = int(os.path.basename(path)[:-4].split("_")[1])
+        with self._lock:
+            self.hits_disk += 1
+            self._keep_hot(key, audio, sr)
+        return audio, sr
+
+    #----------------------------------writes-----------------------------------------
+
+    def put(self, key: str, audio: np.ndarray, sr: int) -> None:
+        audio = np.ascontiguousarray(audio, dtype=np.float32)
+        folder = os.path.join(self.directory, key[:2])
+        path = os.path.join(folder, f"{key}_{sr}.npy")
+        os.makedirs(folder, exist_ok=True)
+        temp = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp, "wb") as f:
+            np.save(f, audio)
+        os.replace(temp, path) #readers never see a half written file
+
+        with self._lock:
+            self._keep_hot(key, audio, sr)
+            previous = self._forget(key)
+            if previous is not None and previous[0] != path: #written before at another sample rate
+                _remove(previous[0])
+            size = os.path.getsize(path)
+            self._disk[key] = (path, size)
+            self._disk_size += size
+            while self._disk_size > self.max_bytes and len(self._disk) > 1:
+                old_key = next(iter(self._disk))
+                old_path, _ = self._disk[old_key]
+                self._forget(old_key)
+                _remove(old_path)
+
+    def _keep_hot(self, key: str, audio: np.ndarray, sr: int) -> None:
+        if key in self._hot:
+            self._hot_size -= self._hot.pop(key)[0].nbytes
+        if audio.nbytes > self.hot_bytes:
+            return
+        self._hot[key] = (audio, sr)
+        self._hot_size += audio.nbytes
+        while self._hot_size > self.hot_bytes:
+            _, (old, _) = self._hot.popitem(last=False)
+            self._hot_size -= old.nbytes
+
+    def _forget(self, key: str):
+        """drops the disk index entry of 'key' and returns it ((path, size) or None), the file stays"""
+        entry = self._disk.pop(key, None)
+        if entry is not None:
+            self._disk_size -= entry[1]
+        return entry
+
+    def clear(self) -> None:
+        """empties both tiers and deletes the files"""
+        with self._lock:
+            keys = list(self._disk)
+            for key in keys:
+                path, _ = self._disk[key]
+                self._forget(key)
+                _remove(path)
+            self._hot.clear()
+            self._hot_size = 0
+
+    def stats(self) -> dict:
+        """hit/miss counters and sizes"""
+        with self._lock:
+            lookups = self.hits_hot + self.hits_disk + self.misses
+            return {
+                "hits_hot": self.hits_hot,
+                "hits_disk": self.hits_disk,
+                "misses": self.misses,
+                "hit_rate": (self.hits_hot + self.hits_disk) / lookups if lookups else 0.0,
+                "hot_entries": len(self._hot),
+                "hot_bytes": self._hot_size,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_size,
+            }
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache() -> AudioCache:
+    """returns the audio cache shared by the whole process, created on first use"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = AudioCache()
+        return _cache
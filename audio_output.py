@@ -0,0 +1,286 @@
+"""
+Audio output engine: one output stream kept open for the whole process, fed by a ring buffer of float32 frames.
+The sound card pulls the frames from a callback, so the threads that produce the audio never wait for the device
+and the clips of a reply follow each other without reopening anything.
+    producer (voice pipeline) -> begin(sr) / write(chunk) ... / end() -> [resample to the device rate, crossfade] -> RingBuffer -> device callback
+Classes:
+    - RingBuffer:
+        Single producer / single consumer ring of float32 frames, the callback side takes no lock.
+    - AudioOutput:
+        The persistent output stream: accepts whole clips or partial chunks, resamples them once to the device rate,
+        crossfades consecutive segments and counts the underruns and the buffer fill. 'clear()' drops what is not played yet.
+Functions:
+    - get_output() -> AudioOutput:
+        Returns the output shared by the whole process, the device is opened on the first write.
+"""
+
+import time
+import threading
+import numpy as np
+from startup import lazy_import
+
+#imports---------------------------------------------------------------
+
+class RingBuffer:
+    """
+    Ring of float32 frames for one writer thread and one reader (the audio callback).\n
+    - '_written' and '_read' only grow and each is only changed by its own side, after the frames are copied,
+      so the reader never sees frames that are not written yet and never needs a lock.
+    - 'rewrite()' lets the writer change frames it already wrote as long as the reader is far enough from them (used by the crossfade).\n
+    exemple_ | ring = RingBuffer(48000 * 30) | ring.write(audio) | ring.read_into(out)
+    """
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._data = np.zeros(capacity, dtype=np.float32)
+        self._written = 0 #frames written since the start
+        self._read = 0 #frames read since the start
+
+    def available(self) -> int:
+        """frames written and not read yet"""
+        return self._written - self._read
+
+    def space(self) -> int:
+        return self.capacity - self.available()
+
+    def write(self, frames: np.ndarray) -> int:
+        """copies as many frames as fit and returns how many (writer side)"""
+        count = min(len(frames), self.space())
+        start = self._written % self.capacity
+        first = min(count, self.capacity - start)
+        self._data[start:start + first] = frames[:first]
+        self._data[:count - first] = frames[first:count]
+        self._written += count #published after the copy
+        return count
+
+    def position(self) -> int:
+        """frames written since the start (writer side)"""
+        return self._written
+
+    def read_into(self, out: np.ndarray) -> int:
+        """fills the start of 'out' with the next frames and returns how many (reader side)"""
+        count = min(len(out), self.available())
+        start = self._read % self.capacity
+        first = min(count, self.capacity - start)
+        out[:first] = self._data[start:start + first]
+        out[first:count] = self._data[:count - first]
+        self._read += count
+        return count
+
+    def skip(self, position: int) -> None:
+        """drops the unread frames before 'position' (reader side)"""
+        self._read = max(self._read, min(position, self._written))
+
+    def rewrite(self, count: int, mix, margin: int) -> bool:
+        """
+        replaces the last 'count' written frames by 'mix(frames)' if at least 'margin' more unread frames are before them,
+        so the reader can not reach them meanwhile. Returns False (nothing changed) when they are too close to be played.
+        """
+        if count <= 0 or self.available() < count + margin:
+            return False
+        indexes = np.arange(self._written - count, self._written) % self.capacity
+        self._data[indexes] = mix(self._data[indexes])
+        return True
+
+class AudioOutput:
+    """
+    Persistent output stream fed by a RingBuffer.\n
+    - A segment is one clip (a sentence): 'begin(sr)', any number of 'write(chunk)' as the audio arrives, then 'end()'. 'play(audio, sr)' does the three.
+    - Every segment is resampled once to the device rate with a streaming resampler (soxr), chunk boundaries are seamless.
+    - The last 'fade_ms' of a segment are held back until 'end()' and faded out, the first 'fade_ms' of the next segment are faded in
+      and mixed over them while they are still in the ring: consecutive clips are crossfaded instead of clicking.
+    - The callback never blocks: when the ring runs dry during a reply it plays silence and counts an underrun.
+      'drain()' waits for the end of the reply and returns the underruns and the lowest buffer fill of the reply.
+    - 'clear()' (any thread) interrupts the reply: the block being played is faded out, the rest of the ring is skipped and the write in progress stops.\n
+    exemple_ | output = get_output() | output.play(audio, 40000) | output.play(audio2, 40000) | stats = output.drain()
+    """
+    def __init__(self, samplerate: int = None, buffer_seconds: float = 30.0, fade_ms: float = 10.0, device=None, blocksize: int = 0, latency="low"):
+        self.device = device
+        self.samplerate = samplerate #None: the default rate of the device, known when the stream opens
+        self.buffer_seconds = buffer_seconds
+        self.fade_ms = fade_ms
+        self.blocksize = blocksize
+        self.latency = latency
+
+        self.ring = None
+        self._stream = None
+        self._lock = threading.Lock() #one producer at a time (the callback never takes it)
+        self._resampler = None
+        self._tail = None #held back end of the current segment
+        self._generation = 0 #incremented by every 'clear()'
+        self._segment = 0 #generation of the current segment, its frames are dropped once it is cleared
+        self._crossfade = False #the previous segment can be crossfaded with the current one
+        self._skip_to = 0 #ring position of the last 'clear()', the callback skips the frames before it
+        self._first = False #the next frames are the start of a segment
+        self._fade = 0
+        self._block = 1024 #largest callback seen, the crossfade keeps this margin from the reader
+
+        #written by the callback, read by the producer
+        self._active = False #a reply is being played: running dry is an underrun, not the end
+        self.underruns = 0
+        self.underrun_frames = 0
+        self.min_fill = None #lowest number of buffered frames seen by the callback during the reply
+        self.played = 0
+
+    #----------------------------------device---------------------------------------------
+
+    def open(self) -> None:
+        """opens the output stream (done by the first write)"""
+        if self._stream is not None:
+            return
+        sounddevice = lazy_import("sounddevice")
+        if self.samplerate is None:
+            self.samplerate = int(sounddevice.query_devices(self.device, "output")["default_samplerate"])
+        self.ring = RingBuffer(int(self.samplerate * self.buffer_seconds))
+        self._fade = int(self.samplerate * self.fade_ms / 1000)
+        self._stream = sounddevice.OutputStream(samplerate=self.samplerate, channels=1, dtype="float32", device=self.device,
+                                                blocksize=self.blocksize, latency=self.latency, callback=self._callback)
+        self._stream.start()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._stream is not None:
+                self._stream.stop()
+                self._stream.close()
+                self._stream = None
+
+    def _callback(self, outdata, frames, time_info, status) -> None:
+        """called by the audio thread for every block: no lock, no allocation"""
+        out = outdata[:, 0]
+        if frames > self._block:
+            self._block = frames
+        ring = self.ring
+        if self._skip_to > ring._read: #cleared: fades out this block and skips the rest (rare, it may allocate)
+            count = ring.read_into(out)
+            out[:count] *= _ramp(count)[::-1]
+            out[count:] = 0
+            ring.skip(self._skip_to)
+            return
+        available = ring.available()
+        if self._active and (self.min_fill is None or available < self.min_fill):
+            self.min_fill = available
+        count = ring.read_into(out)
+        if count < frames:
+            out[count:] = 0
+            if self._active: #the next clip is late
+                self.underruns += 1
+                self.underrun_frames += frames - count
+        self.played += count
+
+    #----------------------------------producer-------------------------------------------
+
+    def begin(self, sr: int) -> None:
+        """starts a segment of audio at 'sr' Hz"""
+        with self._lock:
+            self.open()
+            self._crossfade = self._segment == self._generation and self.ring.position() > 0 #no crossfade over cleared audio
+            self._segment = self._generation
+            self._first = True
+            self._resampler = None if sr == self.samplerate else lazy_import("soxr").ResampleStream(sr, self.samplerate, 1, dtype="float32")
+
+    def write(self, chunk: np.ndarray) -> None:
+        """adds the next chunk of the current segment, blocks only while the ring is full"""
+        with self._lock:
+            chunk = np.asarray(chunk, dtype=np.float32).reshape(-1)
+            if self._resampler is not None:
+                chunk = self._resampler.resample_chunk(chunk)
+            if self._tail is not None:
+                chunk = np.concatenate((self._tail, chunk))
+                self._tail = None
+            if self._first and len(chunk) > 0:
+                chunk = self._fade_in(chunk)
+            if len(chunk) > self._fade: #keeps the end for the fade out
+                chunk, self._tail = chunk[:-self._fade], chunk[-self._fade:].copy()
+            else:
+                self._tail, chunk = chunk, chunk[:0]
+            self._push(chunk)
+
+    def end(self) -> None:
+        """ends the current segment: flushes the resampler and fades the held back end out"""
+        with self._lock:
+            chunk = self._resampler.resample_chunk(np.zeros(0, dtype=np.float32), last=True) if self._resampler is not None else np.zeros(0, dtype=np.float32)
+            self._resampler = None
+            if self._tail is not None:
+                chunk = np.concatenate((self._tail, chunk))
+                self._tail = None
+            if self._first and len(chunk) > 0:
+                chunk = self._fade_in(chunk)
+            if len(chunk) > 0:
+                fade = min(self._fade, len(chunk))
+                chunk = chunk.copy()
+                chunk[-fade:] *= _ramp(fade)[::-1]
+            self._push(chunk)
+
+    def play(self, audio: np.ndarray, sr: int) -> None:
+        """plays a whole clip after the previous ones"""
+        self.begin(sr)
+        self.write(audio)
+        self.end()
+
+    def _fade_in(self, chunk: np.ndarray) -> np.ndarray:
+        """fades the start of a segment in, mixed over the faded out end of the previous one when it is still in the ring"""
+        self._first = False
+        fade = min(self._fade, len(chunk))
+        if fade == 0:
+            return chunk
+        chunk = chunk.copy()
+        head = chunk[:fade] * _ramp(fade)
+        if self._crossfade and self.ring.rewrite(fade, lambda previous: previous + head, margin=2 * self._block):
+            return chunk[fade:] #the head is already in the ring, over the previous segment
+        chunk[:fade] = head
+        return chunk
+
+    def _push(self, frames: np.ndarray) -> None:
+        if len(frames) > 0 and not self._active and self._segment == self._generation: #first frames of a reply
+            self.underruns = 0
+            self.underrun_frames = 0
+            self.min_fill = None
+            self._active = True
+        while len(frames) > 0 and self._segment == self._generation: #a 'clear()' drops the rest of the segment
+            count = self.ring.write(frames)
+            frames = frames[count:]
+            if len(frames) > 0: #full: waits for the device to play some of it
+                time.sleep(min(len(frames), self.ring.capacity // 4) / self.samplerate / 2)
+
+    def clear(self) -> None:
+        """drops the audio not played yet and the rest of the segment being written (a new turn interrupts the previous one)"""
+        self._generation += 1
+        self._active = False
+        if self.ring is not None:
+            self._skip_to = self.ring.position()
+
+    #----------------------------------state----------------------------------------------
+
+    def fill(self) -> float:
+        """seconds of audio buffered and not played yet"""
+        return 0.0 if self.ring is None else self.ring.available() / self.samplerate
+
+    def drain(self, timeout: float = None) -> dict:
+        """waits until everything written is played, ends the reply and returns its stats"""
+        self._active = False #nothing more is coming, running dry now is the end of the reply
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while self.ring is not None and self.ring.available() > 0:
+            if deadline is not None and time.perf_counter() > deadline:
+                break
+            time.sleep(min(self.fill(), 0.05) + 0.001)
+        return self.stats()
+
+    def stats(self) -> dict:
+        """underruns of the reply, seconds of silence they caused, current and lowest buffer fill (seconds)"""
+        rate = self.samplerate or 1
+        return {"underruns": self.underruns, "underrun_seconds": self.underrun_frames / rate, "fill_seconds": self.fill(),
+                "min_fill_seconds": None if self.min_fill is None else self.min_fill / rate, "samplerate": self.samplerate}
+
+def _ramp(count: int) -> np.ndarray:
+    """0 -> 1 raised cosine, its mirror is the fade out and both add up to 1"""
+    return (0.5 - 0.5 * np.cos(np.pi * (np.arange(count, dtype=np.float32) + 0.5) / count)).astype(np.float32)
+
+_output = None
+_output_lock = threading.Lock()
+
+def get_output() -> AudioOutput:
+    """returns the output shared by the whole process, created on first use"""
+    global _output
+    with _output_lock:
+        if _output is None:
+            _output = AudioOutput()
+        return _output
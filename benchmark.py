@@ -0,0 +1,325 @@
+"""
+Offline benchmarks of the chat, voice, memory and screen paths: no network, no gpu, no api key.
+The openAI api is replaced by 'fake_openai.FakeOpenAI' (configurable token timings) and rvc by 'stub_rvc()' (cpu resampling + a simulated inference time).
+Everything runs in a temporary folder so the real './memory' is never touched.
+Measures:
+    - chat:   time to first token, streamed and non streamed turn latency
+    - voice:  time to first audio and whole turn latency through the voice pipeline (tts -> rvc stub, no audio device)
+    - tts:    tts latency (p50/p95/p99) on a flaky connection (slow answers and 503s), without and with the hedged requests of 'http_pool'
+    - memory: append cost, load, tail, full read and context build at 1k/10k/100k turns
+    - screen: filter_pictures throughput (first run and with the hash index) and summarize_images throughput
+Results are written as json ('./benchmarks/{commit}.json' by default) so two commits can be compared with '--compare'.
+Usage:
+    python benchmark.py [--quick] [--only chat,voice,tts,memory,screen] [--runs 10] [--out file.json] [--compare old.json] [--threshold 0.1]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import argparse
+import subprocess
+import numpy as np
+
+#imports---------------------------------------------------------------
+
+BENCHMARKS = {} #name -> function(client, args) -> dict of metrics
+
+def benchmark(name: str):
+    """registers a benchmark function"""
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+def stats(seconds: list) -> dict:
+    """mean / p50 / p95 / p99 / min / max in milliseconds"""
+    values = np.array(seconds, dtype=np.float64) * 1000
+    return {"mean_ms": float(values.mean()), "p50_ms": float(np.percentile(values, 50)), "p95_ms": float(np.percentile(values, 95)),
+            "p99_ms": float(np.percentile(values, 99)), "min_ms": float(values.min()), "max_ms": float(values.max()), "n": len(values)}
+
+def stub_rvc(audio: np.ndarray, sr: int, voice=None, target_sr: int = 40000, realtime_factor: float = 0.05) -> tuple:
+    """
+    stand-in of 'rvc_converter.convertToAI_array()': resamples to 'target_sr' and smooths on the cpu,
+    then waits 'realtime_factor' seconds per second of audio like a gpu inference would.
+    """
+    duration = len(audio) / sr
+    positions = np.linspace(0, len(audio) - 1, int(duration * target_sr))
+    converted = np.interp(positions, np.arange(len(audio)), audio).astype(np.float32)
+    converted = np.convolve(converted, np.ones(16, dtype=np.float32) / 16, mode="same")
+    time.sleep(realtime_factor * duration)
+    return converted, target_sr
+
+#----------------------------------benchmarks----------------------------------------
+
+@benchmark("chat")
+def bench_chat(client, args) -> dict:
+    import chatgpt
+    first_tokens, streamed, blocking = [], [], []
+    chatgpt.chat(client, "You are a benchmark.", "gpt-5", "hi", "bench") #opens the connection, not measured
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        first = None
+        for _ in chatgpt.chat(client, "You are a benchmark.", "gpt-5", "hi", "bench", streaming=True):
+            if first is None:
+                first = time.perf_counter() - start
+        streamed.append(time.perf_counter() - start)
+        first_tokens.append(first)
+
+        start = time.perf_counter()
+        chatgpt.chat(client, "You are a benchmark.", "gpt-5", "hi", "bench")
+        blocking.append(time.perf_counter() - start)
+    return {"time_to_first_token": stats(first_tokens), "streamed_turn": stats(streamed), "blocking_turn": stats(blocking)}
+
+@benchmark("voice")
+def bench_voice(client, args) -> dict:
+    import chatgpt
+    from voice_pipeline import VoicePipeline
+    first_audio, turns, errors = [], [], 0
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        pipeline = VoicePipeline(client, "calm", "bench", convert=stub_rvc, play=False)
+        pipeline.speak(chatgpt.chat(client, "You are a benchmark.", "gpt-5", "hi", "bench", streaming=True), echo=False)
+        first = pipeline.wait()
+        turns.append(time.perf_counter() - start)
+        errors += len(pipeline.errors)
+        if first is not None:
+            first_audio.append(first)
+    return {"time_to_first_audio": stats(first_audio) if first_audio else None, "turn": stats(turns), "errors": errors}
+
+@benchmark("tts")
+def bench_tts(client, args) -> dict:
+    import chatgpt
+    import http_pool
+    from fake_openai import FakeOpenAI
+    sentences = ["Hi!", "I missed you a lot, you know.", "How was your day?", "Tell me everything, I want to know what you did."]
+    results = {}
+    #own server: 10% of the tts answers are 1.5s late and 3% fail
+    with FakeOpenAI(tts_delay=args.tts_delay, tts_slow_rate=0.1, tts_slow_delay=1.5, error_rate=0.03, seed=0) as fake:
+        flaky = http_pool.get_client("fake", fake.base_url)
+        default = chatgpt.TTS_HEDGE
+        try:
+            for mode, hedge in (("plain", None), ("hedged", http_pool.Hedge())):
+                chatgpt.TTS_HEDGE = hedge
+                latencies, errors = [], 0
+                for i in range(max(args.runs * 20, 100)):
+                    start = time.perf_counter()
+                    try:
+                        chatgpt.voice_pcm(flaky, sentences[i % len(sentences)], "calm")
+                    except Exception:
+                        errors += 1
+                    latencies.append(time.perf_counter() - start)
+                results[mode] = {"latency": stats(latencies), "errors": errors}
+        finally:
+            chatgpt.TTS_HEDGE = default
+        results["requests"] = fake.requests["speech"]
+    return results
+
+@benchmark("memory")
+def bench_memory(client, args) -> dict:
+    import memory
+    import context
+    results = {}
+    turn = "[USER] what did you do today? I went to the park with my cat\n[YOU] I read a book about the sea and thought about you\n"
+    for size in args.sizes:
+        name = f"bench{size}"
+        store = memory.get_store("chatlogs", name)
+        start = time.perf_counter()
+        for _ in range(size):
+            store.append(turn)
+        store.sync()
+        append = time.perf_counter() - start
+        memory.close_store("chatlogs", name)
+
+        start = time.perf_counter()
+        store = memory.get_store("chatlogs", name) #reopens: reads the turn index
+        load = time.perf_counter() - start
+
+        start = time.perf_counter()
+        store.tail(20)
+        tail = time.perf_counter() - start
+
+        start = time.perf_counter()
+        store.read()
+        read_cold = time.perf_counter() - start
+        start = time.perf_counter()
+        store.read()
+        read_warm = time.perf_counter() - start
+
+        window = context.ContextWindow(None, name, 4000)
+        start = time.perf_counter()
+        window.build("where is my cat")
+        build_cold = time.perf_counter() - start #counts and indexes every turn
+        builds = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            store.append(turn)
+            window.build("where is my cat")
+            builds.append(time.perf_counter() - start)
+
+        results[str(size)] = {
+            "append_us_per_turn": 1e6 * append / size,
+            "load_ms": 1000 * load,
+            "tail_ms": 1000 * tail,
+            "read_cold_ms": 1000 * read_cold,
+            "read_warm_ms": 1000 * read_warm,
+            "context_build_cold_ms": 1000 * build_cold,
+            "context_build_after_turn": stats(builds),
+            "file_bytes": os.path.getsize(store.path),
+        }
+        memory.delete_memory(name)
+    return results
+
+def _make_frames(directory: str, count: int) -> None:
+    """writes 'count' 1280x720 screenshots named like 'screen.screenshot()': a few screens with small changes between them"""
+    from datetime import datetime, timedelta
+    from PIL import Image
+    import screen
+    rng = np.random.default_rng(0)
+    screens = [rng.integers(0, 255, (45, 80, 3), dtype=np.uint8) for _ in range(max(count // 20, 2))]
+    start = datetime(2025, 1, 1, 12)
+    os.makedirs(directory, exist_ok=True)
+    for i in range(count):
+        base = screens[(i // 10) % len(screens)].astype(np.int16) + rng.integers(-3, 4, (45, 80, 3))
+        image = Image.fromarray(np.clip(base, 0, 255).astype(np.uint8)).resize((1280, 720), Image.BILINEAR)
+        date = (start + timedelta(seconds=i)).strftime(screen.DATE_FORMAT)
+        image.save(f"{directory}/screen {date}.jpg", quality=85)
+
+@benchmark("screen")
+def bench_screen(client, args) -> dict:
+    import screen
+    directory = "./memory/images"
+    _make_frames(directory, args.frames)
+
+    start = time.perf_counter()
+    kept = screen.filter_pictures(directory)
+    cold = time.perf_counter() - start
+    start = time.perf_counter()
+    screen.filter_pictures(directory)
+    warm = time.perf_counter() - start
+
+    start = time.perf_counter()
+    screen.summarize_images(client, kept, "bench", image_dir=directory, clean=False)
+    summarize = time.perf_counter() - start
+    return {
+        "frames": args.frames,
+        "kept": len(kept),
+        "filter_first_frames_per_s": args.frames / cold,
+        "filter_indexed_frames_per_s": args.frames / warm,
+        "filter_indexed_ms": 1000 * warm,
+        "summarize_ms": 1000 * summarize,
+        "summarize_frames_per_s": len(kept) / summarize if kept else 0.0,
+    }
+
+#----------------------------------results-------------------------------------------
+
+def _commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except Exception:
+        return "unknown"
+
+def _flatten(results: dict, prefix: str = "") -> dict:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+def compare(old: dict, new: dict, threshold: float = 0.1) -> list:
+    """
+    returns the metrics that got worse by more than 'threshold' (0.1 = 10%) as (metric, old, new, change).
+    '_per_s' metrics are better when higher, the times and costs when lower. Counters ('n', 'frames'...) are ignored.
+    """
+    old, new = _flatten(old["results"]), _flatten(new["results"])
+    worse = []
+    for metric, value in new.items():
+        before = old.get(metric)
+        if before is None or before == 0 or not metric.endswith(("_ms", "_us_per_turn", "_per_s")):
+            continue
+        change = (value - before) / abs(before)
+        if metric.endswith("_per_s"):
+            change = -change
+        if change > threshold:
+            worse.append((metric, before, value, change))
+    return worse
+
+def run(args) -> dict:
+    import http_pool
+    from fake_openai import FakeOpenAI
+
+    timings = {"first_token_delay": args.first_token_delay, "token_interval": args.token_interval,
+               "tts_delay": args.tts_delay, "chat_delay": args.chat_delay}
+    report = {
+        "commit": _commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": f"{platform.system()} {platform.machine()} ({os.cpu_count()} cpus)",
+        "config": {**timings, "runs": args.runs, "sizes": args.sizes, "frames": args.frames},
+        "results": {},
+    }
+    home = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="bench_")
+    os.chdir(workdir) #'./memory' of the benchmarks
+    try:
+        with FakeOpenAI(**timings) as fake:
+            client = http_pool.get_client("fake", fake.base_url)
+            for name in args.only:
+                print(f"[INFO] benchmark {name}...", flush=True)
+                start = time.perf_counter()
+                report["results"][name] = BENCHMARKS[name](client, args)
+                report["results"][name]["seconds"] = time.perf_counter() - start
+            report["requests"] = fake.requests
+    finally:
+        os.chdir(home)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="offline benchmarks (fake openAI server, rvc stub)")
+    parser.add_argument("--only", default=",".join(BENCHMARKS), help=f"comma separated: {','.join(BENCHMARKS)}")
+    parser.add_argument("--quick", action="store_true", help="smaller memory sizes and fewer frames")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--frames", type=int, default=None)
+    parser.add_argument("--first-token-delay", type=float, default=0.3)
+    parser.add_argument("--token-interval", type=float, default=0.02)
+    parser.add_argument("--tts-delay", type=float, default=0.15)
+    parser.add_argument("--chat-delay", type=float, default=0.5)
+    parser.add_argument("--out", default=None, help="defaults to ./benchmarks/{commit}.json")
+    parser.add_argument("--compare", default=None, help="older result file, prints the regressions and exits with 1 if any")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args()
+
+    args.only = [name.strip() for name in args.only.split(",") if name.strip()]
+    for name in args.only:
+        assert name in BENCHMARKS, f"unknown benchmark: {name}"
+    args.sizes = [1000, 10000] if args.quick else [1000, 10000, 100000]
+    if args.frames is None:
+        args.frames = 200 if args.quick else 1000
+    if args.quick:
+        args.runs = min(args.runs, 3)
+
+    report = run(args)
+    out = args.out if args.out is not None else f"./benchmarks/{report['commit']}.json"
+    if os.path.dirname(out) != "":
+        os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report["results"], indent=2))
+    print(f"[INFO] results written to {out}")
+
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            old = json.load(f)
+        worse = compare(old, report, args.threshold)
+        for metric, before, value, change in worse:
+            print(f"[WARN] {metric}: {before:.3f} -> {value:.3f} ({100 * change:+.0f}% worse)")
+        if worse:
+            sys.exit(1)
+        print(f"[INFO] no regression above {100 * args.threshold:.0f}% against {old.get('commit', args.compare)}")
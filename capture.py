@@ -0,0 +1,300 @@
+"""
+Continuous, low overhead screen capture running in a background thread.
+Instead of opening a new grabber and writing a '.jpg' for every screenshot like 'screen.screenshot()', the service:
+    - reuses one mss grabber for the whole session,
+    - computes a small thumbnail and its perceptual hash right after the grab,
+    - keeps every frame (time, hash, thumbnail) in a bounded in-memory ring buffer,
+    - only encodes (jpeg) the frames that pass the change filter.
+It measures its own cost (cpu time of the capture thread) and frame rate so it can run all day next to games.
+The frame rate adapts to the screen: it goes up while consecutive frames change and backs off to a slow heartbeat on a static screen,
+and never goes over a cpu budget. The screen summaries are triggered by the change accumulated since the last one instead of a timer.
+Classes:
+    - Frame:
+        One captured frame.
+    - CaptureService:
+        The background capture thread and its ring buffer.
+"""
+
+import io
+import time
+import threading
+from collections import deque
+from datetime import datetime
+from startup import lazy_import
+import screen
+import hash_index
+import numpy as np
+
+#imports---------------------------------------------------------------
+
+class Frame:
+    """
+    One captured frame.\n
+    - time: capture time (time.time())
+    - hash: 64-bit perceptual hash (see 'screen.phash64')
+    - thumbnail: small PIL image used for the hash
+    - jpeg: encoded frame (bytes) if it passed the change filter, else None
+    """
+    __slots__ = ("time", "hash", "thumbnail", "jpeg")
+
+    def __init__(self, time: float, hash: int, thumbnail, jpeg: bytes = None):
+        self.time = time
+        self.hash = hash
+        self.thumbnail = thumbnail
+        self.jpeg = jpeg
+
+    @property
+    def kept(self) -> bool:
+        return self.jpeg is not None
+
+    @property
+    def date(self) -> str:
+        """capture time in the same format as the screenshot file names"""
+        return datetime.fromtimestamp(self.time).strftime(screen.DATE_FORMAT)
+
+class CaptureService:
+    """
+    Captures the screen in a background thread, starting every 'interval' seconds.\n
+    A frame is kept (encoded in jpeg at 'size') when its hash differs by more than 'threshold' bits from the last kept frame.
+    The last 'buffer_size' frames, kept or not, stay in memory. 'save_dir' also writes the kept frames to disk with the
+    same names as 'screen.screenshot()' so the old disk based functions keep working.\n
+    Governor (see '_next_interval()'):
+    - two consecutive frames that differ by more than 'motion_threshold' bits halve the interval (down to 'min_interval'),
+      a frame without change grows it by 'backoff' (up to the 'max_interval' heartbeat). 'min_interval == max_interval' captures at a fixed rate.
+    - the interval never gets shorter than the average cpu time of a frame allows with 'cpu_budget' (percent of one core, 0: no budget).
+    - 'on_summary(frames)' is called in its own thread with the keyframes since the last summary once the change between consecutive frames
+      adds up to 'summary_change' bits, at most every 'min_summary_interval' seconds (see 'summarizer()').\n
+    exemple_ | service = CaptureService(on_summary=summarizer(client, "teto")) | service.start() | ... | service.keyframes() | service.stats() | service.stop()
+    """
+    def __init__(self, interval: float = 1.0, threshold: int = 8, buffer_size: int = 120, monitor: int = 1,
+                 size: tuple = (1280, 720), thumbnail_size: tuple = (160, 90), quality: int = 85, save_dir: str = None,
+                 min_interval: float = 0.25, max_interval: float = 5.0, backoff: float = 1.25, motion_threshold: int = 2, cpu_budget: float = 2.0,
+                 on_summary = None, summary_change: int = 256, min_summary_interval: float = 30.0, summary_frames: int = 16):
+        self.interval = interval
+        self.min_interval = min(min_interval, max_interval)
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.motion_threshold = motion_threshold
+        self.cpu_budget = cpu_budget
+        self.on_summary = on_summary
+        self.summary_change = summary_change
+        self.min_summary_interval = min_summary_interval
+        self.summary_frames = summary_frames
+        self.threshold = threshold
+        self.monitor = monitor
+        self.size = size
+        self.thumbnail_size = thumbnail_size
+        self.quality = quality
+        self.save_dir = save_dir
+
+        self._frames = deque(maxlen=buffer_size)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_kept = None #hash of the last kept frame
+        self._last_hash = None #hash of the previous frame
+
+        #governor
+        self._interval = min(max(interval, self.min_interval), self.max_interval) #current interval
+        self._motion = 0 #bits changed between the last two frames
+        self._frame_cpu = None #average cpu seconds of a frame
+        self._change = 0 #bits changed between consecutive frames since the last summary
+        self._pending = [] #kept frames since the last summary, outside of the ring buffer so none is evicted before it is summarized
+        self._summary_time = None #time.perf_counter() of the last summary
+        self._summary = None #running summary thread
+        self._summaries = 0
+
+        #stats
+        self._started = None
+        self._cpu = 0.0 #cpu seconds used by the capture thread
+        self._captured = 0
+        self._kept = 0
+        self._recent = deque(maxlen=30) #capture times for the current frame rate
+
+    #----------------------------------control----------------------------------------
+
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="screen-capture", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self) -> None:
+        mss = lazy_import("mss")
+        with mss.mss() as grabber: #one grabber for the whole session, it must live in this thread
+            monitor = grabber.monitors[self.monitor]
+            next_time = time.perf_counter()
+            while not self._stop.is_set():
+                next_time += self._step(grabber, monitor)
+                delay = next_time - time.perf_counter()
+                if delay < 0: #late, does not try to catch up
+                    next_time = time.perf_counter()
+                    delay = 0
+                self._stop.wait(delay)
+
+    def _step(self, grabber, monitor) -> float:
+        """one capture of the loop: captures, measures its cpu time, starts a summary if enough changed and returns the next interval"""
+        cpu = time.thread_time()
+        try:
+            self.capture_once(grabber, monitor)
+        except Exception as e:
+            print(f"[WARN] screen capture: {e}")
+        cost = time.thread_time() - cpu
+        self._cpu += cost
+        self._frame_cpu = cost if self._frame_cpu is None else 0.8 * self._frame_cpu + 0.2 * cost
+        self._maybe_summarize()
+        return self._next_interval()
+
+    def _next_interval(self) -> float:
+        """
+        halves the interval when the last two frames differ (the screen is busy), grows it by 'backoff' when they do not,
+        then keeps it within 'min_interval' / 'max_interval' and above what the cpu budget allows
+        """
+        if self._motion > self.motion_threshold:
+            interval = self._interval / 2
+        else:
+            interval = self._interval * self.backoff
+        interval = min(max(interval, self.min_interval), self.max_interval)
+        if self.cpu_budget > 0 and self._frame_cpu is not None:
+            interval = max(interval, self._frame_cpu * 100 / self.cpu_budget) #the budget wins over the heartbeat
+        self._interval = interval
+        return interval
+
+    #----------------------------------summaries--------------------------------------
+
+    def _maybe_summarize(self) -> None:
+        """starts 'on_summary' with the keyframes since the last summary once 'summary_change' bits changed"""
+        if self.on_summary is None or self._change < self.summary_change:
+            return
+        if self._summary is not None and self._summary.is_alive():
+            return
+        if self._summary_time is not None and time.perf_counter() - self._summary_time < self.min_summary_interval:
+            return
+        with self._lock:
+            frames, self._pending = self._pending, []
+        if not frames:
+            return
+        hashes = np.array([frame.hash for frame in frames], dtype=np.uint64)
+        frames = [frames[i] for i in hash_index.select_keyframes(hashes, self.threshold)] #a screen flipping between two states is sent once
+        if len(frames) > self.summary_frames: #evenly spread over the period
+            frames = [frames[i] for i in np.linspace(0, len(frames) - 1, self.summary_frames).round().astype(int)]
+        self._change = 0
+        self._summary_time = time.perf_counter()
+        self._summaries += 1
+        self._summary = threading.Thread(target=self._summarize, args=(frames,), name="screen-summary", daemon=True)
+        self._summary.start()
+
+    def _summarize(self, frames: list) -> None:
+        try:
+            self.on_summary(frames)
+        except Exception as e:
+            print(f"[WARN] screen summary: {e}")
+
+    #----------------------------------capture----------------------------------------
+
+    def capture_once(self, grabber, monitor) -> Frame:
+        """grabs, hashes and (if it changed) encodes one frame, then adds it to the ring buffer"""
+        Image = lazy_import("PIL.Image")
+        shot = grabber.grab(monitor)
+        now = time.time()
+
+        #reads the BGRA buffer of mss without converting it first
+        image = Image.frombuffer("RGB", shot.size, shot.bgra, "raw", "BGRX", 0, 1)
+        thumbnail = image.resize(self.thumbnail_size, Image.BILINEAR, reducing_gap=2.0)
+        frame_hash = screen.phash64(thumbnail)
+        if self._last_hash is not None:
+            self._motion = screen.hamming(self._last_hash, frame_hash)
+            if self._motion > self.motion_threshold:
+                self._change += self._motion
+        self._last_hash = frame_hash
+
+        jpeg = None
+        if self._last_kept is None or screen.hamming(self._last_kept, frame_hash) > self.threshold:
+            jpeg = self._encode(image)
+            self._last_kept = frame_hash
+
+        frame = Frame(now, frame_hash, thumbnail, jpeg)
+        with self._lock:
+            self._frames.append(frame)
+            self._captured += 1
+            self._kept += jpeg is not None
+            if jpeg is not None and self.on_summary is not None:
+                self._pending.append(frame)
+                if len(self._pending) > 8 * self.summary_frames: #a long wait for the summary: keeps every other frame, still spread over the period
+                    self._pending = self._pending[::2]
+            self._recent.append(time.perf_counter())
+        if jpeg is not None and self.save_dir is not None:
+            with open(f"{self.save_dir}/screen {frame.date}.jpg", "wb") as f:
+                f.write(jpeg)
+        return frame
+
+    def _encode(self, image) -> bytes:
+        Image = lazy_import("PIL.Image")
+        resized = image.resize(self.size, Image.LANCZOS, reducing_gap=2.0)
+        buffer = io.BytesIO()
+        resized.save(buffer, format="JPEG", quality=self.quality)
+        return buffer.getvalue()
+
+    #----------------------------------reads------------------------------------------
+
+    def frames(self, since: float = None) -> list:
+        """every frame of the ring buffer (oldest first), only the ones captured after 'since' if given"""
+        with self._lock:
+            frames = list(self._frames)
+        if since is not None:
+            frames = [frame for frame in frames if frame.time > since]
+        return frames
+
+    def keyframes(self, since: float = None) -> list:
+        """the frames that passed the change filter"""
+        return [frame for frame in self.frames(since) if frame.kept]
+
+    def latest(self) -> Frame:
+        with self._lock:
+            return self._frames[-1] if self._frames else None
+
+    def stats(self) -> dict:
+        """
+        fps: frames per second over the last frames | cpu_percent: share of one core used by the capture thread since start
+        cpu_ms_per_frame: average cpu cost of one frame | frames/kept: counters | buffered: frames in the ring buffer
+        interval: current interval of the governor | change: bits changed since the last summary | summaries: summaries started
+        """
+        with self._lock:
+            recent = list(self._recent)
+            captured = self._captured
+            kept = self._kept
+            buffered = len(self._frames)
+        elapsed = time.perf_counter() - self._started if self._started is not None else 0
+        fps = (len(recent) - 1) / (recent[-1] - recent[0]) if len(recent) > 1 and recent[-1] > recent[0] else 0.0
+        return {
+            "fps": fps,
+            "cpu_percent": 100 * self._cpu / elapsed if elapsed > 0 else 0.0,
+            "cpu_ms_per_frame": 1000 * self._cpu / captured if captured else 0.0,
+            "frames": captured,
+            "kept": kept,
+            "buffered": buffered,
+            "interval": self._interval,
+            "change": self._change,
+            "summaries": self._summaries,
+        }
+
+def summarizer(client, name: str, **kwargs):
+    """
+    'on_summary' callback that summarizes the frames with 'screen.summarize_images()' and adds the summary to the screen log of 'name'.\n
+    exemple_ | CaptureService(on_summary=summarizer(client, "teto", max_concurrency=2))
+    """
+    def summarize(frames: list) -> None:
+        screen.summarize_images(client, frames, name, clean=False, **kwargs)
+    return summarize
@@ -3,36 +3,79 @@ This module provides functions to interact with the OpenAI API for chat and voic
 Functions:
     - get_openai_settings(settings_file: str = "settings.json"):
         Loads OpenAI API credentials and model settings from a JSON file, validates the API key, and returns the client and model information.
-    - chat(client: openai.OpenAI=None, description: str=None, text_model: str=None, user_input: str=None, name: str=None, useMemory: bool=True) -> str:
+    - chat(client: openai.OpenAI=None, description: str=None, text_model: str=None, user_input: str=None, name: str=None, useMemory: bool=True, context=None) -> str:
         Sends a chat request to the OpenAI API using the provided client and model settings, optionally including previous chat memory, and returns the generated response text.
+        With a 'context.ContextWindow' only a token budgeted part of the memory is sent. With a 'turn_runtime.TurnScope' a streamed answer stops when the turn is cancelled.
     - voice(client: openai.OpenAI=None, text: str=None, name: str="speech") -> None:
         Generates an audio file from the provided text using OpenAI's text-to-speech (TTS) API and saves it to the specified file.
-    - stream_chat(client: openai.OpenAI=None, description: str=None, text_model: str=None, user_input: str=None, name: str=None, useMemory: bool=True) -> str:
-        Streams chat responses from the OpenAI API in real-time, processes each segment for voice synthesis and audio conversion in background threads, and returns the concatenated response text.
+    - voice_pcm(client: openai.OpenAI=None, text: str=None, description: str=None) -> tuple:
+        Same as voice() but asks for raw pcm and returns it as a float32 NumPy array with its sample rate, nothing is written to disk.
+        The tts of short sentences is hedged (see 'http_pool.hedged()').
+    - stream_chat_voice(client: openai.OpenAI=None, description: str=None, text_model: str=None, user_input: str=None, name: str=None, useMemory: bool=True) -> tuple:
+        Streams chat responses from the OpenAI API in real-time, speaks each sentence through the voice pipeline (tts -> rvc -> playback) while the rest is generated, and returns the response text.
+    - achat(), astream_deltas(), avoice_pcm():
+        asyncio versions of chat(), stream_deltas() and voice_pcm() for an openai.AsyncOpenAI client.
     - Requires a valid OpenAI API key and appropriate model settings in 'settings.json'.
     - Integrates with external modules for memory management and audio conversion.
     - Designed for interactive applications with real-time feedback and audio output.
 """
 
 import openai
+import asyncio
 import json
 import os
+import time
+import hashlib
+import numpy as np
+import tracing
+import http_pool
 from memory import get_memory
 
 #imports---------------------------------------------------------------
 
-def get_openai_settings(settings_file: str = "settings.json"):
+TTS_MODEL = "gpt-4o-mini-tts"
+TTS_VOICE = "coral"
+TTS_HEDGE = http_pool.Hedge() #delay before the duplicate of a slow tts request, learned from the tts latencies
+
+def _tts_hedge(client, text: str):
+    """the hedge of the tts of 'text' with 'client', None (not hedged) for the texts longer than the 'hedge_tts_chars' of its network settings"""
+    return TTS_HEDGE if 0 < len(text) <= http_pool.hedge_chars(client) else None
+
+KEY_CACHE_FILE = "./memory/api_key_cache.json" #sha256 of the validated keys and when they were checked, never the keys themselves
+
+def _key_hash(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+def _read_key_cache() -> dict:
+    try:
+        with open(KEY_CACHE_FILE, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def key_recently_validated(api_key: str, ttl: float) -> bool:
+    """returns True if the api key was validated less than 'ttl' seconds ago"""
+    checked = _read_key_cache().get(_key_hash(api_key))
+    return checked is not None and 0 <= time.time() - checked < ttl
+
+def remember_valid_key(api_key: str) -> None:
+    cache = _read_key_cache()
+    cache[_key_hash(api_key)] = time.time()
+    try:
+        os.makedirs(os.path.dirname(KEY_CACHE_FILE), exist_ok=True)
+        with open(KEY_CACHE_FILE, "w") as f:
+            json.dump(cache, f)
+    except OSError as e: #the cache is only an optimisation
+        print(f"[WARN] could not save the api key cache: {e}")
+
+def load_settings(settings_file: str = "settings.json") -> dict:
     """_summary_
-    gets the needed info for openai api uses from the .json, checks if the api key is valid and creates a model name.
-    
-    Args:
-        settings_file (str): _description_. Defaults to "settings.json".
+    reads the openai settings from the .json without making any request (no client, no key check)
 
     Returns:
-        tuple (client,description,voice_description,text_model,name,stream,reasoning):  | _description_ | client: openAI client object| description: model description | text_model: openAI's text model name | name: name of the model
+        dict: _description_. keys: api_key, description, voice_description, text_model, name, stream, reasoning
     """
     #check if the settings file exists
-    
     try:
         with open(settings_file, "r") as f:
             pass
@@ -43,31 +86,61 @@ def get_openai_settings(settings_file: str = "settings.json"):
     with open(settings_file, "r") as f:
             settings = json.load(f)
 
-    #gets the needed info for openai api uses from the .json
-    client = openai.OpenAI(api_key=settings["user"]["openAI_apiKey"])
-    description = "\n".join(settings["model_description"]["description"])
-    voice_description = "\n".join(settings["model_description"]["voice_description"])
-    text_model = settings["model_settings"]["openAI_text_model"]
-    name = os.path.splitext(settings["model_files"]["name"])[0]
-    stream = settings["model_settings"]["streaming"]
-    reasoning = settings["model_settings"]["reasoning"]
+    return {
+        "api_key": settings["user"]["openAI_apiKey"],
+        "description": "\n".join(settings["model_description"]["description"]),
+        "voice_description": "\n".join(settings["model_description"]["voice_description"]),
+        "text_model": settings["model_settings"]["openAI_text_model"],
+        "name": os.path.splitext(settings["model_files"]["name"])[0],
+        "stream": settings["model_settings"]["streaming"],
+        "reasoning": settings["model_settings"]["reasoning"],
+    }
+
+def get_openai_settings(settings_file: str = "settings.json", key_check_ttl: float = 24 * 3600):
+    """_summary_
+    gets the needed info for openai api uses from the .json, checks if the api key is valid and creates a model name.
+    The key check is a billable request so it is done at most once every 'key_check_ttl' seconds per key.
     
-    #Makes a request to see if the api_key is valid
-    try:
-        client.responses.create(
-            model="gpt-5-nano", #least expensive model
-            instructions=" ",
-            input=" ",
-            max_output_tokens=16 #minimum token value
-        )
-        print("API key is valid!")
-    except Exception as e:
-        assert False, f"An error occurred: {e} Try checking your connection or API key"
+    Args:
+        settings_file (str): _description_. Defaults to "settings.json".
+        key_check_ttl (float): _description_. Seconds a successful key check is trusted. 0 checks on every call. Defaults to 24h.
+
+    Returns:
+        tuple (client,description,voice_description,text_model,name,stream,reasoning):  | _description_ | client: openAI client object| description: model description | text_model: openAI's text model name | name: name of the model
+    """
+    settings = load_settings(settings_file)
+    network = http_pool.configure(settings_file)
+
+    #gets the needed info for openai api uses from the .json (the client shares the connection pool of the process)
+    client = http_pool.get_client(settings["api_key"], network=network)
+    description = settings["description"]
+    voice_description = settings["voice_description"]
+    text_model = settings["text_model"]
+    name = settings["name"]
+    stream = settings["stream"]
+    reasoning = settings["reasoning"]
+    
+    #Makes a request to see if the api_key is valid, unless it was checked recently
+    api_key = settings["api_key"]
+    if key_check_ttl > 0 and key_recently_validated(api_key, key_check_ttl):
+        print("API key is valid! (cached)")
+    else:
+        try:
+            http_pool.for_operation(client,"check").responses.create(
+                model="gpt-5-nano", #least expensive model
+                instructions=" ",
+                input=" ",
+                max_output_tokens=16 #minimum token value
+            )
+            print("API key is valid!")
+        except Exception as e:
+            assert False, f"An error occurred: {e} Try checking your connection or API key"
+        if key_check_ttl > 0:
+            remember_valid_key(api_key)
     
     return client,description,voice_description,text_model,name,stream,reasoning
 
-def chat(client: openai.OpenAI=None, description: str=None,text_model: str=None,user_input: str=None,name : str = None,streaming : bool = False,additional_instructions: str = "",reason : str = "minimal"):
-    
+def _check_chat_args(client,description,text_model,user_input):
     #assertions
     if client == None:
         assert False, "missing api_key"
@@ -77,31 +150,110 @@ def chat(client: openai.OpenAI=None, description: str=None,text_model: str=None,
         assert False, "missing model"
     elif user_input == None or user_input == "":
         assert False, "missing user input"
+
+def _chat_request(description,text_model,memory_text,user_input,additional_instructions,reason,previous_response_id=None) -> dict:
+    """
+    arguments of the responses request shared by 'chat()' and 'achat()'.
+    With 'previous_response_id' only the user input is sent, openAI already has the rest of the conversation.
+    """
+    request = dict(
+        model=text_model,
+        instructions=description + ' ' + additional_instructions,
+        reasoning={"effort": reason},
+    )
+    if previous_response_id is not None:
+        request["input"] = [{"role": "user", "content": user_input}]
+        request["previous_response_id"] = previous_response_id
+    else:
+        request["input"] = [
+        {
+            "role": "assistant",
+            "content": memory_text
+        },
+        {
+            "role": "user",
+            "content": user_input
+        }]
+    return request
+
+CHAIN_ERRORS = (openai.NotFoundError, openai.BadRequestError) #previous response expired, deleted or not stored
+
+def chat(client: openai.OpenAI=None, description: str=None,text_model: str=None,user_input: str=None,name : str = None,streaming : bool = False,additional_instructions: str = "",reason : str = "minimal",context = None,scope = None):
+    """_summary_
+    Sends the user input with the memory of the model to openAI and returns the answer (or a generator of text deltas when streaming)
+    Args:
+        context (context.ContextWindow): _description_. Builds a token budgeted memory (summary + recent turns + old turns related to the user input)
+            and chains the turns on openAI's stored state when its 'chain_turns' > 0 (falls back to the memory if the chain is lost). Defaults to None which sends the whole memory file.
+        scope (turn_runtime.TurnScope): _description_. Cancelling it closes the stream of the answer (the connection is freed, no more tokens are generated). Defaults to None.
+    """
+    _check_chat_args(client,description,text_model,user_input)
+    previous = context.chain() if context is not None else None
     
+    #memory sent with the request, not needed when chained on the previous response
+    memory_text = None
+    if previous is None:
+        with tracing.span("chat.memory"):
+            if context is not None:
+                memory_text = context.build(user_input)
+            else:
+                memory_text = get_memory("chatlogs",name)
+
      #send a request with user texts to openai
-    response = client.responses.create(
-    model=text_model,
-    instructions=description + ' ' + additional_instructions,
-    input=[
-    {
-        "role": "assistant",
-        "content": get_memory("chatlogs",name)
-    },
-    {
-        "role": "user",
-        "content": user_input
-    }],
-    reasoning={"effort": reason},
-    stream= streaming
-    )
+    sent = time.perf_counter()
+    try:
+        with tracing.span("chat.request", model=text_model, streaming=streaming, chained=previous is not None):
+            response = http_pool.for_operation(client,"chat").responses.create(
+                **_chat_request(description,text_model,memory_text,user_input,additional_instructions,reason,previous),
+                stream= streaming
+            )
+    except CHAIN_ERRORS as e:
+        if previous is None:
+            raise
+        print(f"[WARN] conversation state lost ({e.__class__.__name__}), sending the memory again")
+        context.unchain()
+        return chat(client,description,text_model,user_input,name,streaming,additional_instructions,reason,context,scope)
+
+    on_done = context.chained if context is not None else None
     if streaming == True:
-        for event in response:
-            if event.type == "response.output_text.delta":
-                yield event.delta
+        if scope is not None:
+            scope.on_cancel(response.close) #the reading thread gets an error and 'stream_deltas' ends
+        return stream_deltas(response,sent,on_done,scope)
     else:
+        if on_done is not None:
+            on_done(response.id)
         text = response.output_text
         return text
 
+def stream_deltas(response, sent: float = None, on_done = None, scope = None):
+    """
+    yields the text deltas of a streamed openAI response
+    (kept out of 'chat()' so that the non streaming call returns a string and not a generator).
+    'sent' is the time.perf_counter() of the request, the first and last delta are traced from it.
+    'on_done' is called with the response id once the response is complete.
+    Ends quietly when 'scope' (turn_runtime.TurnScope) is cancelled, the stream is closed when the reader stops early.
+    """
+    first = None
+    try:
+        for event in response:
+            if scope is not None and scope.cancelled:
+                return
+            if event.type == "response.completed" and on_done is not None:
+                on_done(event.response.id)
+            elif event.type == "response.output_text.delta":
+                if first is None:
+                    first = time.perf_counter()
+                    if sent is not None:
+                        tracing.record("chat.first_delta", first - sent, sent)
+                yield event.delta
+    except Exception:
+        if scope is None or not scope.cancelled:
+            raise
+        return #closed by the cancel of the turn
+    finally:
+        response.close()
+    if first is not None and sent is not None:
+        tracing.record("chat.last_delta", time.perf_counter() - sent, sent)
+
 
 
 def voice(client: openai.OpenAI=None, text: str=None,description : str = None, name : str = "speech") -> None:
@@ -122,172 +274,180 @@ def voice(client: openai.OpenAI=None, text: str=None,description : str = None, n
         assert False, "missing text for tts"
         
     #with output text creates a tss with openai-tts
-    with client.audio.speech.with_streaming_response.create(
-        model="gpt-4o-mini-tts",
-        voice="coral",
+    with tracing.span("tts", chars=len(text)), http_pool.for_operation(client,"tts").audio.speech.with_streaming_response.create(
+        model=TTS_MODEL,
+        voice=TTS_VOICE,
         input=text,
         instructions=description,
     ) as response:
         response.stream_to_file(f"./audio_input/{name}.wav")
 
 
-def stream_chat_voice(client: openai.OpenAI=None, description: str=None,text_model: str=None,user_input: str=None,name : str = None,useMemory : bool = True) -> str:
+TTS_SAMPLE_RATE = 24000 #openAI's raw pcm: 24kHz, 16-bit signed little-endian, mono
+
+def pcm_to_float32(data: bytes) -> np.ndarray:
+    """
+    decodes raw 16-bit pcm bytes to float32 samples in [-1, 1].
+    The bytes are read in place with 'np.frombuffer', the only copy is the float32 result.
+    """
+    samples = np.frombuffer(data, dtype="<i2", count=len(data) // 2)
+    return np.multiply(samples, 1 / 32768, dtype=np.float32)
+
+def voice_pcm(client: openai.OpenAI=None, text: str=None,description : str = None) -> tuple:
+    """_summary_
+    Makes the audio with the openAI's tts and returns it in memory
+    Args:
+        client (openai.OpenAI): _description_. The api_key found in the .json file should use '_get_openai_settings()'.
+        text (str): _description_. The text to be used for the tts should be made by 'chat()'.
+        description (str): _description_. The tone of the voice.
+
+    Returns:
+        tuple (audio,sr): | audio: mono float32 NumPy array | sr: sample rate (24000)
+    """
+    if client == None:
+        assert False, "missing api_key"
+    if text == None:
+        assert False, "missing text for tts"
+
+    def request() -> bytes:
+        response = http_pool.for_operation(client,"tts").audio.speech.create(
+            model=TTS_MODEL,
+            voice=TTS_VOICE,
+            input=text,
+            instructions=description,
+            response_format="pcm",
+        )
+        return response.read()
+
+    with tracing.span("tts", chars=len(text)) as span:
+        data = http_pool.hedged(request,_tts_hedge(client,text))
+        span.set(bytes=len(data))
+    return pcm_to_float32(data),TTS_SAMPLE_RATE
+
+
+#----------------------------------asyncio versions---------------------------------
+
+async def achat(client: openai.AsyncOpenAI=None, description: str=None,text_model: str=None,user_input: str=None,name : str = None,streaming : bool = False,additional_instructions: str = "",reason : str = "minimal",context = None):
+    """_summary_
+    Same as 'chat()' with an openai.AsyncOpenAI client. The memory is read in a worker thread so the event loop never waits on the disk.
+    Returns:
+        str or async generator: _description_. The answer, or an async generator of text deltas when streaming
     """
-    [DEPRECATED]
-    Streams chat responses from an OpenAI client, processes the output in real-time, and generates and converts voice audio for each response segment.
+    _check_chat_args(client,description,text_model,user_input)
+
+    previous = context.chain() if context is not None else None
+
+    memory_text = None
+    if previous is None:
+        with tracing.span("chat.memory"):
+            if context is not None:
+                memory_text = await asyncio.to_thread(context.build,user_input)
+            else:
+                memory_text = await asyncio.to_thread(get_memory,"chatlogs",name)
+
+    sent = time.perf_counter()
+    try:
+        with tracing.span("chat.request", model=text_model, streaming=streaming, chained=previous is not None):
+            response = await http_pool.for_operation(client,"chat").responses.create(
+                **_chat_request(description,text_model,memory_text,user_input,additional_instructions,reason,previous),
+                stream= streaming
+            )
+    except CHAIN_ERRORS as e:
+        if previous is None:
+            raise
+        print(f"[WARN] conversation state lost ({e.__class__.__name__}), sending the memory again")
+        context.unchain()
+        return await achat(client,description,text_model,user_input,name,streaming,additional_instructions,reason,context)
+
+    on_done = context.chained if context is not None else None
+    if streaming == True:
+        return astream_deltas(response,sent,on_done)
+    else:
+        if on_done is not None:
+            on_done(response.id)
+        return response.output_text
+
+async def astream_deltas(response, sent: float = None, on_done = None):
+    """yields the text deltas of a streamed openAI response from an openai.AsyncOpenAI client, traced like 'stream_deltas()'. The stream is closed when the reader stops early or is cancelled"""
+    first = None
+    try:
+        async for event in response:
+            if event.type == "response.completed" and on_done is not None:
+                on_done(event.response.id)
+            elif event.type == "response.output_text.delta":
+                if first is None:
+                    first = time.perf_counter()
+                    if sent is not None:
+                        tracing.record("chat.first_delta", first - sent, sent)
+                yield event.delta
+    finally:
+        await response.close()
+    if first is not None and sent is not None:
+        tracing.record("chat.last_delta", time.perf_counter() - sent, sent)
+
+async def avoice_pcm(client: openai.AsyncOpenAI=None, text: str=None,description : str = None) -> tuple:
+    """_summary_
+    Same as 'voice_pcm()' with an openai.AsyncOpenAI client
+    Returns:
+        tuple (audio,sr): | audio: mono float32 NumPy array | sr: sample rate (24000)
+    """
+    if client == None:
+        assert False, "missing api_key"
+    if text == None:
+        assert False, "missing text for tts"
+
+    async def request() -> bytes:
+        response = await http_pool.for_operation(client,"tts").audio.speech.create(
+            model=TTS_MODEL,
+            voice=TTS_VOICE,
+            input=text,
+            instructions=description,
+            response_format="pcm",
+        )
+        return response.content
+
+    with tracing.span("tts", chars=len(text)) as span:
+        data = await http_pool.ahedged(request,_tts_hedge(client,text))
+        span.set(bytes=len(data))
+    return pcm_to_float32(data),TTS_SAMPLE_RATE
+
+
+def stream_chat_voice(client: openai.OpenAI=None, description: str=None,text_model: str=None,user_input: str=None,name : str = None,useMemory : bool = True,voice_description: str = None) -> str:
+    """
+    Streams a chat response and speaks it sentence by sentence while it is generated.
         client (openai.OpenAI): The OpenAI client instance to use for generating responses. Must not be None.
         description (str): System instructions or description for the assistant. Must not be None.
         text_model (str): The model name to use for generating responses. Must not be None.
         user_input (str): The user's input message. Must not be None or empty.
         name (str): The name used for audio file naming and memory retrieval.
         useMemory (bool): Whether to include previous chat logs in the prompt. Defaults to True.
+        voice_description (str): The tone given to the tts. Defaults to None.
     Returns:
-        str: The concatenated text output generated by the model.
-    Raises:
-        AssertionError: If any of the required arguments (`client`, `description`, `text_model`, or `user_input`) are missing or invalid.
-        - Streams and prints model output in real-time.
-        - For each line of output, generates a voice audio file and processes it in a background thread.
-        - Calls external functions for voice synthesis and audio conversion.
-        - May read from and write to files in './audio_input/' and './audio_output/' directories.
+        tuple (text,nb): The text output generated by the model and the number of spoken sentences.
     Notes:
         - Needs the rvc settings loaded with 'load_rvc_settings()' before the calling of this function or else it will not work
-        - Designed for interactive or streaming applications where immediate feedback and audio output are desired.
+        - The sentences go through 'voice_pipeline.VoicePipeline' (tts -> rvc -> playback), the function returns once the last one is played.
     """
-    #assertions
-    if client == None:
-        assert False, "missing api_key"
-    elif description == None:
-        assert False, "missing description"
-    elif text_model == None:
-        assert False, "missing model"
-    elif user_input == None or user_input == "":
-        assert False, "missing user input"
-    
-    #imports
-    from rvc_converter import convertToAI
-    import threading
+    from voice_pipeline import VoicePipeline #imported here because voice_pipeline needs this module
     
-    #--------------------Functions needed to be in a thread-----------------------------
-    
-    class BackgroundTask:
-        """
-        A class to run a function as a background task in a separate thread.
-        Args:
-            func (callable): The function to execute in the background.
-            *args: Positional arguments to pass to the function.
-            **kwargs: Keyword arguments to pass to the function.
-        Methods:
-            start():
-                Starts the background task if it is not already running.
-        Example:
-            def my_task(x, y):
-                print(x + y)
-            task = BackgroundTask(my_task, 2, 3)
-            task.start()
-        """
-        def __init__(self, func, *args, **kwargs):
-            self.func = func
-            self.args = args
-            self.kwargs = kwargs
-            self._thread = None
-
-        def _run(self):
-            self.func(*self.args, **self.kwargs)  # run once
-
-        def start(self):
-            if self._thread is None or not self._thread.is_alive():
-                self._thread = threading.Thread(target=self._run, daemon=True)
-                self._thread.start()
-                print("Background task started")
-
-    def start_voice(text: list,i,client:openai.OpenAI=None,name: str = None):
-        """
-        Generates and converts a voice audio file from a given text input.
-
-        Side Effects:
-            - Calls the `voice` function to generate a voice audio file from the specified text.
-            - Prints status messages to the console.
-            - Calls the `convertToAI` function to process the generated audio file.
-            - Saves audio files in the './audio_input/' and './audio_output/' directories.
-        """
-        voice(client,text[i],f"{name}{i}") # create a voice with tts
-        print("voice done")
-        convertToAI(f"./audio_input/{name}{i}.wav",f"./audio_output/{name}{i}.wav") # converts it with rvc
-        print(f"-------convertion {i} done-------")
-        
-    #-----------------------------------Main script----------------------------------------------
-    if useMemory == True:    
-        # creates a stream of text using the memory in the memory file for the model and user input
-        stream = client.responses.create(
-            model=text_model,
-            instructions=description,
-            input=[
-            {
-                "role": "assistant",
-                "content": get_memory("chatlogs",name)
-            },
-            {
-                "role": "user",
-                "content": user_input
-            }
-        ],
-            reasoning={"effort": "minimal"},
-            stream=True
-        )
+    pipeline = VoicePipeline(client,voice_description,name)
+    pipeline.start() #time to first audio is measured from the request
+    if useMemory == True:
+        deltas = chat(client,description,text_model,user_input,name,streaming=True)
     else:
-        # creates a stream of text only with user input
-        stream = client.responses.create(
+        if client == None:
+            assert False, "missing api_key"
+        elif user_input == None or user_input == "":
+            assert False, "missing user input"
+        response = http_pool.for_operation(client,"chat").responses.create(
             model=text_model,
             instructions=description,
-            input=[
-            {
-                "role": "user",
-                "content": user_input
-            }
-        ],
+            input=[{"role": "user", "content": user_input}],
             reasoning={"effort": "minimal"}, #for max speed
             stream=True
         )
+        deltas = stream_deltas(response)
 
-    # global variables needed for real time convertion
-    texts = []
-    temp_text = ""
-    nb = 0
-
-    # loop for real time convertion
-    for event in stream:
-        if event.type == "response.output_text.delta":
-            # checks every characters in the stream
-            for char in event.delta:
-                temp_text += char # adds it to a temporary memory
-                if char == '\n': # checks if the sentence can be cutted without causing the tts model to sound weird
-                    if temp_text == '\n': # avoid empty soundfiles
-                        temp_text = ""
-                        continue
-                    else: # converts the text in memory, resets it and add it to the returned value of the function: 'texts'
-                        print("[-----------append text------------")
-                        print(repr(temp_text))
-                        print("-----------append text------------]")
-                        texts.append(temp_text+'\n')
-                        thread = BackgroundTask(start_voice,texts,nb,client,name)
-                        thread.start()
-                        temp_text = ""
-                        nb += 1
-        # When stream completed converts the text in memory with the remaining characters and add it to the returned value
-        elif event.type == "response.completed":
-            print("[-----------append text------------")
-            print(repr(temp_text))
-            print("-----------append text------------]")
-            texts.append(temp_text+'\n')
-            thread = BackgroundTask(start_voice,texts,nb,client,name)
-            thread.start()
-            print("--- Stream completed ---")
-            nb += 1
-            
-        elif event.type == "response.error":
-            print(f"\n[Error] {event.error}")
-
-
-    text = "".join(texts) # combines the segmented script into a single string
-    return text,nb
-
+    text = pipeline.speak(deltas)
+    pipeline.wait()
+    return text,len(pipeline.texts)
@@ -0,0 +1,245 @@
+"""
+This module builds the memory part of the chat prompt within a token budget instead of sending the whole chat log.
+The most recent turns are kept word for word and the older ones are folded into a rolling summary that is refreshed in a background thread.
+Functions:
+    - count_tokens(text: str) -> int:
+        Counts the tokens of a text with tiktoken if it is installed, or estimates it (about 4 characters per token).
+    - get_context_settings(settings_file: str = "settings.json") -> tuple:
+        Reads the optional context settings from the .json file.
+Classes:
+    - ContextWindow:
+        Assembles the memory of a model for 'chatgpt.chat()' and keeps the per-turn token counts and the summary between turns.
+"""
+
+import json
+import threading
+import openai
+import memory
+import retrieval
+import http_pool
+
+#imports---------------------------------------------------------------
+
+SUMMARY_HEADER = "[summary of the earlier conversation]:\n"
+RECENT_HEADER = "[recent messages]:\n"
+RECALL_HEADER = "[earlier messages related to the new one]:\n"
+
+_encoding = None #tiktoken encoder, loaded on the first count
+_encoding_loaded = False
+_headers_tokens = None
+
+def _get_encoding():
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("o200k_base")
+        except Exception: #tiktoken is optional
+            _encoding = None
+    return _encoding
+
+def count_tokens(text: str) -> int:
+    """
+    returns the number of tokens of the text. Uses tiktoken when available, else an estimate of 4 characters per token
+    """
+    if text == "":
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+def _headers_count() -> int:
+    """tokens of the section headers, part of every memory text"""
+    global _headers_tokens
+    if _headers_tokens is None:
+        _headers_tokens = count_tokens(SUMMARY_HEADER + RECENT_HEADER + RECALL_HEADER)
+    return _headers_tokens
+
+def get_context_settings(settings_file: str = "settings.json"):
+    """_summary_
+    gets the context window settings from the .json. All of them are optional.
+
+    Args:
+        settings_file (str): _description_. Defaults to "settings.json".
+
+    Returns:
+        tuple (context_tokens,summary_tokens,summary_model,recall_turns,recall_tokens): | context_tokens: token budget of the memory sent with each request | summary_tokens: max size of the rolling summary | summary_model: openAI's model used to summarize
+        | recall_turns: number of old turns related to the new message added to the memory (0 disables it) | recall_tokens: max size of these turns
+        | chain_turns: turns chained on openAI's stored conversation state before the memory is sent again (0 sends the memory every turn)
+    """
+    with open(settings_file, "r") as f:
+        settings = json.load(f)
+
+    model_settings = settings["model_settings"]
+    context_tokens = model_settings.get("context_tokens", 4000)
+    summary_tokens = model_settings.get("summary_tokens", context_tokens // 4)
+    summary_model = model_settings.get("summary_model", "gpt-5-nano")
+    recall_turns = model_settings.get("recall_turns", 4)
+    recall_tokens = model_settings.get("recall_tokens", context_tokens // 4)
+    chain_turns = model_settings.get("chain_turns", 0)
+    return context_tokens,summary_tokens,summary_model,recall_turns,recall_tokens,chain_turns
+
+class ContextWindow:
+    """
+    Builds the memory sent to the model with at most 'budget' tokens.\n
+    - The newest turns of the memory file are kept verbatim as long as they fit in the budget left by the summary.
+    - The turns that fall out of the budget are folded into a rolling summary by 'summary_model' in a background thread,
+      the request never waits for it: until it is done the previous summary is used.
+    - The token count of every turn is computed once and cached, turns are never re-tokenized.
+    - Up to 'recall_turns' older turns related to the new message (found by a local 'retrieval.TurnIndex', at most 'recall_tokens')
+      are added after the recent turns, so an old fact can come back without sending the whole memory.
+    - The text is ordered from the most stable part (summary) to the least stable one (related turns), so openAI's prompt cache
+      can reuse the start of the previous request. The three headers are always written, in this order, even for an empty section.
+    - With 'chain_turns' > 0 the memory is only sent on the first turn of a chain ("anchor"), the next turns only send the new message
+      with 'previous_response_id' (openAI's stored conversation state). After 'chain_turns' turns, or when the chain is lost,
+      the next turn is an anchor again so the input tokens of a turn stay bounded.\n
+    exemple_ | context = ContextWindow(client,"teto",budget=4000) | chatgpt.chat(...,context=context)
+    """
+    def __init__(self, client: openai.OpenAI = None, name: str = None, budget: int = 4000, summary_tokens: int = None, summary_model: str = "gpt-5-nano",
+                 recall_turns: int = 4, recall_tokens: int = None, chain_turns: int = 0, type: str = "chatlogs"):
+        assert name != None and name != "", "missing model name"
+        self.client = client
+        self.name = name
+        self.type = type
+        self.budget = budget
+        self.summary_tokens = budget // 4 if summary_tokens is None else summary_tokens
+        self.summary_model = summary_model
+        self.recall_turns = recall_turns
+        self.recall_tokens = budget // 4 if recall_tokens is None else recall_tokens
+        self.chain_turns = chain_turns
+        self.previous_response_id = None #last response of the chain, None when the next turn is an anchor
+        self._chained = 0 #turns in the current chain
+
+        self._lock = threading.Lock()
+        self._counts = [] #token count of every turn of the memory file
+        self._index = retrieval.TurnIndex() #words of every turn of the memory file
+        self.summary = ""
+        self._summary_count = 0
+        self._summarized = 0 #number of turns already folded in the summary
+        self._refresh = None #running summary thread
+
+    def reset(self) -> None:
+        """forgets the summary and the cached counts, used when the memory file is deleted"""
+        with self._lock:
+            self._counts = []
+            self._index = retrieval.TurnIndex()
+            self.summary = ""
+            self._summary_count = 0
+            self._summarized = 0
+            self.previous_response_id = None
+            self._chained = 0
+
+    def _update_counts(self, store: memory.MemoryStore) -> None:
+        total = len(store)
+        if total < len(self._counts): #memory was deleted and restarted
+            self._counts = []
+            self._index = retrieval.TurnIndex()
+            self.summary = ""
+            self._summary_count = 0
+            self._summarized = 0
+        if total > len(self._counts):
+            for turn in store.turns(len(self._counts), total):
+                self._counts.append(count_tokens(turn))
+                self._index.add(turn)
+
+    def build(self, query: str = "") -> str:
+        """
+        returns the memory text to send with the next request: the rolling summary, the most recent turns and the old turns related to 'query'
+        (the new message), each under its header even when it is empty. Starts a summary refresh in the background when turns fell out of the budget.
+        """
+        store = memory.get_store(self.type, self.name)
+        with self._lock:
+            self._update_counts(store)
+            total = len(self._counts)
+            left = self.budget - self._summary_count - _headers_count()
+
+            start = total
+            while start > self._summarized and left - self._counts[start - 1] >= 0:
+                start -= 1
+                left -= self._counts[start]
+            if start == total and total > 0 and start > self._summarized:
+                start = total - 1 #always keep the last turn even if it is bigger than the budget
+
+            if start > self._summarized:
+                self._start_refresh(store, start)
+            summary = self.summary
+            recalled = self._recall(query, start)
+
+        recent = store.tail(total - start) if start < total else ""
+        #the three sections are always there and in the same order, empty or not, so the model always reads the same layout
+        text = SUMMARY_HEADER + (summary + "\n" if summary != "" else "")
+        text += RECENT_HEADER + recent
+        return text + RECALL_HEADER + "".join(store.turn(turn) for turn in recalled)
+
+    def _recall(self, query: str, before: int) -> list:
+        """numbers of the turns before 'before' that are the most related to 'query' and fit in 'recall_tokens', oldest first"""
+        if query == "" or self.recall_turns <= 0 or before <= 0:
+            return []
+        left = self.recall_tokens
+        recalled = []
+        for turn, _ in self._index.search(query, self.recall_turns, before):
+            if self._counts[turn] <= left:
+                left -= self._counts[turn]
+                recalled.append(turn)
+        return sorted(recalled)
+
+    #----------------------------------conversation state-------------------------------
+
+    def chain(self):
+        """id of the response to chain the next turn on, or None when the next turn must send the memory"""
+        if self.chain_turns <= 0:
+            return None
+        return self.previous_response_id
+
+    def chained(self, response_id: str) -> None:
+        """records the response of a turn, the next one is chained on it until 'chain_turns' turns were chained"""
+        if self.chain_turns <= 0 or response_id is None:
+            return
+        with self._lock:
+            self._chained = self._chained + 1 if self.previous_response_id is not None else 1
+            self.previous_response_id = response_id if self._chained < self.chain_turns else None
+
+    def unchain(self) -> None:
+        """forgets the chain (expired or deleted on openAI's side), the next turn sends the memory"""
+        with self._lock:
+            self.previous_response_id = None
+            self._chained = 0
+
+    #----------------------------------rolling summary---------------------------------
+
+    def _start_refresh(self, store: memory.MemoryStore, stop: int) -> None:
+        if self.client is None or (self._refresh is not None and self._refresh.is_alive()):
+            return
+        turns = store.turns(self._summarized, stop)
+        self._refresh = threading.Thread(target=self._summarize, args=(self.summary, turns, self._summarized, stop), daemon=True)
+        self._refresh.start()
+
+    def _summarize(self, previous: str, turns: list, start: int, stop: int) -> None:
+        try:
+            response = http_pool.for_operation(self.client,"summary").responses.create(
+                model=self.summary_model,
+                instructions="You keep the long term memory of a conversation. Merge the previous summary and the new messages into one short summary. "
+                             "Keep names, facts about the user, promises, running jokes and the current topic. Only write the summary.",
+                input=f"[previous summary]:\n{previous}\n[new messages]:\n{''.join(turns)}",
+                max_output_tokens=max(self.summary_tokens * 4, 256), #leaves room for the reasoning tokens
+                reasoning={"effort": "minimal"},
+            )
+            summary = response.output_text.strip()
+        except Exception as e:
+            print(f"[WARN] could not refresh the memory summary: {e}")
+            return
+
+        with self._lock:
+            if self._summarized != start: #memory was reset while summarizing
+                return
+            self.summary = summary
+            self._summary_count = count_tokens(summary)
+            self._summarized = stop
+
+    def wait(self, timeout: float = None) -> None:
+        """waits for the running summary refresh, if any"""
+        thread = self._refresh
+        if thread is not None:
+            thread.join(timeout)
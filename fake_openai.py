@@ -0,0 +1,287 @@
+"""
+Local stand-in of the parts of the openAI api used by this project, for benchmarks and offline runs (no network, no key, no cost).
+Routes (under /v1):
+    - POST /responses         text answer, streamed (server sent events) or not, with a configurable time to first token and time between tokens.
+                              The response ids are kept so 'previous_response_id' works (404 for an unknown id, like an expired one)
+    - POST /audio/speech      24kHz 16-bit pcm (a tone as long as the text would be spoken) after a configurable delay
+    - POST /chat/completions  short text answer after a configurable delay (+ a cost per image)
+    - GET  /models
+    A flaky connection is simulated with 'tts_slow_rate' (share of the tts answers delayed by 'tts_slow_delay') and 'error_rate' (share of 503 answers).
+    'jitter' spreads every delay around its value (0.3: uniformly between 70% and 130% of it), like a real api under load.
+    'rpm' / 'tpm' apply per model rate limits like openAI's: 'x-ratelimit-*' headers on every answer and a 429 when a request does not fit.
+Classes:
+    - FakeOpenAI:
+        Runs the server in a background thread. exemple_ | with FakeOpenAI(first_token_delay=0.3) as fake: client = openai.OpenAI(api_key="fake", base_url=fake.base_url)
+Functions:
+    - create_app(...) -> FastAPI:
+        Returns the app, used by 'FakeOpenAI' and by the command line.
+Usage:
+    python fake_openai.py --port 8001 --first-token-delay 0.3
+    OPENAI_BASE_URL=http://127.0.0.1:8001/v1 python server.py
+"""
+
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import threading
+import numpy as np
+from fastapi import FastAPI, Request
+from starlette.requests import ClientDisconnect
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+import uvicorn
+import rate_limits
+
+#imports---------------------------------------------------------------
+
+SAMPLE_RATE = 24000
+REPLY = ("Hi! I was just thinking about you. How was your day? Tell me everything, I want to know what you did, "
+         "who you talked to and what made you smile. I missed you a lot, you know. ")
+
+def _reply_tokens(count: int) -> list:
+    """'count' word sized tokens of a looping reply"""
+    words = REPLY.split(" ")
+    return [(" " if i else "") + words[i % len(words)] for i in range(count)]
+
+def _response(text: str, model: str, response_id: str = "resp_fake") -> dict:
+    return {
+        "id": response_id, "object": "response", "created_at": int(time.time()), "model": model, "status": "completed",
+        "output": [{"type": "message", "id": "msg_fake", "status": "completed", "role": "assistant",
+                    "content": [{"type": "output_text", "text": text, "annotations": []}]}],
+        "parallel_tool_calls": True, "tool_choice": "auto", "tools": [],
+        "usage": {"input_tokens": 0, "output_tokens": len(text) // 4, "total_tokens": len(text) // 4,
+                  "input_tokens_details": {"cached_tokens": 0}, "output_tokens_details": {"reasoning_tokens": 0}},
+    }
+
+async def _body(request: Request) -> dict:
+    """json body of a request, None when the client already gave up on it (the slower copy of a hedged tts)"""
+    try:
+        return await request.json()
+    except ClientDisconnect:
+        return None
+
+def _event(data: dict) -> str:
+    return f"event: {data['type']}\ndata: {json.dumps(data)}\n\n"
+
+def create_app(first_token_delay: float = 0.3, token_interval: float = 0.02, reply_tokens: int = 60, tts_delay: float = 0.15,
+               tts_seconds_per_char: float = 0.06, chat_delay: float = 0.5, image_delay: float = 0.05,
+               tts_slow_rate: float = 0.0, tts_slow_delay: float = 2.0, error_rate: float = 0.0, seed: int = None, rpm: int = 0, tpm: int = 0,
+               jitter: float = 0.0) -> FastAPI:
+    """
+    first_token_delay: seconds before the first text token | token_interval: seconds between two tokens | reply_tokens: tokens of every answer
+    tts_delay: seconds before the tts answer | tts_seconds_per_char: length of the spoken audio | chat_delay / image_delay: chat completions time (+ per image)
+    tts_slow_rate / tts_slow_delay: share of the tts answers that take 'tts_slow_delay' more seconds | error_rate: share of the requests answered with a 503
+    rpm / tpm: requests and tokens per minute of every model (0: no limit), the tokens are counted with 'rate_limits.estimate_tokens()'
+    jitter: every delay is drawn uniformly between (1 - jitter) and (1 + jitter) times its value
+    """
+    rng = random.Random(seed)
+
+    def delay(seconds: float) -> float:
+        if jitter > 0 and seconds > 0:
+            return max(seconds * (1 + jitter * rng.uniform(-1, 1)), 0.0)
+        return seconds
+
+    def unavailable():
+        """a 503 for 'error_rate' of the requests, the openAI client retries them"""
+        if error_rate > 0 and rng.random() < error_rate:
+            return JSONResponse({"error": {"message": "The server is overloaded.", "type": "server_error", "param": None, "code": None}}, status_code=503)
+        return None
+
+    buckets = {} #model -> [requests left, tokens left, time.monotonic() of the last update]
+
+    def rate_limit(body: dict) -> tuple:
+        """(a 429 answer or None, the rate limit headers) of a request, the buckets refill over a minute"""
+        if rpm <= 0 and tpm <= 0:
+            return None, {}
+        tokens = rate_limits.estimate_tokens(body)
+        now = time.monotonic()
+        bucket = buckets.setdefault(body.get("model", "fake"), [float(rpm), float(tpm), now])
+        elapsed, bucket[2] = now - bucket[2], now
+        bucket[0] = min(rpm, bucket[0] + elapsed * rpm / 60)
+        bucket[1] = min(tpm, bucket[1] + elapsed * tpm / 60)
+        wait = 0.0
+        if rpm > 0 and bucket[0] < 1:
+            wait = (1 - bucket[0]) * 60 / rpm
+        if tpm > 0 and bucket[1] < min(tokens, tpm):
+            wait = max(wait, (min(tokens, tpm) - bucket[1]) * 60 / tpm)
+        if wait == 0:
+            bucket[0] -= 1
+            bucket[1] -= min(tokens, tpm)
+        headers = {}
+        if rpm > 0:
+            headers.update({"x-ratelimit-limit-requests": str(rpm), "x-ratelimit-remaining-requests": str(max(int(bucket[0]), 0))})
+        if tpm > 0:
+            headers.update({"x-ratelimit-limit-tokens": str(tpm), "x-ratelimit-remaining-tokens": str(max(int(bucket[1]), 0))})
+        if wait == 0:
+            return None, headers
+        app.state.rate_limited += 1
+        headers["retry-after-ms"] = str(int(wait * 1000) + 1)
+        return JSONResponse({"error": {"message": "Rate limit reached, please try again later.", "type": "requests", "param": None,
+                                       "code": "rate_limit_exceeded"}}, status_code=429, headers=headers), headers
+
+    app = FastAPI(title="fake openAI")
+    app.state.requests = {"responses": 0, "speech": 0, "chat": 0}
+    app.state.rate_limited = 0 #429 answers
+    app.state.input_chars = [] #characters of the input of every /responses request
+    app.state.stored = set() #ids of the responses, for 'previous_response_id'
+
+    @app.get("/v1/models")
+    async def models():
+        return {"object": "list", "data": [{"id": "gpt-5-nano", "object": "model", "created": 0, "owned_by": "fake"}]}
+
+    @app.post("/v1/responses")
+    async def responses(request: Request):
+        body = await _body(request)
+        if body is None:
+            return Response(status_code=499)
+        app.state.requests["responses"] += 1
+        error = unavailable()
+        if error is not None:
+            return error
+        error, headers = rate_limit(body)
+        if error is not None:
+            return error
+        model = body.get("model", "fake")
+        previous = body.get("previous_response_id")
+        if previous is not None and previous not in app.state.stored:
+            return JSONResponse({"error": {"message": f"Previous response with id '{previous}' not found.", "type": "invalid_request_error",
+                                           "param": "previous_response_id", "code": "previous_response_not_found"}}, status_code=404)
+        app.state.input_chars.append(len(json.dumps(body.get("input", ""))) + len(body.get("instructions") or ""))
+        response_id = f"resp_{len(app.state.stored) + 1}"
+        app.state.stored.add(response_id)
+        tokens = _reply_tokens(min(reply_tokens, body.get("max_output_tokens") or reply_tokens))
+        if not body.get("stream", False):
+            await asyncio.sleep(delay(first_token_delay + token_interval * (len(tokens) - 1)))
+            return JSONResponse(_response("".join(tokens), model, response_id), headers=headers)
+
+        async def events():
+            sequence = 0
+            yield _event({"type": "response.created", "sequence_number": sequence, "response": {**_response("", model, response_id), "status": "in_progress", "output": []}})
+            await asyncio.sleep(delay(first_token_delay))
+            for i, token in enumerate(tokens):
+                if i:
+                    await asyncio.sleep(delay(token_interval))
+                sequence += 1
+                yield _event({"type": "response.output_text.delta", "sequence_number": sequence, "item_id": "msg_fake",
+                              "output_index": 0, "content_index": 0, "delta": token, "logprobs": []})
+            sequence += 1
+            yield _event({"type": "response.completed", "sequence_number": sequence, "response": _response("".join(tokens), model, response_id)})
+        return StreamingResponse(events(), media_type="text/event-stream", headers=headers)
+
+    @app.post("/v1/audio/speech")
+    async def speech(request: Request):
+        body = await _body(request)
+        if body is None:
+            return Response(status_code=499)
+        app.state.requests["speech"] += 1
+        error = unavailable()
+        if error is not None:
+            return error
+        error, headers = rate_limit(body)
+        if error is not None:
+            return error
+        slow = tts_slow_delay if tts_slow_rate > 0 and rng.random() < tts_slow_rate else 0.0
+        await asyncio.sleep(delay(tts_delay) + slow)
+        samples = max(int(len(body.get("input", "")) * tts_seconds_per_char * SAMPLE_RATE), SAMPLE_RATE // 10)
+        tone = 0.2 * np.sin(2 * np.pi * 220 * np.arange(samples) / SAMPLE_RATE)
+        return Response((tone * 32767).astype("<i2").tobytes(), media_type="audio/pcm", headers=headers)
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await _body(request)
+        if body is None:
+            return Response(status_code=499)
+        app.state.requests["chat"] += 1
+        error, headers = rate_limit(body)
+        if error is not None:
+            return error
+        images = sum(1 for message in body.get("messages", []) if isinstance(message.get("content"), list)
+                     for part in message["content"] if part.get("type") == "image_url")
+        await asyncio.sleep(delay(chat_delay + image_delay * images))
+        text = f"The user switched between {images} screens." if images else "The user worked on their project."
+        return JSONResponse({"id": "chatcmpl_fake", "object": "chat.completion", "created": int(time.time()), "model": body.get("model", "fake"),
+                             "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                             "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}}, headers=headers)
+
+    return app
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+class FakeOpenAI:
+    """
+    Runs 'create_app(**timings)' with uvicorn in a background thread on a free local port.\n
+    exemple_ | with FakeOpenAI(token_interval=0.01) as fake: openai.OpenAI(api_key="fake", base_url=fake.base_url)
+    """
+    def __init__(self, port: int = None, **timings):
+        self.port = _free_port() if port is None else port
+        self.app = create_app(**timings)
+        self.base_url = f"http://127.0.0.1:{self.port}/v1"
+        self._server = uvicorn.Server(uvicorn.Config(self.app, host="127.0.0.1", port=self.port, log_level="warning"))
+        self._thread = None
+
+    def start(self) -> "FakeOpenAI":
+        self._thread = threading.Thread(target=self._server.run, name="fake-openai", daemon=True)
+        self._thread.start()
+        deadline = time.monotonic() + 10
+        while not self._server.started:
+            assert time.monotonic() < deadline, "fake openAI server did not start"
+            time.sleep(0.01)
+        return self
+
+    def stop(self) -> None:
+        self._server.should_exit = True
+        if self._thread is not None:
+            self._thread.join(5)
+            self._thread = None
+
+    @property
+    def requests(self) -> dict:
+        """number of requests received per route"""
+        return dict(self.app.state.requests)
+
+    @property
+    def rate_limited(self) -> int:
+        """number of 429 answers"""
+        return self.app.state.rate_limited
+
+    @property
+    def input_chars(self) -> list:
+        """size of the input of every /responses request"""
+        return list(self.app.state.input_chars)
+
+    def forget(self) -> None:
+        """drops the stored responses, the next 'previous_response_id' gets a 404 like an expired chain"""
+        self.app.state.stored.clear()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="local stand-in of the openAI api")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--first-token-delay", type=float, default=0.3)
+    parser.add_argument("--token-interval", type=float, default=0.02)
+    parser.add_argument("--reply-tokens", type=int, default=60)
+    parser.add_argument("--tts-delay", type=float, default=0.15)
+    parser.add_argument("--chat-delay", type=float, default=0.5)
+    parser.add_argument("--tts-slow-rate", type=float, default=0.0)
+    parser.add_argument("--tts-slow-delay", type=float, default=2.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0, help="spread of every delay, 0.3: between 70%% and 130%% of it")
+    parser.add_argument("--rpm", type=int, default=0, help="requests per minute of every model, 0: no limit")
+    parser.add_argument("--tpm", type=int, default=0, help="tokens per minute of every model, 0: no limit")
+    args = parser.parse_args()
+
+    app = create_app(args.first_token_delay, args.token_interval, args.reply_tokens, args.tts_delay, chat_delay=args.chat_delay,
+                     tts_slow_rate=args.tts_slow_rate, tts_slow_delay=args.tts_slow_delay, error_rate=args.error_rate,
+                     rpm=args.rpm, tpm=args.tpm, jitter=args.jitter)
+    uvicorn.run(app, host=args.host, port=args.port)
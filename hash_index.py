@@ -0,0 +1,120 @@
+"""
+Persistent perceptual hash index of a folder of screenshots and vectorized keyframe selection.
+The 64-bit hashes are kept in a NumPy uint64 array and compared in batches (xor + popcount table) instead of one imagehash at a time.
+Classes:
+    - HashIndex:
+        (file name, capture time, hash) of the images of a folder, saved next to them so a file is only hashed once.
+Functions:
+    - hamming_matrix(hashes: np.ndarray, others: np.ndarray) -> np.ndarray:
+        Hamming distances between every hash of 'hashes' and every hash of 'others'.
+    - select_keyframes(hashes: np.ndarray, threshold: int = 8, window: int = 8) -> list:
+        Indexes of the frames that differ by more than 'threshold' bits from each of the last 'window' keyframes.
+"""
+
+import os
+import numpy as np
+
+#imports---------------------------------------------------------------
+
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8) #bits set in every byte value
+
+def hamming_matrix(hashes: np.ndarray, others: np.ndarray) -> np.ndarray:
+    """returns a (len(hashes), len(others)) array of the number of different bits"""
+    xor = np.bitwise_xor.outer(np.asarray(hashes, dtype=np.uint64), np.asarray(others, dtype=np.uint64))
+    return _POPCOUNT[xor.view(np.uint8)].reshape(xor.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+def select_keyframes(hashes: np.ndarray, threshold: int = 8, window: int = 8) -> list:
+    """
+    returns the indexes of the keyframes of a chronological sequence of hashes.
+    A frame is a keyframe when it differs by more than 'threshold' bits from every one of the last 'window' keyframes,
+    so a screen flipping between two states (A-B-A-B) only gives 2 keyframes. The first frame is always a keyframe.\n
+    The distances are computed for blocks of frames at a time: a static stretch is skipped in a few NumPy calls
+    and the block shrinks after each keyframe so a busy stretch does not recompute much.
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    if len(hashes) == 0:
+        return []
+    keep = [0]
+    keys = [hashes[0]]
+    pos = 1
+    block = 16
+    while pos < len(hashes):
+        chunk = hashes[pos:pos + block]
+        distances = hamming_matrix(chunk, np.array(keys[-window:], dtype=np.uint64)).min(axis=1)
+        different = np.flatnonzero(distances > threshold)
+        if len(different) == 0: #nothing new in this block, looks further next time
+            pos += len(chunk)
+            block = min(block * 2, 4096)
+            continue
+        index = pos + int(different[0])
+        keep.append(index)
+        keys.append(hashes[index])
+        pos = index + 1
+        block = 16
+    return keep
+
+class HashIndex:
+    """
+    Hashes of the images of a folder, saved in '{path}' (.npz) so the next run only hashes the new files.\n
+    exemple_ | index = HashIndex("./memory/images/hash_index.npz") | index.add(name,time,hash) | index.save() | names, times, hashes = index.ordered()
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._names = []
+        self._times = []
+        self._hashes = []
+        self._positions = {} #name -> position in the lists
+        self._dirty = False
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                self._names = data["names"].tolist()
+                self._times = data["times"].tolist()
+                self._hashes = data["hashes"].tolist()
+        except (FileNotFoundError, OSError, KeyError, ValueError): #missing or unreadable index, it is rebuilt
+            pass
+        self._positions = {name: i for i, name in enumerate(self._names)}
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._positions
+
+    def add(self, name: str, time: float, hash: int) -> None:
+        if name in self._positions:
+            i = self._positions[name]
+            self._times[i] = time
+            self._hashes[i] = hash
+        else:
+            self._positions[name] = len(self._names)
+            self._names.append(name)
+            self._times.append(time)
+            self._hashes.append(hash)
+        self._dirty = True
+
+    def prune(self, existing: set) -> None:
+        """forgets the files that are not in 'existing' anymore"""
+        if all(name in existing for name in self._names):
+            return
+        rows = [(n, t, h) for n, t, h in zip(self._names, self._times, self._hashes) if n in existing]
+        self._names = [row[0] for row in rows]
+        self._times = [row[1] for row in rows]
+        self._hashes = [row[2] for row in rows]
+        self._positions = {name: i for i, name in enumerate(self._names)}
+        self._dirty = True
+
+    def ordered(self) -> tuple:
+        """returns (names, times, hashes) sorted by capture time, times and hashes as NumPy arrays"""
+        times = np.array(self._times, dtype=np.float64)
+        hashes = np.array(self._hashes, dtype=np.uint64)
+        order = np.argsort(times, kind="stable")
+        return [self._names[i] for i in order], times[order], hashes[order]
+
+    def save(self) -> None:
+        if not self._dirty:
+            return
+        temp = f"{self.path}.tmp.npz"
+        np.savez(temp, names=np.array(self._names, dtype=np.str_), times=np.array(self._times, dtype=np.float64),
+                 hashes=np.array(self._hashes, dtype=np.uint64))
+        os.replace(temp, self.path)
+        self._dirty = False
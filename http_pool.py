@@ -0,0 +1,333 @@
+"""
+One keep-alive connection pool shared by every openAI client of the process (chat, tts, vision, summaries),
+per operation timeouts and retries, and hedged tts requests.
+- All the clients of an api key use the same 'openai.DefaultHttpxClient', so the TLS connections are opened once and reused by every call.
+- 'for_operation()' returns the client with the timeout and retries of an operation ('client.with_options()' shares the pool).
+  Retries use the exponential backoff of the openAI client (0.5s doubling up to 8s, with jitter, 'Retry-After' honored).
+- A hedged request is sent a second time when the first one is slower than usual (p95 of the recent ones), the first answer wins.
+  Only used for the tts of short sentences where a duplicate costs little and a slow answer blocks the whole voice turn.
+- Every request waits for room in the rate limits of its model before it is sent ('rate_limits.py'), the operations of 'PRIORITIES'
+  marked "background" (summaries, vision) give way to the interactive ones (chat, tts).
+Classes:
+    - Network:
+        Timeouts, retries and hedging of the clients of one character (the "network" settings of its .json).
+    - Hedge:
+        Delay before the duplicate request, learned from the latencies of the operation.
+Functions:
+    - configure(settings_file: str = "settings.json") -> Network:
+        Reads the optional "network" settings: applies the rate limits (shared by the process) and returns the options of the character.
+    - get_client(api_key: str, base_url: str = None, network: Network = None) -> openai.OpenAI
+    - get_async_client(api_key: str, base_url: str = None, network: Network = None) -> openai.AsyncOpenAI:
+        The shared clients, one async pool per event loop (an async pool can not be used from another loop).
+        The clients of an api key share their connection pool whatever their 'network'.
+    - for_operation(client, operation: str):
+        'client' with the timeout and retries of 'operation' ("chat", "tts", "vision", "summary", "check") in its 'network'.
+    - hedge_chars(client) -> int:
+        Longest tts text hedged with 'client', 0 when its tts is never hedged.
+    - hedged(func, hedge: Hedge = None) / ahedged(func, hedge: Hedge = None):
+        Calls 'func()' (a coroutine function for 'ahedged'), calls it a second time if it is slower than 'hedge.delay()' and returns the first result.
+"""
+
+import json
+import time
+import asyncio
+import threading
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import openai
+import tracing
+import rate_limits
+
+#imports---------------------------------------------------------------
+
+#operation -> [timeout (seconds without an answer or between two chunks of a stream), retries], defaults of every 'Network'
+OPERATIONS = {
+    "chat": [60.0, 2],
+    "tts": [20.0, 2],
+    "vision": [120.0, 2],
+    "summary": [60.0, 3], #background work, can wait longer
+    "check": [15.0, 1], #api key check at startup
+}
+#operation -> class of its requests in the rate limits, the background ones wait for the interactive ones
+PRIORITIES = {
+    "chat": "interactive",
+    "tts": "interactive",
+    "check": "interactive",
+    "vision": "background", #screen summaries
+    "summary": "background", #memory and screen log summaries
+}
+PRIORITY_HEADER = "x-ai-gf-priority" #set by 'for_operation()', removed before the request is sent
+CONNECT_TIMEOUT = 5.0
+HEDGE_CHARS = 200 #tts of texts up to this length are hedged, 0 disables the hedging (default of every 'Network')
+
+_lock = threading.Lock()
+_http = {} #(api_key, base_url) -> openai.DefaultHttpxClient
+_clients = {} #(api_key, base_url, network) -> openai.OpenAI
+_async_http = weakref.WeakKeyDictionary() #event loop -> {(api_key, base_url): openai.DefaultAsyncHttpxClient}
+_async_clients = weakref.WeakKeyDictionary() #event loop -> {(api_key, base_url, network): openai.AsyncOpenAI}
+_networks = weakref.WeakKeyDictionary() #client -> its Network
+_derived = weakref.WeakKeyDictionary() #client -> {operation: client.with_options(...)}
+
+class Network:
+    """
+    Timeouts, retries and hedging of the clients of one character, read from the "network" section of its .json by 'configure()'.
+    Kept by the clients made with it, so two characters with different settings never change each other's options.
+    Equal options are the same client (and all the clients of an api key share one connection pool).\n
+    exemple_ | network = http_pool.configure("settings/teto.json") | client = http_pool.get_client(api_key, network=network)
+    """
+    def __init__(self, operations: dict = None, hedge_chars: int = HEDGE_CHARS):
+        operations = operations or {}
+        #operation -> (timeout, retries)
+        self.operations = {operation: tuple(operations.get(operation, values)) for operation, values in OPERATIONS.items()}
+        self.hedge_chars = hedge_chars
+
+    def key(self) -> tuple:
+        return tuple(sorted(self.operations.items())), self.hedge_chars
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Network) and self.key() == other.key()
+
+    def __hash__(self) -> int:
+        return hash(self.key())
+
+    def timeout(self, operation: str) -> openai.Timeout:
+        return openai.Timeout(self.operations[operation][0], connect=CONNECT_TIMEOUT)
+
+    def retries(self, operation: str) -> int:
+        return self.operations[operation][1]
+
+DEFAULT_NETWORK = Network()
+
+def configure(settings_file: str = "settings.json") -> Network:
+    """_summary_
+    reads the optional "network" section of the .json and returns the options of the clients of this character:
+    "chat_timeout", "tts_timeout", "vision_timeout", "summary_timeout" (seconds), "retries" (all the operations), "hedge_tts_chars" (0 disables the hedged tts).
+    Also applies "rate_limits" ({model: {"rpm", "tpm"}} known before the first answer), "background_reserve" (share of the limits kept for the interactive requests)
+    and "rate_limit" (false sends every request right away) to the rate limiter of the process, the limits are the ones of the account.
+    """
+    with open(settings_file, "r") as f:
+        network = json.load(f).get("network", {})
+    operations = {}
+    for operation, (timeout, retries) in OPERATIONS.items():
+        if "retries" in network and operation != "check":
+            retries = int(network["retries"])
+        operations[operation] = (float(network.get(f"{operation}_timeout", timeout)), retries)
+    rate_limits.get_limiter().configure(network.get("rate_limits"), network.get("background_reserve"), network.get("rate_limit"))
+    return Network(operations, int(network.get("hedge_tts_chars", HEDGE_CHARS)))
+
+def network_of(client) -> Network:
+    """the Network of a client made by 'get_client()' / 'get_async_client()', the defaults for any other client"""
+    return _networks.get(client, DEFAULT_NETWORK)
+
+def hedge_chars(client) -> int:
+    """tts of texts up to this length are hedged with 'client', 0 when they never are"""
+    return network_of(client).hedge_chars
+
+#----------------------------------clients-------------------------------------------
+
+def _cost(request) -> tuple:
+    """(model, estimated tokens, priority) of a request, model None when it is not a json request to a model"""
+    priority = request.headers.pop(PRIORITY_HEADER, "interactive")
+    if request.method != "POST":
+        return None, 0, priority
+    try:
+        body = json.loads(request.content)
+    except Exception: #streamed or not json
+        return None, 0, priority
+    if not isinstance(body, dict) or not isinstance(body.get("model"), str):
+        return None, 0, priority
+    return body["model"], rate_limits.estimate_tokens(body), priority
+
+def _before(request) -> None:
+    """request hook of the sync pools: waits for room in the rate limits"""
+    model, tokens, priority = _cost(request)
+    request.extensions["rate_limit_model"] = model
+    rate_limits.get_limiter().acquire(model, tokens, priority)
+
+async def _abefore(request) -> None:
+    model, tokens, priority = _cost(request)
+    request.extensions["rate_limit_model"] = model
+    await rate_limits.get_limiter().aacquire(model, tokens, priority)
+
+def _after(response) -> None:
+    """response hook: the rate limit headers correct the buckets of the model"""
+    rate_limits.get_limiter().observe(response.request.extensions.get("rate_limit_model"), response.status_code, response.headers)
+
+async def _aafter(response) -> None:
+    _after(response)
+
+def get_client(api_key: str, base_url: str = None, network: Network = None) -> openai.OpenAI:
+    """the openai.OpenAI client of 'api_key' with the options of 'network' (defaults when None), all of them share one connection pool"""
+    network = DEFAULT_NETWORK if network is None else network
+    key = (api_key, base_url, network)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            http = _http.get((api_key, base_url))
+            if http is None:
+                http = _http[(api_key, base_url)] = openai.DefaultHttpxClient(event_hooks={"request": [_before], "response": [_after]})
+            options = {} if base_url is None else {"base_url": base_url}
+            client = _clients[key] = openai.OpenAI(api_key=api_key, http_client=http, timeout=network.timeout("chat"), max_retries=network.retries("chat"), **options)
+            _networks[client] = network
+        return client
+
+def get_async_client(api_key: str, base_url: str = None, network: Network = None) -> openai.AsyncOpenAI:
+    """the openai.AsyncOpenAI client of 'api_key' and 'network' for the running event loop, shared by every model of this loop"""
+    network = DEFAULT_NETWORK if network is None else network
+    loop = asyncio.get_running_loop()
+    key = (api_key, base_url, network)
+    with _lock:
+        clients = _async_clients.get(loop)
+        if clients is None:
+            clients = _async_clients[loop] = {}
+            _async_http[loop] = {}
+        client = clients.get(key)
+        if client is None:
+            options = {} if base_url is None else {"base_url": base_url}
+            pools = _async_http[loop]
+            http = pools.get((api_key, base_url))
+            if http is None:
+                http = pools[(api_key, base_url)] = openai.DefaultAsyncHttpxClient(event_hooks={"request": [_abefore], "response": [_aafter]})
+            client = clients[key] = openai.AsyncOpenAI(api_key=api_key, http_client=http,
+                                                       timeout=network.timeout("chat"), max_retries=network.retries("chat"), **options)
+            _networks[client] = network
+        return client
+
+def for_operation(client, operation: str):
+    """
+    'client' with the timeout and retries of 'operation' in the Network of the client and the rate limit class of 'operation',
+    made once per client (they share its connection pool).\n
+    exemple_ | http_pool.for_operation(client, "tts").audio.speech.create(...)
+    """
+    with _lock:
+        clients = _derived.get(client)
+        if clients is None:
+            clients = _derived[client] = {}
+        derived = clients.get(operation)
+        if derived is None:
+            network = _networks.get(client, DEFAULT_NETWORK)
+            derived = clients[operation] = client.with_options(timeout=network.timeout(operation), max_retries=network.retries(operation),
+                                                               default_headers={PRIORITY_HEADER: PRIORITIES[operation]})
+        return derived
+
+#----------------------------------hedged requests-----------------------------------
+
+class Hedge:
+    """
+    Delay before the duplicate of a hedged request: the 'quantile' of the last 'window' latencies, so only the slowest ~5% of the requests are sent twice,
+    but at most 'median_ratio' times the median (when more than 5% of the answers are slow the quantile is one of them) and bounded by 'min_delay' and 'max_delay'.
+    'default' is used until 'min_samples' latencies are known.
+    The sync 'hedged()' calls of a Hedge run in its own pool of up to 'max_workers' threads (two per slow call), so concurrent calls do not queue
+    behind each other; the latencies are measured from the start of the call in the pool, the time waiting for a thread is not counted.\n
+    exemple_ | TTS_HEDGE = Hedge() | audio = hedged(lambda: request(text), TTS_HEDGE)
+    """
+    def __init__(self, quantile: float = 0.95, median_ratio: float = 3.0, min_delay: float = 0.3, max_delay: float = 3.0, default: float = 1.0,
+                 window: int = 200, min_samples: int = 20, max_workers: int = 64):
+        self.quantile = quantile
+        self.median_ratio = median_ratio
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.default = default
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window)
+        self._delay = default
+        self.max_workers = max_workers
+        self._executor = None
+
+    def delay(self) -> float:
+        return self._delay
+
+    def executor(self) -> ThreadPoolExecutor:
+        """pool of the sync hedged calls, made on first use (its threads are only started when needed)"""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="hedge")
+            return self._executor
+
+    def observe(self, seconds: float, censored: bool = False) -> None:
+        """
+        adds the latency of a first request (not of the duplicates, they would hide the slow ones).
+        'censored': the first request was cancelled after 'seconds' without an answer because its duplicate won,
+        its latency is only known to be longer and counts as a slow one ('max_delay' at least).
+        """
+        if censored:
+            seconds = max(seconds, self.max_delay)
+        with self._lock:
+            self._latencies.append(seconds)
+            if len(self._latencies) < self.min_samples:
+                return
+            latencies = np.array(self._latencies, dtype=np.float64)
+        median, tail = np.quantile(latencies, [0.5, self.quantile])
+        self._delay = min(max(min(float(tail), self.median_ratio * float(median)), self.min_delay), self.max_delay)
+
+def hedged(func, hedge: Hedge = None):
+    """
+    returns 'func()', calling it a second time in parallel when the first call takes longer than 'hedge.delay()'.
+    The slower call is left to finish in the background and its result is dropped. An error is only raised if both calls fail.
+    """
+    if hedge is None:
+        return func()
+    start = time.perf_counter()
+    began = [start]
+    def first_call():
+        began[0] = time.perf_counter() #not counting the wait for a thread of the pool
+        return func()
+    def observe(future):
+        if future.exception() is None:
+            hedge.observe(time.perf_counter() - began[0])
+
+    executor = hedge.executor()
+    first = executor.submit(tracing.run_in_turn(first_call))
+    first.add_done_callback(observe) #the whole latency of the first call, even when the duplicate wins
+    done, _ = wait([first], timeout=hedge.delay())
+    if done:
+        return first.result()
+
+    tracing.record("hedge", 0.0, waited_ms=round((time.perf_counter() - start) * 1000, 3))
+    pending = {first, executor.submit(tracing.run_in_turn(func))}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            error = error or future.exception()
+    raise error
+
+async def ahedged(func, hedge: Hedge = None):
+    """
+    same as 'hedged()' for a coroutine function, the slower request is cancelled.
+    Only the latency of the first request is observed: when the duplicate wins the first one counts as censored (slower than its wait).
+    """
+    if hedge is None:
+        return await func()
+    start = time.perf_counter()
+    def observe(task):
+        if not task.cancelled() and task.exception() is None:
+            hedge.observe(time.perf_counter() - start)
+
+    first = asyncio.ensure_future(func())
+    first.add_done_callback(observe)
+    pending = {first}
+    try:
+        done, pending = await asyncio.wait(pending, timeout=hedge.delay())
+        if not done:
+            tracing.record("hedge", 0.0, waited_ms=round((time.perf_counter() - start) * 1000, 3))
+            pending.add(asyncio.ensure_future(func()))
+        error = None
+        while True:
+            for task in done:
+                if task.exception() is None:
+                    if task is not first and not first.done(): #the duplicate won, the first one is cancelled below
+                        hedge.observe(time.perf_counter() - start, censored=True)
+                    return task.result()
+                error = error or task.exception()
+            if not pending:
+                raise error
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in pending:
+            task.cancel()
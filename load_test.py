@@ -0,0 +1,248 @@
+"""
+Multi-user load test of the chat and voice turns: how many conversations at the same time one machine sustains before the latency collapses.
+Every simulated user is an 'AsyncModel' session (its own memory, like the sessions of 'server.py') that sends the messages of a script
+one after the other, with a think time between them. The openAI api is 'fake_openai.FakeOpenAI' (configurable latencies and their jitter)
+and rvc is the cpu stub of 'benchmark.py' or, with '--rvc real', the real rvc conversion of the character on the cpu ('--rvc-workers' processes).
+The number of users goes up step by step and every step reports:
+    - throughput: turns finished per second (sum of the turns per second of every user)
+    - time to first token and time to first audio (voice mode): p50 / p99
+    - errors and the cpu used by this process
+The saturation point is the last step that kept its p99 time to first audio (first token in chat mode) under '--slo' seconds
+while still turning at least '--min-efficiency' of its added users into throughput. The steps stop after the first saturated one unless '--all'.
+Everything runs in a temporary folder so the real './memory' is never touched.
+Usage:
+    python load_test.py [--users 1,2,4,8,16,32] [--turns 5] [--mode voice|chat] [--rvc stub|real] [--settings ./settings/teto.json]
+                        [--script lines.txt] [--jitter 0.3] [--slo 2.0] [--out file.json]
+"""
+
+import os
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import benchmark
+
+#imports---------------------------------------------------------------
+
+SCRIPT = [
+    "hi, how are you today?",
+    "I just got back from work, it was a long day.",
+    "what do you want to do this weekend?",
+    "tell me something that made you smile recently.",
+    "I am thinking about learning to cook, any idea where to start?",
+    "do you remember what we talked about yesterday?",
+    "good night, talk to you tomorrow!",
+]
+
+async def _user(model, index: int, args, results: dict) -> None:
+    """one simulated user: 'args.turns' messages of the script with a think time between them"""
+    rng = random.Random(args.seed + index)
+    await asyncio.sleep(rng.uniform(0, args.think)) #the users do not all start on the same millisecond
+    started = time.perf_counter()
+    done = 0
+    for turn in range(args.turns):
+        message = args.script[(index + turn) % len(args.script)]
+        start = time.perf_counter()
+        first_token = first_audio = None
+        try:
+            if args.mode == "voice":
+                async for event in model.stream_chat_voice(message):
+                    if event["type"] == "text" and first_token is None:
+                        first_token = time.perf_counter() - start
+                    elif event["type"] == "audio" and first_audio is None:
+                        first_audio = time.perf_counter() - start
+            else:
+                async for _ in model.stream_chat(message):
+                    if first_token is None:
+                        first_token = time.perf_counter() - start
+        except Exception as e:
+            results["errors"] += 1
+            print(f"[WARN] user {index} turn {turn}: {e}")
+            continue
+        results["turns"].append(time.perf_counter() - start)
+        done += 1
+        if first_token is not None:
+            results["first_token"].append(first_token)
+        if first_audio is not None:
+            results["first_audio"].append(first_audio)
+        await asyncio.sleep(args.think * rng.uniform(0.5, 1.5))
+    results["rates"].append(done / (time.perf_counter() - started)) #turns per second of this user, a late user does not stretch the others
+
+async def run_step(settings: str, users: int, args) -> dict:
+    """runs 'users' users at the same time and returns the throughput and latencies of the step"""
+    from model import AsyncModel
+    models = await asyncio.gather(*[AsyncModel.create(settings, session=f"load{users}_{i}") for i in range(users)])
+    for model in models:
+        model.audio_cache = None #the script repeats itself, cached lines would skip the tts and rvc
+        if args.rvc == "real":
+            await model.load_model(warmup=False) #loaded once by the first model, instant for the others
+        else:
+            model.convert = benchmark.stub_rvc
+
+    results = {"turns": [], "first_token": [], "first_audio": [], "rates": [], "errors": 0}
+    cpu = time.process_time()
+    start = time.perf_counter()
+    await asyncio.gather(*[_user(model, i, args, results) for i, model in enumerate(models)])
+    seconds = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    for model in models:
+        await model.delete_memory()
+
+    step = {
+        "users": users,
+        "seconds": seconds,
+        "turns": len(results["turns"]),
+        "errors": results["errors"],
+        "throughput_turns_per_s": sum(results["rates"]),
+        "cpu_percent": 100 * cpu / seconds,
+        "turn": benchmark.stats(results["turns"]) if results["turns"] else None,
+        "time_to_first_token": benchmark.stats(results["first_token"]) if results["first_token"] else None,
+    }
+    if args.mode == "voice":
+        step["time_to_first_audio"] = benchmark.stats(results["first_audio"]) if results["first_audio"] else None
+    return step
+
+def saturation(steps: list, slo: float, min_efficiency: float = 0.5, metric: str = "time_to_first_audio") -> dict:
+    """
+    returns {"users": last step before saturation (None if even the first one is saturated), "reason": why the next one is saturated (None if none is)}.
+    A step is saturated when its p99 'metric' is over 'slo' seconds, when it has errors, or when less than 'min_efficiency' of the users it added
+    over the previous step turned into throughput (0.5: doubling the users gave less than 1.5x the turns per second).
+    """
+    best = None
+    previous = None
+    for step in steps:
+        latency = step.get(metric)
+        if latency is None or latency["p99_ms"] > slo * 1000:
+            return {"users": best, "reason": f"p99 {metric} over {slo}s with {step['users']} users"}
+        if step["errors"] > 0:
+            return {"users": best, "reason": f"{step['errors']} failed turns with {step['users']} users"}
+        if previous is not None and step["users"] > previous["users"]:
+            gain = step["throughput_turns_per_s"] / previous["throughput_turns_per_s"] - 1
+            efficiency = gain / (step["users"] / previous["users"] - 1)
+            if efficiency < min_efficiency:
+                return {"users": best, "reason": f"throughput only {100 * efficiency:.0f}% efficient from {previous['users']} to {step['users']} users"}
+        best = step["users"]
+        previous = step
+    return {"users": best, "reason": None}
+
+def _print_step(step: dict) -> None:
+    def p(name: str) -> str:
+        stats = step.get(name)
+        return "-" if stats is None else f"{stats['p50_ms']:.0f}/{stats['p99_ms']:.0f}ms"
+    audio = f" | first audio p50/p99 {p('time_to_first_audio')}" if "time_to_first_audio" in step else ""
+    print(f"[INFO] {step['users']:>4} users | {step['throughput_turns_per_s']:.2f} turns/s | first token p50/p99 {p('time_to_first_token')}{audio}"
+          f" | {step['errors']} errors | cpu {step['cpu_percent']:.0f}%", flush=True)
+
+def _settings(path: str, args) -> str:
+    """copy of the character settings for the fake api: fake key and, for the real rvc, the cpu workers"""
+    with open(path, "r") as f:
+        settings = json.load(f)
+    settings["user"]["openAI_apiKey"] = "fake"
+    if args.rvc == "real":
+        settings["model_settings"]["rvc_workers"] = args.rvc_workers
+        settings["model_settings"]["rvc_device"] = "cpu"
+    os.makedirs("./settings", exist_ok=True)
+    copy = os.path.join("./settings", os.path.basename(path))
+    with open(copy, "w") as f:
+        json.dump(settings, f, indent=4)
+    return copy
+
+async def _run_steps(settings: str, args) -> list:
+    steps = []
+    metric = "time_to_first_audio" if args.mode == "voice" else "time_to_first_token"
+    for users in args.users:
+        step = await run_step(settings, users, args)
+        _print_step(step)
+        steps.append(step)
+        if not args.all and saturation(steps, args.slo, args.min_efficiency, metric)["reason"] is not None:
+            break
+    return steps
+
+def run(args) -> dict:
+    import rvc_converter
+    from fake_openai import FakeOpenAI
+    from model import AsyncModel
+
+    timings = {"first_token_delay": args.first_token_delay, "token_interval": args.token_interval, "reply_tokens": args.reply_tokens,
+               "tts_delay": args.tts_delay, "jitter": args.jitter, "rpm": args.rpm, "tpm": args.tpm, "seed": args.seed}
+    metric = "time_to_first_audio" if args.mode == "voice" else "time_to_first_token"
+    report = {
+        "commit": benchmark._commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": f"{platform.system()} {platform.machine()} ({os.cpu_count()} cpus)",
+        "config": {**timings, "mode": args.mode, "rvc": args.rvc, "turns": args.turns, "think": args.think, "slo": args.slo,
+                   "min_efficiency": args.min_efficiency, "settings": os.path.basename(args.settings)},
+    }
+    settings_path = os.path.abspath(args.settings)
+    home = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="load_")
+    os.chdir(workdir) #'./memory' of the simulated users
+    try:
+        for folder in ("model", "models"): #the rvc models of the real conversion
+            if os.path.isdir(os.path.join(home, folder)):
+                os.symlink(os.path.join(home, folder), folder)
+        settings = _settings(settings_path, args)
+        if args.rvc_workers > 0: #like 'server.py --rvc-workers', the stub runs 'rvc_workers' conversions at the same time
+            if args.rvc == "real":
+                rvc_converter.start_service(args.rvc_workers, "cpu")
+            AsyncModel.configure_rvc(args.rvc_workers) #one waiting thread per worker
+        with FakeOpenAI(**timings) as fake:
+            os.environ["OPENAI_BASE_URL"] = fake.base_url #every client of 'http_pool' goes to the fake api
+            report["steps"] = asyncio.run(_run_steps(settings, args))
+            report["requests"] = fake.requests
+            report["rate_limited"] = fake.rate_limited
+    finally:
+        rvc_converter.stop_service()
+        os.chdir(home)
+        shutil.rmtree(workdir, ignore_errors=True)
+    report["saturation"] = saturation(report["steps"], args.slo, args.min_efficiency, metric)
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="multi-user load test of the chat and voice turns (fake openAI server)")
+    parser.add_argument("--users", default="1,2,4,8,16,32", help="comma separated numbers of users at the same time, one step each")
+    parser.add_argument("--turns", type=int, default=5, help="messages sent by every user in a step")
+    parser.add_argument("--think", type=float, default=0.5, help="seconds between two messages of a user (0.5x to 1.5x)")
+    parser.add_argument("--mode", choices=["voice", "chat"], default="voice")
+    parser.add_argument("--rvc", choices=["stub", "real"], default="stub", help="stub: 'benchmark.stub_rvc', real: the rvc model of the settings on the cpu")
+    parser.add_argument("--rvc-workers", type=int, default=1, help="rvc worker processes (conversions at the same time with the stub), 0 converts in this process one at a time")
+    parser.add_argument("--settings", default="./settings/teto.json")
+    parser.add_argument("--script", default=None, help=".txt with one message per line, defaults to a short built-in conversation")
+    parser.add_argument("--first-token-delay", type=float, default=0.3)
+    parser.add_argument("--token-interval", type=float, default=0.02)
+    parser.add_argument("--reply-tokens", type=int, default=60)
+    parser.add_argument("--tts-delay", type=float, default=0.15)
+    parser.add_argument("--jitter", type=float, default=0.3, help="spread of every delay of the fake api, 0.3: between 70%% and 130%% of it")
+    parser.add_argument("--rpm", type=int, default=0, help="requests per minute of the fake api, 0: no limit")
+    parser.add_argument("--tpm", type=int, default=0, help="tokens per minute of the fake api, 0: no limit")
+    parser.add_argument("--slo", type=float, default=2.0, help="p99 time to first audio (first token in chat mode) in seconds")
+    parser.add_argument("--min-efficiency", type=float, default=0.5, help="share of the added users that must turn into throughput")
+    parser.add_argument("--all", action="store_true", help="runs every step, even after the saturation")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None, help="defaults to ./benchmarks/load_{commit}.json")
+    args = parser.parse_args()
+
+    args.users = sorted(int(users) for users in args.users.split(",") if users.strip())
+    if args.script is None:
+        args.script = SCRIPT
+    else:
+        with open(args.script, "r", encoding="utf-8") as f:
+            args.script = [line.strip() for line in f if line.strip() != ""]
+        assert args.script, "empty script"
+    report = run(args)
+    out = args.out if args.out is not None else f"./benchmarks/load_{report['commit']}.json"
+    if os.path.dirname(out) != "":
+        os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+    result = report["saturation"]
+    if result["reason"] is None:
+        print(f"[INFO] no saturation up to {report['steps'][-1]['users']} users")
+    else:
+        print(f"[INFO] saturation point: {result['users']} users ({result['reason']})")
+    print(f"[INFO] results written to {out}")
@@ -1,29 +1,226 @@
 import os
+import re
 import json
 import shutil
+import threading
+import time
+import atexit
+from array import array
 
-def get_memory(type :str = "chatlogs",name : str = None) -> str:
-    assert name != None or name != "", "missing model name"
-    
-    if type == "chatlogs":
+class MemoryStore:
+    """
+    Append-only memory file with an in-process cache and a side index of the byte offset of every turn.\n
+    Each call to 'append()' is one turn. The text goes to '{file}.txt' and the byte offset where the turn starts
+    goes to '{file}.idx' as a little-endian uint64, so turn 'i' is found with a single seek to 'i*8' in the index
+    and a single seek in the text file. Nothing is ever rewritten.\n
+    Writes are flushed on every append but only fsynced every 'fsync_every' appends, at most 'fsync_interval' seconds after an append
+    (a timer syncs the last appends of a quiet chat) and on close.\n
+    exemple_ | store = MemoryStore("./memory/teto.txt") | store.append("[USER] hi\\n") | store.tail(10)
+    """
+    def __init__(self, path: str, fsync_every: int = 8, fsync_interval: float = 2.0):
+        self.path = path
+        self.index_path = os.path.splitext(path)[0] + ".idx"
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
 
+        self._lock = threading.RLock()
+        self._parts = None #cached turns, loaded on the first full read
+        self._joined = None #cached result of the full read
+        self._pending = 0 #appends since the last fsync
+        self._last_sync = time.monotonic()
+        self._timer = None #pending 'sync()' of the last appends
+
+        directory = os.path.dirname(path)
+        if directory != "":
+            os.makedirs(directory, exist_ok=True)
+        if not os.path.exists(path):
+            print(f"{path} does not exists, creating file")
+
+        self._file = open(path, "ab")
+        self._size = self._file.seek(0, os.SEEK_END)
+        self._offsets = self._load_index()
+        self._index_file = open(self.index_path, "ab")
+
+    def _load_index(self) -> array:
+        """
+        reads the offsets from the index file and rebuilds it if it does not match the text file
+        (missing index, crash between the two writes or a file written by an older version)
+        """
+        offsets = array("Q")
         try:
-            with open(f"./memory/{name}.txt", "r", encoding="utf-8") as memory: #returns the text in memory if it exists
-                return memory.read()
+            with open(self.index_path, "rb") as f:
+                data = f.read()
+            offsets.frombytes(data[:len(data) - len(data) % offsets.itemsize])
         except FileNotFoundError:
-            with open(f"./memory/{name}.txt", "w", encoding="utf-8") as memory: #checks if the model already has a memory if not creates it
-                memory.write("")
-            print(f"./memory/{name}.txt does not exists, creating file")
-            return ""
+            pass
+
+        valid = len(offsets)
+        while valid > 0 and offsets[valid - 1] >= self._size:
+            valid -= 1
+        if valid != len(offsets) or (valid == 0 and self._size > 0):
+            del offsets[valid:]
+            if len(offsets) == 0 and self._size > 0:
+                offsets.append(0) #legacy file without index: the whole text is one turn
+            with open(self.index_path, "wb") as f:
+                offsets.tofile(f)
+        return offsets
+
+    #----------------------------------writes-----------------------------------------
+
+    def append(self, text: str) -> int:
+        """
+        appends a turn to the memory and returns its number (-1 if the text is empty)
+        """
+        if text == "":
+            return -1
+        data = text.encode("utf-8")
+        with self._lock:
+            turn = len(self._offsets)
+            self._file.write(data)
+            self._file.flush()
+            self._index_file.write(self._size.to_bytes(8, "little"))
+            self._index_file.flush()
+            self._offsets.append(self._size)
+            self._size += len(data)
+
+            if self._parts is not None:
+                self._parts.append(text)
+                self._joined = None
+
+            self._pending += 1
+            if self._pending >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+                self.sync()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.fsync_interval, self.sync)
+                self._timer.daemon = True
+                self._timer.start()
+            return turn
+
+    def sync(self) -> None:
+        """forces the pending appends to disk"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel() #no-op when called by the timer itself
+                self._timer = None
+            if self._pending == 0 or self._file.closed:
+                return
+            os.fsync(self._file.fileno())
+            os.fsync(self._index_file.fileno())
+            self._pending = 0
+            self._last_sync = time.monotonic()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file.closed:
+                return
+            self.sync()
+            self._file.close()
+            self._index_file.close()
+
+    #----------------------------------reads------------------------------------------
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def _read_bytes(self, start: int, end: int) -> bytes:
+        if start >= end:
+            return b""
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            return f.read(end - start)
+
+    def _read_range(self, start: int, end: int) -> str:
+        return self._read_bytes(start, end).decode("utf-8")
+
+    def _turn_start(self, turn: int) -> int:
+        return self._offsets[turn] if turn < len(self._offsets) else self._size
+
+    def read(self) -> str:
+        """returns the whole memory, read from disk once and then served from the cache"""
+        with self._lock:
+            if self._joined is None:
+                if self._parts is None:
+                    self._parts = self.turns(0, len(self._offsets))
+                self._joined = "".join(self._parts)
+            return self._joined
+
+    def turn(self, turn: int) -> str:
+        """returns a single turn. negative numbers count from the end"""
+        with self._lock:
+            if turn < 0:
+                turn += len(self._offsets)
+            if turn < 0 or turn >= len(self._offsets):
+                raise IndexError(f"turn {turn} out of range")
+            return self._read_range(self._offsets[turn], self._turn_start(turn + 1))
+
+    def turns(self, start: int = 0, stop: int = None) -> list:
+        """returns the turns in [start, stop) as a list, reading only that part of the file"""
+        with self._lock:
+            count = len(self._offsets)
+            stop = count if stop is None else min(stop, count)
+            start = max(start, 0)
+            if start >= stop:
+                return []
+            if self._parts is not None and len(self._parts) == count:
+                return self._parts[start:stop]
+            #one read of the raw bytes, cut at the offsets of the index, every turn decoded once
+            block = memoryview(self._read_bytes(self._offsets[start], self._turn_start(stop)))
+            base = self._offsets[start]
+            bounds = [self._offsets[i] - base for i in range(start, stop)] + [len(block)]
+            return [str(block[bounds[i]:bounds[i + 1]], "utf-8") for i in range(len(bounds) - 1)]
+
+    def tail(self, n: int) -> str:
+        """returns the last 'n' turns as one string"""
+        with self._lock:
+            if n <= 0:
+                return ""
+            start = max(len(self._offsets) - n, 0)
+            return self._read_range(self._turn_start(start), self._size)
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def _memory_path(type: str, name: str) -> str:
+    if type == "chatlogs":
+        return f"./memory/{name}.txt"
     elif type == "screenlogs":
-        try:
-            with open(f"./memory/{name}Screen.txt", "r", encoding="utf-8") as memory: #returns the text in memory if it exists
-                return memory.read()
-        except FileNotFoundError:
-            with open(f"./memory/{name}Screen.txt", "w", encoding="utf-8") as memory: #checks if the model already has a memory if not creates it
-                memory.write("")
-            print(f"./memory/{name}Screen.txt does not exists, creating file")
-            return ""
+        return f"./memory/{name}Screen.txt"
+    assert False, f"unknown memory type: {type}"
+
+def get_store(type: str = "chatlogs", name: str = None) -> MemoryStore:
+    """
+    returns the shared MemoryStore of a memory file, opening it on first use
+    """
+    assert name != None and name != "", "missing model name"
+    path = _memory_path(type, name)
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = MemoryStore(path)
+            _stores[path] = store
+        return store
+
+def close_store(type: str = "chatlogs", name: str = None) -> None:
+    """closes a memory file and drops it from the cache"""
+    path = _memory_path(type, name)
+    with _stores_lock:
+        store = _stores.pop(path, None)
+    if store is not None:
+        store.close()
+
+@atexit.register
+def _close_all_stores():
+    with _stores_lock:
+        stores = list(_stores.values())
+        _stores.clear()
+    for store in stores:
+        store.close()
+
+def get_memory(type :str = "chatlogs",name : str = None) -> str:
+    assert name != None and name != "", "missing model name"
+    
+    if type == "chatlogs" or type == "screenlogs":
+        return get_store(type,name).read() #creates the memory file if it does not exists
         
 def add_memory(type : str = "chatlogs",name : str = None,text: str = "") -> None: 
     """
@@ -35,33 +232,57 @@ def add_memory(type : str = "chatlogs",name : str = None,text: str = "") -> None
     Raises:
         AssertionError: If 'name' is None or an empty string.
     Notes:
-        - The function retrieves the existing memory content using `get_memory`, then appends the new text.
-        - The memory file is stored in the "./memory/" directory with a ".txt" extension.
+        - The text is appended as a new turn of the file's MemoryStore, the old memory is never read nor rewritten.
+        - An empty text only makes sure the memory file exists.
+        - The memory file is stored in the "./memory/" directory with a ".txt" extension and its turn index with a ".idx" extension.
     """
     
-    assert name != None or name != "", "missing model name"
+    assert name != None and name != "", "missing model name"
             
-    if type == "chatlogs":
-        #checks if the file exists and write the text in it
-        old_memory = get_memory(type,name)
-        with open(f"./memory/{name}.txt", "w", encoding="utf-8") as memory:
-                memory.write(old_memory + text)
-        
-        
-    elif type == "screenlogs":
-        #checks if the file exists and write the text in it
-        old_memory = get_memory(type,name)
-        with open(f"./memory/{name}Screen.txt", "w", encoding="utf-8") as memory:
-                memory.write(old_memory + text)
+    if type == "chatlogs" or type == "screenlogs":
+        get_store(type,name).append(text)
         
     
     
 
-def euthanize_model(settings_file: str = "settings.json"):
+def session_name(name: str, session: str = None) -> str:
+    """
+    returns the memory name of a model for a session. Each session gets its own folder './memory/sessions/{session}/'
+    so two users talking to the same character never share (or delete) each other's memory. No session keeps './memory/{name}'.
+    """
+    if session is None:
+        return name
+    assert re.fullmatch(r"[A-Za-z0-9_-]{1,64}", session), f"invalid session id: {session}"
+    return f"sessions/{session}/{name}"
+
+def delete_memory(name: str) -> None:
+    """deletes the chat and screen memory files (and their index) and the screen log of a memory name"""
+    close_store("chatlogs",name)
+    close_store("screenlogs",name)
+    import screenlog #imported here, screenlog imports this module
+    screenlog.close_log(name)
+    try:
+        os.remove(f"./memory/{name}.txt")
+        print(f"File /memory/{name}.txt deleted successfully. she loved you.")
+    except:
+        pass
+    try:
+        os.remove(f"./memory/{name}Screen.txt")
+        print(f"File /memory/{name}Screen.txt deleted successfully.")
+    except:
+        pass
+    for index in (f"./memory/{name}.idx", f"./memory/{name}Screen.idx", f"./memory/{name}Screen.jsonl"):
+        try:
+            os.remove(index)
+        except:
+            pass
+
+def euthanize_model(settings_file: str = "settings.json", session: str = None):
     """_summary_
     deletes the memory of the model. she loved you :(
     Args:
         settings_file (str, optional): _description_. Defaults to "settings.json".
+        session (str, optional): _description_. Only deletes the memory of this session. Defaults to None.
     """
     try:
         with open(settings_file, "r") as f:
@@ -73,17 +294,7 @@ def euthanize_model(settings_file: str = "settings.json"):
         settings = json.load(f)
         
     name = os.path.splitext(settings["model_files"]["name"])[0]
-    
-    try:
-        os.remove(f"./memory/{name}.txt")
-        print(f"File /memory/{name}.txt deleted successfully. she loved you.")
-    except:
-        pass
-    try:
-        os.remove(f"./memory/{name}Screen.txt")
-        print(f"File /memory/{name}Screen.txt deleted successfully.")
-    except:
-        pass
+    delete_memory(session_name(name, session))
 
 def clean_directory_cache(folder_path, keep_filename = ""):
     for filename in os.listdir(folder_path):
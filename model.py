@@ -1,43 +1,24 @@
 from rvc_converter import *
 import chatgpt
 import memory
-import screen
-import librosa
-import sounddevice
+import context
+import voice_pipeline
+import audio_cache
+import startup
+import tracing
+import http_pool
+import turn_runtime
+import numpy as np
+import openai
+import asyncio
 import threading
-from time import sleep
-import os
-import shutil
-import time
-import wave
-import random
-import struct
-
-class BackgroundTask:
-    """
-    Makes a function in an other thread\n
-    exemple_ | exemple = BackgroundTask(function,var1=var,var2=var,var3=var)
-    """
-    def __init__(self, func, *args, **kwargs):
-        self.func = func
-        self.args = args
-        self.kwargs = kwargs
-        self._thread = None
-
-    def _run(self):
-        self.func(*self.args, **self.kwargs)  # run on*ce
-
-    def start(self):
-        if self._thread is None or not self._thread.is_alive():
-            self._thread = threading.Thread(target=self._run, daemon=True)
-            self._thread.start()
-            print("Background task started")
+from concurrent.futures import ThreadPoolExecutor
 
 class Model:
 
     #-----------Initialisation-------------
 
-    def __init__(self,json_setting = "settings.json"):
+    def __init__(self,json_setting = "settings.json", session: str = None):
         #- self.client
         #- self.description
         #- self.voice_description
@@ -46,12 +27,26 @@ class Model:
         #- self.stream
         #- self.reasoning
         self.json_file = json_setting
+        self.session = session #separate memory for this session, see memory.session_name()
         self.model_loaded = False
+        self.voice = None #key of the rvc voice of the model in the registry
+        self.debug_audio = False #saves the tts and rvc audio of every sentence in ./audio_input and ./audio_output
+        self.audio_cache = audio_cache.get_cache() #None disables the cache
+        self.runtime = turn_runtime.get_runtime() #background work of the turns
+        self.turn_scope = None #scope of the last turn, cancelled by the next one
 
-        self.client,self.description,self.voice_description,self.text_model,self.name,self.stream,self.reasoning = chatgpt.get_openai_settings(json_setting)
+        with startup.timed("openai settings"):
+            self.client,self.description,self.voice_description,self.text_model,self.name,self.stream,self.reasoning = chatgpt.get_openai_settings(json_setting)
+
+        self.memory_name = memory.session_name(self.name,session)
+
+        with startup.timed("memory"):
+            memory.euthanize_model(json_setting,session)
+            memory.add_memory("chatlogs",self.memory_name) #makes an empty memory file
 
-        memory.euthanize_model(json_setting)
-        memory.add_memory("chatlogs",self.name) #makes an empty memory file
+            #token budgeted memory sent with each request
+            context_tokens,summary_tokens,summary_model,recall_turns,recall_tokens,chain_turns = context.get_context_settings(json_setting)
+            self.context = context.ContextWindow(self.client,self.memory_name,context_tokens,summary_tokens,summary_model,recall_turns,recall_tokens,chain_turns)
     
 
     #################################################################################
@@ -66,10 +61,12 @@ class Model:
         else:
             self.json_file = json_setting
 
-        self.client,self.description,self.text_model,self.name = chatgpt.get_openai_settings(json_setting)
+        self.client,self.description,self.voice_description,self.text_model,self.name,self.stream,self.reasoning = chatgpt.get_openai_settings(json_setting)
+        self.context.client = self.client #same shared connection pool, the memory summary uses the new key
 
     def delete_memory(self):
-        memory.euthanize_model(self.json_file)
+        memory.euthanize_model(self.json_file,self.session)
+        self.context.reset()
 
     def reset_audio_cache(self):
         memory.clean_directory_cache("./audio_input")
@@ -77,70 +74,25 @@ class Model:
 
 
     def load_model(self):
-        load_rvc_settings(self.json_file)
+        workers,device = get_service_settings(self.json_file)
+        if workers > 0: #rvc in worker processes, the chat and tts threads never wait for the GIL
+            start_service(workers,device)
+        self.voice = load_rvc_settings(self.json_file)
         
-        with wave.open("./audio_input/model_loader.wav","wb") as f:
-            f.setnchannels(1)         # mono
-            f.setsampwidth(2)         # 16-bit
-            f.setframerate(44100)
-
-            # Generate gibberish: random 16-bit signed samples
-            frames = b"".join(
-                struct.pack("<h", random.randint(-32768, 32767))
-                for _ in range(44100)
-            )
-
-            f.writeframes(frames)
-
-        convertToAI("./audio_input/model_loader.wav","./audio_output/model_loader.wav")
-        #self.reset_audio_cache()
+        # Converts 1s of gibberish (random samples) so the first real sentence does not pay for the model warm up
+        # (the worker processes already did it in 'load_rvc_settings()')
+        if workers <= 0:
+            noise = np.random.uniform(-1, 1, 44100).astype(np.float32)
+            convertToAI_array(noise, 44100, self.voice)
         
         self.model_loaded = True
 
     def unload_model(self):
-        unload_rvc_settings()
+        if self.voice is not None:
+            unload_rvc_settings(self.voice)
+            self.voice = None
         self.model_loaded = False
 
-    def run_stream_audio_chat(self):
-        """
-        [DEPRECATED]
-        """
-        def play_audios(name,nb):
-            for i in range(nb):
-                filename = f"./audio_output/{name}{i}.wav"
-                
-                it = 0
-                while not os.path.exists(filename):
-                    time.sleep(0.5)  # sleep to avoid busy-waiting
-                    it += 1
-                    if it == 360:  # wait about 3min before break to avoid infinite loop
-                        break
-                if it == 240:
-                    print(f"File: '{filename}' does not exists for more than 3min. Stopping sound playing loop")
-                    break
-
-                audio, sr = librosa.load(filename, sr=None)
-                print(f"-------- Playing {filename} ------------")
-                sounddevice.play(audio, sr)
-                sounddevice.wait()
-
-        self.load_model()
-        print("##############################\n########-Chat started-########\n##############################\n")
-        print("[INFO] type ':q' to quit")
-        while True:
-            user = input("You: ")
-            if user == ':q':
-                self.unload_model
-                print("[INFO] exiting chat")
-                break
-            self.reset_audio_cache()
-            
-            text,nb = chatgpt.stream_chat_voice(self.client,self.description,self.text_model,user,self.name)
-            play_audios(self.name,nb)
-            print("---------------ALL DONE--------------")
-            memory.add_memory("chatlogs",self.name,"\n[user]:"+user+"\n[You]:"+text)
-
-
     ##########################################################################################
     ################################## CHAT FUNCTIONS ########################################
     ##########################################################################################
@@ -154,69 +106,270 @@ class Model:
             if user == ':q':
                 print("[INFO] exiting chat")
                 break
-            print(f"{self.name} : ",end="")
-            if self.stream == True:
-                temp_str = ""
-                response = chatgpt.chat(self.client,self.description,self.text_model,user,self.name,streaming = self.stream,additional_instructions=additional_instruction,reason=self.reasoning)
-                while True:
-                    try:
-                        temp = next(response)
-                        print(temp,end="")
-                        temp_str += temp
-                    except StopIteration:
-                        memory.add_memory("chatlogs",self.name,temp_str)
-                        break
-            else:
-                response = chatgpt.chat(self.client,self.description,self.text_model,user,self.name,streaming = self.stream)
-                print(response)
-                memory.add_memory("chatlogs",self.name,response)
+            with tracing.turn("chat"):
+                print(f"{self.name} : ",end="")
+                if self.stream == True:
+                    temp_str = ""
+                    response = chatgpt.chat(self.client,self.description,self.text_model,user,self.memory_name,streaming = self.stream,additional_instructions=additional_instruction,reason=self.reasoning,context=self.context)
+                    while True:
+                        try:
+                            temp = next(response)
+                            print(temp,end="")
+                            temp_str += temp
+                        except StopIteration:
+                            memory.add_memory("chatlogs",self.memory_name,temp_str)
+                            break
+                else:
+                    response = chatgpt.chat(self.client,self.description,self.text_model,user,self.memory_name,streaming = self.stream,additional_instructions=additional_instruction,reason=self.reasoning,context=self.context)
+                    print(response)
+                    memory.add_memory("chatlogs",self.memory_name,response)
             print('\n')
     
 
 
 
     def run_chat_voice(self,additional_instruction: str = ""):
+        """
+        Chat where every answer is spoken with the rvc voice. The answer goes sentence by sentence through
+        'voice_pipeline.VoicePipeline' so the first sentence plays while the next ones are generated and converted.
+        The prompt comes back once the text is written and the voice keeps playing: the next message (or ':q')
+        cancels what is left of the answer (tts, rvc and audio not played yet) before starting the new turn.
+        """
         self.load_model()
         print("##############################\n########-Chat started-########\n##############################\n")
         print("[INFO] type ':q' to quit")
         while True:
             user = input("You: ")
+            self.turn_scope = self.runtime.next_turn(self.turn_scope, "voice") #interrupts the previous answer
             if user == ':q':
+                self.turn_scope.cancel()
                 print("[INFO] exiting chat")
                 break
-            print(f"{self.name} : ",end="")
-            if self.stream == True:
-                temp_str = ""
-                response = chatgpt.chat(self.client,self.description,self.text_model,user,self.name,streaming = self.stream,additional_instructions=additional_instruction,reason=self.reasoning)
-                while True:
-                    try:
-                        temp = next(response)
-                        print(temp,end="")
-                        temp_str += temp
-                    except StopIteration:
-                        memory.add_memory("chatlogs",self.name,f"[USER] {user}\n[YOU] {temp_str}\n")
-                        break
-            else:
-                response = chatgpt.chat(self.client,self.description,self.text_model,user,self.name,streaming = self.stream)
-                print(response)
-                memory.add_memory("chatlogs",self.name,f"[USER] {user}\n[YOU] {response}\n")
-
-
-            print("\n///////////////Generating voice...///////////////")
-            self.reset_audio_cache()
-            if self.stream == True:
-                print("[INFO] not made yet for stream using conventional method")
-                chatgpt.voice(self.client,temp_str,self.voice_description,self.name)
-                convertToAI()
-                audio, sr = librosa.load(f"./audio_output/{self.name}.wav", sr=None)
-                sounddevice.play(audio, sr)
-                sounddevice.wait()
-            else:
-                chatgpt.voice(self.client,response,self.voice_description,self.name)
-                convertToAI()
-                audio, sr = librosa.load(f"./audio_output/{self.name}.wav", sr=None)
-                sounddevice.play(audio, sr)
-                sounddevice.wait()
-        
-    
-    
\ No newline at end of file
+            with tracing.turn("voice"):
+                print(f"{self.name} : ",end="")
+                pipeline = voice_pipeline.VoicePipeline(self.client,self.voice_description,self.name,debug_dump=self.debug_audio,voice=self.voice,cache=self.audio_cache,scope=self.turn_scope)
+                pipeline.start()
+                response = chatgpt.chat(self.client,self.description,self.text_model,user,self.memory_name,streaming = self.stream,additional_instructions=additional_instruction,reason=self.reasoning,context=self.context,scope=self.turn_scope)
+                if self.stream == True:
+                    text = pipeline.speak(response)
+                else:
+                    text = pipeline.speak([response])
+                memory.add_memory("chatlogs",self.memory_name,f"[USER] {user}\n[YOU] {text}\n")
+                self.runtime.submit(self.turn_scope, pipeline.wait) #the last sentences play while the user types
+            print('\n')
+
+class AsyncModel:
+    """
+    asyncio version of Model to serve many conversations from one event loop.\n
+    - Every AsyncModel of a loop shares one openai.AsyncOpenAI client per api key, so they also share its connection pool.
+    - Nothing blocks the loop: memory files are read and written in worker threads and rvc runs in its own executor,
+      made on the first conversion with 'configure_rvc()' workers (1 by default: one conversion at a time on the gpu).
+    - There is no 'input()' loop, the caller sends the user messages (see 'chat', 'stream_chat', 'stream_chat_voice').\n
+    exemple_ | teto = await AsyncModel.create("./settings/teto.json") | text = await teto.chat("hi")
+    """
+    _rvc_workers = 1 #conversions at the same time, see 'configure_rvc()'
+    _rvc_executor = None
+    _rvc_lock = threading.Lock()
+
+    def __init__(self,json_setting = "settings.json", max_pending: int = 3, session: str = None):
+        settings = chatgpt.load_settings(json_setting)
+        self.json_file = json_setting
+        self.session = session #separate memory for this session, see memory.session_name()
+        self.api_key = settings["api_key"]
+        self.description = settings["description"]
+        self.voice_description = settings["voice_description"]
+        self.text_model = settings["text_model"]
+        self.name = settings["name"]
+        self.memory_name = memory.session_name(self.name,session)
+        self.reasoning = settings["reasoning"]
+        self.max_pending = max_pending #sentences being voiced ahead of the one being delivered
+
+        self.model_loaded = False
+        self.voice_key = None #key of the rvc voice of the model in the registry
+        self.audio_cache = audio_cache.get_cache() #None disables the cache
+        self.convert = None #replaces the rvc conversion, a function (audio, sr, voice) -> (audio, sr) like 'benchmark.stub_rvc', skips the audio cache
+
+        self.network = http_pool.configure(json_setting) #timeouts, retries and hedging of the clients of this model
+        context_tokens,summary_tokens,summary_model,recall_turns,recall_tokens,chain_turns = context.get_context_settings(json_setting)
+        #the background memory summary uses the shared sync client
+        self.context = context.ContextWindow(http_pool.get_client(self.api_key,network=self.network),self.memory_name,context_tokens,summary_tokens,summary_model,recall_turns,recall_tokens,chain_turns)
+
+    @classmethod
+    async def create(cls, json_setting = "settings.json", key_check_ttl: float = 24 * 3600, **kwargs):
+        """makes an AsyncModel, checks the api key (at most once per 'key_check_ttl') and starts with an empty memory like Model"""
+        self = cls(json_setting, **kwargs)
+        if key_check_ttl <= 0 or not chatgpt.key_recently_validated(self.api_key, key_check_ttl):
+            try:
+                await http_pool.for_operation(self.client,"check").responses.create(model="gpt-5-nano", instructions=" ", input=" ", max_output_tokens=16)
+            except Exception as e:
+                assert False, f"An error occurred: {e} Try checking your connection or API key"
+            if key_check_ttl > 0:
+                await asyncio.to_thread(chatgpt.remember_valid_key, self.api_key)
+        await asyncio.to_thread(self._reset_memory)
+        return self
+
+    @property
+    def client(self) -> openai.AsyncOpenAI:
+        """the AsyncOpenAI client shared by the models of the running loop"""
+        return http_pool.get_async_client(self.api_key,network=self.network)
+
+    def _reset_memory(self):
+        memory.euthanize_model(self.json_file,self.session)
+        memory.add_memory("chatlogs",self.memory_name) #makes an empty memory file
+        self.context.reset()
+
+    async def delete_memory(self):
+        await asyncio.to_thread(self._reset_memory)
+
+    @classmethod
+    def configure_rvc(cls, workers: int = 1) -> None:
+        """
+        conversions run at the same time by every AsyncModel: 1 for one rvc on the gpu of this process,
+        the number of worker processes of 'rvc_converter.start_service()' (one waiting thread per worker) otherwise
+        """
+        with cls._rvc_lock:
+            executor, cls._rvc_executor = AsyncModel._rvc_executor, None
+            AsyncModel._rvc_workers = max(int(workers), 1)
+        if executor is not None: #the running conversions finish in the old one
+            executor.shutdown(wait=False)
+
+    @classmethod
+    def _rvc_pool(cls) -> ThreadPoolExecutor:
+        with cls._rvc_lock:
+            if AsyncModel._rvc_executor is None:
+                AsyncModel._rvc_executor = ThreadPoolExecutor(max_workers=AsyncModel._rvc_workers, thread_name_prefix="rvc")
+            return AsyncModel._rvc_executor
+
+    async def _run_rvc(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._rvc_pool(), func, *args)
+
+    async def load_model(self, warmup: bool = True):
+        """loads the rvc voice (instant if another model already loaded it), 'warmup' converts 1s of noise like Model.load_model"""
+        self.voice_key = await self._run_rvc(load_rvc_settings, self.json_file)
+        if warmup:
+            noise = np.random.uniform(-1, 1, 44100).astype(np.float32)
+            await self._run_rvc(convertToAI_array, noise, 44100, self.voice_key)
+        self.model_loaded = True
+
+    async def unload_model(self):
+        if self.voice_key is not None:
+            await self._run_rvc(unload_rvc_settings, self.voice_key)
+            self.voice_key = None
+        self.model_loaded = False
+
+    ##########################################################################################
+    ################################## CHAT FUNCTIONS ########################################
+    ##########################################################################################
+
+    async def chat(self, user: str, additional_instruction: str = "") -> str:
+        """sends one message and returns the whole answer"""
+        with tracing.turn("chat"):
+            text = await chatgpt.achat(self.client,self.description,self.text_model,user,self.memory_name,streaming = False,additional_instructions=additional_instruction,reason=self.reasoning,context=self.context)
+            await asyncio.to_thread(memory.add_memory,"chatlogs",self.memory_name,f"[USER] {user}\n[YOU] {text}\n")
+        return text
+
+    async def stream_chat(self, user: str, additional_instruction: str = ""):
+        """sends one message and yields the answer as text deltas, the answer is saved in memory at the end"""
+        with tracing.turn("chat"):
+            deltas = await chatgpt.achat(self.client,self.description,self.text_model,user,self.memory_name,streaming = True,additional_instructions=additional_instruction,reason=self.reasoning,context=self.context)
+            parts = []
+            try:
+                async for delta in deltas:
+                    parts.append(delta)
+                    yield delta
+            finally: #closes the openAI stream right away when the reader stops early
+                await deltas.aclose()
+            await asyncio.to_thread(memory.add_memory,"chatlogs",self.memory_name,f"[USER] {user}\n[YOU] {''.join(parts)}\n")
+
+    async def voice(self, text: str) -> tuple:
+        """
+        returns (audio,sr) of the text, converted with rvc when the model is loaded (or with 'convert'). Lines already said come from the audio cache.
+        The audio of a 'convert' hook never goes through the cache, its key could not tell it from the real voice.
+        """
+        key = None
+        if self.audio_cache is not None and self.convert is None and self.audio_cache.cacheable(text):
+            key = audio_cache.audio_key(text, chatgpt.TTS_MODEL, chatgpt.TTS_VOICE, self.voice_description, self.voice_key if self.model_loaded else None)
+            cached = await asyncio.to_thread(self.audio_cache.get, key)
+            if cached is not None:
+                return cached
+        audio, sr = await chatgpt.avoice_pcm(self.client,text,self.voice_description)
+        if self.convert is not None:
+            audio, sr = await self._run_rvc(self.convert, audio, sr, self.voice_key)
+        elif self.model_loaded:
+            audio, sr = await self._run_rvc(convertToAI_array, audio, sr, self.voice_key)
+        if key is not None:
+            await asyncio.to_thread(self.audio_cache.put, key, audio, sr)
+        return audio, sr
+
+    async def stream_chat_voice(self, user: str, additional_instruction: str = ""):
+        """
+        sends one message and yields the answer as it comes:
+            {"type": "text", "delta": str} for every text delta
+            {"type": "audio", "text": str, "audio": np.ndarray, "sr": int} for every sentence, in order
+        up to 'max_pending' sentences are voiced at the same time while the text keeps streaming.
+        """
+        events = asyncio.Queue(maxsize=64)
+        voices = asyncio.Queue(maxsize=self.max_pending) #voice tasks in sentence order
+
+        async def deliver():
+            while True:
+                item = await voices.get()
+                if item is None:
+                    return
+                sentence, task = item
+                audio, sr = await task
+                await events.put({"type": "audio", "text": sentence, "audio": audio, "sr": sr})
+
+        async def produce():
+            deliverer = asyncio.create_task(deliver())
+            chat = self.stream_chat(user, additional_instruction)
+            tasks = []
+            async def hand_over(item):
+                """puts 'item' for the deliverer, raises the error of the deliverer if it stopped on a failed voice instead of waiting forever"""
+                put = asyncio.ensure_future(voices.put(item))
+                await asyncio.wait([put, deliverer], return_when=asyncio.FIRST_COMPLETED)
+                if not put.done():
+                    put.cancel()
+                    deliverer.result()
+            async def voice_later(sentence):
+                task = asyncio.create_task(self.voice(sentence))
+                tasks.append(task)
+                await hand_over((sentence, task))
+            try:
+                segmenter = voice_pipeline.SentenceSegmenter()
+                async for delta in chat:
+                    await events.put({"type": "text", "delta": delta})
+                    for sentence in segmenter.feed(delta):
+                        await voice_later(sentence)
+                last = segmenter.flush()
+                if last != "":
+                    await voice_later(last)
+                await hand_over(None)
+                await deliverer
+                await events.put(None)
+            except BaseException as e: #stops the voices still running and hands the error to the reader
+                deliverer.cancel()
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(deliverer, *tasks, return_exceptions=True) #their errors are the one raised here
+                await chat.aclose()
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                await events.put(e)
+
+        turn = tracing.turn("voice")
+        turn.__enter__() #the producer task copies the context, its spans belong to the turn
+        producer = asyncio.create_task(produce())
+        try:
+            while True:
+                event = await events.get()
+                if event is None:
+                    break
+                if isinstance(event, BaseException):
+                    raise event
+                yield event
+        finally:
+            if not producer.done(): #the reader stopped early or was cancelled: the stream, tts and rvc of the turn stop before it ends
+                producer.cancel()
+                await asyncio.wait([producer])
+            turn.__exit__(None, None, None)
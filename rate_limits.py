@@ -0,0 +1,256 @@
+"""
+Client side scheduling of the openAI requests under the rate limits of the account, so the interactive requests (chat, tts) always find room
+and the background ones (screen and memory summaries) wait instead of using it all up, and a request waits instead of being refused with a 429.
+- Every model has a bucket of requests and a bucket of tokens per minute. Their size comes from the 'x-ratelimit-limit-*' headers
+  (or from the "rate_limits" network settings before the first answer), they refill continuously over a minute
+  and every answer corrects them with its 'x-ratelimit-remaining-*' headers. A model with no known limit is never held back.
+- A request takes 1 request and its estimated tokens (see 'estimate_tokens()') before it is sent, and waits while there is not enough.
+- A "background" request also waits while an "interactive" one of the same model is waiting, and leaves 'background_reserve' of both buckets to them.
+- A 429 stops the model until its 'retry-after': the openAI client retries the request and the retry waits here.
+'http_pool' runs 'acquire()' / 'observe()' as event hooks of its shared connection pools, the class of a request comes from 'http_pool.for_operation()'.
+Classes:
+    - RateLimiter:
+        The buckets of every model. exemple_ | limiter.acquire("gpt-4o-mini", 1200, "background") | limiter.observe("gpt-4o-mini", 200, headers)
+Functions:
+    - estimate_tokens(body: dict) -> int:
+        Tokens counted by openAI for a request body: prompt characters / 4, images and the maximum output.
+    - get_limiter() -> RateLimiter:
+        The limiter shared by the whole process.
+"""
+
+import re
+import time
+import asyncio
+import threading
+import tracing
+
+#imports---------------------------------------------------------------
+
+PRIORITIES = ("interactive", "background")
+IMAGE_TOKENS = 765 #a high detail image of up to 1024x1024 (4 tiles)
+OUTPUT_TOKENS = 256 #output counted for a request without a maximum
+
+def estimate_tokens(body: dict) -> int:
+    """_summary_
+    tokens of a request body as openAI counts them against the tokens per minute: the text of "input", "instructions" and "messages"
+    (4 characters per token), 'IMAGE_TOKENS' per image and the maximum output ("max_output_tokens", "max_tokens"...)
+    """
+    counts = [0, 0] #characters, images
+    def walk(value):
+        if isinstance(value, str):
+            if not value.startswith("data:"): #base64 images are counted as images
+                counts[0] += len(value)
+        elif isinstance(value, list):
+            for item in value:
+                walk(item)
+        elif isinstance(value, dict):
+            if value.get("type") in ("image_url", "input_image"):
+                counts[1] += 1
+                return
+            for key, item in value.items():
+                if key not in ("type", "role", "detail"):
+                    walk(item)
+    for key in ("instructions", "input", "messages"):
+        walk(body.get(key))
+    output = body.get("max_output_tokens") or body.get("max_completion_tokens") or body.get("max_tokens") or OUTPUT_TOKENS
+    return counts[0] // 4 + counts[1] * IMAGE_TOKENS + int(output)
+
+def _seconds(text: str) -> float:
+    """duration of a rate limit header: "1s", "6m0s", "20ms", "0.5" (seconds)"""
+    if text is None:
+        return None
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    units = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", text)
+    return sum(float(value) * units[unit] for value, unit in parts) if parts else None
+
+class _Bucket:
+    """amount left of a per minute limit, refilled continuously ('capacity' None: no known limit)"""
+    __slots__ = ("capacity", "level", "updated")
+
+    def __init__(self, capacity: float = None):
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        if self.capacity is not None:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def wait(self, amount: float, reserve: float) -> float:
+        """seconds before 'amount' can be taken while leaving 'reserve' (share of the capacity), 0 when it can be taken now"""
+        if self.capacity is None:
+            return 0.0
+        need = min(amount, self.capacity * (1 - reserve)) + self.capacity * reserve #a request larger than the bucket waits for a full one
+        if self.level >= need:
+            return 0.0
+        return (need - self.level) * 60 / self.capacity
+
+    def take(self, amount: float) -> None:
+        if self.capacity is not None:
+            self.level -= min(amount, self.capacity)
+
+    def correct(self, capacity: str, remaining: str) -> None:
+        """applies the limit and remaining headers of an answer"""
+        if capacity is not None:
+            self.capacity = float(capacity)
+            if self.level is None:
+                self.level = self.capacity
+        if remaining is not None and self.capacity is not None:
+            self.level = min(self.level, float(remaining)) #the local count already has the requests still on their way
+
+class _Model:
+    __slots__ = ("requests", "tokens", "blocked_until", "waiting")
+
+    def __init__(self, rpm: float = None, tpm: float = None):
+        self.requests = _Bucket(rpm)
+        self.tokens = _Bucket(tpm)
+        self.blocked_until = 0.0 #after a 429
+        self.waiting = dict.fromkeys(PRIORITIES, 0)
+
+class RateLimiter:
+    """
+    Per model request and token buckets with two priority classes.\n
+    - 'acquire()' (threads) and 'aacquire()' (event loop) wait until the request fits, 'observe()' reads the headers of the answer.
+    - 'limits' presets the buckets before the first answer: {"gpt-4o-mini": {"rpm": 500, "tpm": 200000}}.
+    - 'enabled=False' lets every request through (the headers are still read).\n
+    exemple_ | limiter = get_limiter() | limiter.acquire(model, estimate_tokens(body), "background")
+    """
+    def __init__(self, limits: dict = None, background_reserve: float = 0.2, enabled: bool = True):
+        self.limits = dict(limits or {})
+        self.background_reserve = background_reserve
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._models = {}
+        self.waits = {priority: [0, 0.0] for priority in PRIORITIES} #requests that waited, seconds waited
+        self.rate_limited = 0 #429 answers
+
+    def configure(self, limits: dict = None, background_reserve: float = None, enabled: bool = None) -> None:
+        with self._lock:
+            if limits is not None:
+                self.limits = dict(limits)
+                for name, preset in self.limits.items():
+                    if name in self._models: #the headers of the next answer correct it again
+                        self._models[name] = _Model(preset.get("rpm"), preset.get("tpm"))
+            if background_reserve is not None:
+                self.background_reserve = background_reserve
+            if enabled is not None:
+                self.enabled = enabled
+
+    def _model(self, name: str) -> _Model:
+        state = self._models.get(name)
+        if state is None:
+            preset = self.limits.get(name, {})
+            state = self._models[name] = _Model(preset.get("rpm"), preset.get("tpm"))
+        return state
+
+    def _try(self, name: str, tokens: int, priority: str) -> float:
+        """takes room for the request and returns 0, or returns the seconds to wait before trying again"""
+        with self._lock:
+            state = self._model(name)
+            now = time.monotonic()
+            if now < state.blocked_until:
+                return state.blocked_until - now
+            reserve = 0.0
+            if priority != "interactive":
+                if state.waiting["interactive"] > 0: #the interactive requests go first
+                    return 0.05
+                reserve = self.background_reserve
+            state.requests.refill(now)
+            state.tokens.refill(now)
+            wait = max(state.requests.wait(1, reserve), state.tokens.wait(tokens, reserve))
+            if wait > 0:
+                return wait
+            state.requests.take(1)
+            state.tokens.take(tokens)
+            return 0.0
+
+    def _waiting(self, name: str, priority: str, count: int) -> None:
+        with self._lock:
+            self._model(name).waiting[priority] += count
+
+    def _waited(self, name: str, priority: str, seconds: float) -> None:
+        with self._lock:
+            self.waits[priority][0] += 1
+            self.waits[priority][1] += seconds
+        tracing.record("ratelimit.wait", seconds, model=name, priority=priority)
+
+    def acquire(self, name: str, tokens: int, priority: str = "interactive") -> float:
+        """waits until the request fits in the limits of the model 'name', returns the seconds waited"""
+        if not self.enabled or name is None:
+            return 0.0
+        wait = self._try(name, tokens, priority)
+        if wait == 0:
+            return 0.0
+        start = time.perf_counter()
+        self._waiting(name, priority, 1)
+        try:
+            while wait > 0:
+                time.sleep(min(wait, 0.25)) #short steps: an answer may free room earlier
+                wait = self._try(name, tokens, priority)
+        finally:
+            self._waiting(name, priority, -1)
+        waited = time.perf_counter() - start
+        self._waited(name, priority, waited)
+        return waited
+
+    async def aacquire(self, name: str, tokens: int, priority: str = "interactive") -> float:
+        """same as 'acquire()' without blocking the event loop"""
+        if not self.enabled or name is None:
+            return 0.0
+        wait = self._try(name, tokens, priority)
+        if wait == 0:
+            return 0.0
+        start = time.perf_counter()
+        self._waiting(name, priority, 1)
+        try:
+            while wait > 0:
+                await asyncio.sleep(min(wait, 0.25))
+                wait = self._try(name, tokens, priority)
+        finally:
+            self._waiting(name, priority, -1)
+        waited = time.perf_counter() - start
+        self._waited(name, priority, waited)
+        return waited
+
+    def observe(self, name: str, status: int, headers) -> None:
+        """updates the buckets of the model with the rate limit headers of an answer, a 429 stops the model until its 'retry-after'"""
+        if name is None:
+            return
+        with self._lock:
+            state = self._model(name)
+            now = time.monotonic()
+            state.requests.refill(now)
+            state.tokens.refill(now)
+            state.requests.correct(headers.get("x-ratelimit-limit-requests"), headers.get("x-ratelimit-remaining-requests"))
+            state.tokens.correct(headers.get("x-ratelimit-limit-tokens"), headers.get("x-ratelimit-remaining-tokens"))
+            if status == 429:
+                self.rate_limited += 1
+                retry = _seconds(headers.get("retry-after-ms"))
+                retry = retry / 1000 if retry is not None else _seconds(headers.get("retry-after"))
+                if retry is None:
+                    resets = [_seconds(headers.get("x-ratelimit-reset-requests")), _seconds(headers.get("x-ratelimit-reset-tokens"))]
+                    retry = max([reset for reset in resets if reset is not None], default=1.0)
+                state.blocked_until = max(state.blocked_until, now + retry)
+
+    def stats(self) -> dict:
+        """per model limits and levels, requests that waited and 429 answers"""
+        with self._lock:
+            now = time.monotonic()
+            models = {}
+            for name, state in self._models.items():
+                state.requests.refill(now)
+                state.tokens.refill(now)
+                models[name] = {"rpm": state.requests.capacity, "requests_left": state.requests.level,
+                                "tpm": state.tokens.capacity, "tokens_left": state.tokens.level, "waiting": dict(state.waiting)}
+            return {"models": models, "waits": {priority: {"count": count, "seconds": seconds} for priority, (count, seconds) in self.waits.items()},
+                    "rate_limited": self.rate_limited}
+
+_limiter = RateLimiter()
+
+def get_limiter() -> RateLimiter:
+    return _limiter
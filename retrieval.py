@@ -0,0 +1,107 @@
+"""
+Local BM25 index over the turns of a chat memory, used to recall the few old turns that are relevant to a new message
+without sending the whole memory nor calling an embedding api.
+Classes:
+    - TurnIndex:
+        Inverted index (term -> turns) updated one turn at a time and queried with NumPy.
+Functions:
+    - tokenize(text: str) -> list:
+        Lowercase words of a text.
+"""
+
+import re
+import threading
+from array import array
+import numpy as np
+
+#imports---------------------------------------------------------------
+
+_WORD = re.compile(r"\w+")
+_MARKERS = {"user", "you"} #'[USER]' and '[YOU]' are written in every turn by the model
+
+def tokenize(text: str) -> list:
+    """lowercase words of a text"""
+    return _WORD.findall(text.lower())
+
+class TurnIndex:
+    """
+    BM25 index of chat turns (turn n of the memory file is document n).\n
+    - add() only tokenizes the new turn and appends to the posting lists of its words: O(size of the turn).
+    - words found in more than max(max_df * turns, min_common) turns are too common to search.
+    - every posting list is an array of turn numbers (sorted, they are appended in order) and an array of term frequencies,
+      read by search() as NumPy arrays without copy, so a query costs a few vector operations per word of the query.\n
+    exemple_ | index = TurnIndex() | index.add("[USER] my cat is named Miso\\n[YOU] ...") | index.search("what is my cat's name", k=4)
+    """
+    def __init__(self, k1: float = 1.2, b: float = 0.75, max_df: float = 0.05, min_common: int = 20):
+        self.k1 = k1
+        self.b = b
+        self.max_df = max_df #share of the turns above which a word is too common to search
+        self.min_common = min_common #a word found in this many turns or less is always searched, 'max_df' alone would drop useful words of a short history
+        self._lock = threading.Lock()
+        self._docs = {} #term -> array of turn numbers
+        self._freqs = {} #term -> array of term frequencies, same order
+        self._lengths = array("f") #number of words of every turn
+        self._total = 0
+
+    def __len__(self) -> int:
+        return len(self._lengths)
+
+    def add(self, text: str) -> int:
+        """indexes the next turn and returns its number"""
+        counts = {}
+        words = tokenize(text)
+        for word in words:
+            if word not in _MARKERS:
+                counts[word] = counts.get(word, 0) + 1
+        with self._lock:
+            turn = len(self._lengths)
+            for word, count in counts.items():
+                docs = self._docs.get(word)
+                if docs is None:
+                    docs = self._docs[word] = array("I")
+                    self._freqs[word] = array("f")
+                docs.append(turn)
+                self._freqs[word].append(count)
+            self._lengths.append(len(words))
+            self._total += len(words)
+        return turn
+
+    def search(self, query: str, k: int = 4, before: int = None) -> list:
+        """
+        returns up to 'k' (turn, score) of the turns most relevant to 'query', best first.
+        'before' only searches the turns before this number (the recent turns are already in the prompt).
+        """
+        terms = set(tokenize(query)) - _MARKERS
+        with self._lock:
+            total = len(self._lengths)
+            stop = total if before is None else min(before, total)
+            if stop <= 0 or k <= 0 or not terms:
+                return []
+            lengths = np.frombuffer(self._lengths, dtype=np.float32, count=stop)
+            average = max(self._total / total, 1e-9)
+            #words found in most turns ('the', 'is'...) barely change the ranking but cost the most, skipped unless nothing else matches
+            known = sorted((len(self._docs[term]), term) for term in terms if term in self._docs)
+            common = max(self.max_df * total, self.min_common)
+            rare = [term for df, term in known if df <= common]
+            scores = np.zeros(stop, dtype=np.float32)
+            matched = []
+            for term in rare if rare else [term for _, term in known[:1]]:
+                docs = self._docs[term]
+                df = len(docs)
+                idf = np.log(1 + (total - df + 0.5) / (df + 0.5))
+                docs = np.frombuffer(docs, dtype=np.uint32)
+                cut = int(np.searchsorted(docs, stop)) #sorted turn numbers
+                docs = docs[:cut]
+                freqs = np.frombuffer(self._freqs[term], dtype=np.float32, count=cut)
+                norm = self.k1 * (1 - self.b + self.b * lengths[docs] / average)
+                scores[docs] += idf * freqs * (self.k1 + 1) / (freqs + norm)
+                matched.append(docs)
+
+        if not matched:
+            return []
+        #only the turns that contain a word of the query, not a scan of every turn
+        found = matched[0] if len(matched) == 1 else np.unique(np.concatenate(matched))
+        if len(found) > k:
+            found = found[np.argpartition(scores[found], -k)[-k:]]
+        found = found[np.argsort(-scores[found], kind="stable")]
+        return [(int(turn), float(scores[turn])) for turn in found]
@@ -1,50 +1,410 @@
 """
 This module provides functionality for speech-to-speech conversion using RVC (Retrieval-based Voice Conversion).
-It initializes a global RVCInference object, loads model and conversion settings from a JSON file, and processes
-audio files in a specified input directory, saving the converted results to an output directory.
+It keeps a registry of loaded voices so several characters can live in the same process, loads model and conversion
+settings from a JSON file, and converts audio files or audio arrays with them.
+Classes:
+    RVCVoice:
+        One resident voice: its synthesizer, index and conversion parameters.
+    RVCRegistry:
+        Keeps the voices resident up to a memory budget (least recently used voices are evicted first) and shares the inference runtime between them.
 Functions:
     load_rvc_settings(settings_file="./settings.json"):
-        Loads RVC model and conversion parameters from a JSON settings file and applies them to the global RVCInference object.
+        Loads RVC model and conversion parameters from a JSON settings file in the registry, makes it the active voice and returns its key.
+    read_rvc_settings(settings_file="./settings.json") / voice_key(model_path, index_path, params):
+        The model, index and parameters of a settings file and the registry key they give, without loading anything.
     convertToAI():
         Converts all '.wav' audio files in the './audio_input' directory using the loaded RVC model and settings,
         saving the converted files to the './audio_output' directory.
+    convertToAI_array(audio, sr):
+        Converts a float32 audio array in memory and returns the converted array and its sample rate, without touching the disk.
+    unload_rvc_settings():
+        Removes a voice from the registry.
+    start_service(workers=1, device="cuda:0") / stop_service():
+        Moves the conversions into worker processes ('rvc_service.RVCService'), the functions above keep the same arguments and results.
 """
-from rvc_python.infer import RVCInference
+from collections import OrderedDict
+from glob import glob
+from contextlib import contextmanager
+from startup import lazy_import
+import tracing
+import numpy as np
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import atexit
 import json
+import os
 #imports---------------------------------------------------------------------------
 
-# makes the rvc object global
-rvc = RVCInference(models_dir="./model",device="cuda:0")
+class RVCVoice:
+    """
+    A loaded voice. Owns its synthesizer (the '.pth'), its index and its conversion parameters,
+    the hubert and rmvpe models are the registry's and are shared by every voice.
+    """
+    def __init__(self, key: tuple, runtime, model_path: str, index_path: str, params: dict):
+        self.key = key
+        self.model_path = model_path
+        self.index_path = index_path
+        self.params = params
+        self.size = os.path.getsize(model_path) #weights in memory are about the size of the .pth
+        self.lock = threading.Lock() #one conversion at a time per voice
+
+        VC = lazy_import("rvc_python.modules.vc.modules").VC
+        self.vc = VC(runtime.lib_dir, runtime.config)
+        self.vc.get_vc(model_path, "v2")
+        print(f"Model {os.path.basename(model_path)} loaded.")
+
+class RVCRegistry:
+    """
+    Keeps several rvc voices loaded at the same time.\n
+    - Voices are keyed by ('.pth', '.index', params), loading a key that is already resident only marks it as recently used.
+    - When the resident voices weigh more than 'memory_budget' bytes the least recently used ones are evicted.
+      An evicted voice is loaded again the next time it is used.
+    - The runtime (device config, hubert and rmvpe models) is created on first use and shared by every voice.
+      rvc_python and torch are only imported then, so importing this module is cheap.\n
+    exemple_ | key = registry.load("models/teto.pth","models/teto.index",params) | registry.get(key)
+    """
+    def __init__(self, models_dir: str = "./model", device: str = "cuda:0", memory_budget: int = 2 * 1024**3):
+        self.models_dir = models_dir
+        self.device = device
+        self.memory_budget = memory_budget
+
+        self._lock = threading.RLock() #the resident voices, never held while loading a model nor while waiting for a voice
+        self._shared_lock = threading.Lock() #the runtime and hubert
+        self._runtime = None
+        self._hubert = None
+        self._rmvpe = None
+        self._voices = OrderedDict() #least recently used first
+        self._known = {} #key -> (model_path, index_path, params) to reload evicted voices
+        self._loading = {} #key -> threading.Event set once the voice being loaded by another thread is ready (or failed)
+
+    @property
+    def runtime(self):
+        """the shared inference runtime (rvc_python.infer.RVCInference), created on first use"""
+        with self._shared_lock:
+            if self._runtime is None:
+                RVCInference = lazy_import("rvc_python.infer").RVCInference
+                self._runtime = RVCInference(models_dir=self.models_dir, device=self.device)
+            return self._runtime
+
+    def hubert(self):
+        runtime = self.runtime
+        with self._shared_lock:
+            if self._hubert is None:
+                self._hubert = lazy_import("rvc_python.modules.vc.utils").load_hubert(runtime.config, runtime.lib_dir)
+            return self._hubert
+
+    #----------------------------------residency--------------------------------------
+    #lock order: 'voice.lock' is only taken with no other lock held ('_use()', '_release()'),
+    #so a conversion and the eviction of its voice by another thread can not wait for each other
+
+    def load(self, model_path: str, index_path: str = "", params: dict = None) -> tuple:
+        """loads a voice if it is not resident yet and returns its key"""
+        params = {} if params is None else params
+        key = voice_key(model_path, index_path, params)
+        with self._lock:
+            self._known[key] = (model_path, index_path, params)
+        self.get(key)
+        return key
+
+    def get(self, key: tuple) -> RVCVoice:
+        """
+        returns a resident voice, reloading it if it was evicted. The model is loaded outside of the registry lock,
+        so the other voices keep converting meanwhile, and only once when several threads ask for it.
+        """
+        while True:
+            with self._lock:
+                voice = self._voices.get(key)
+                if voice is not None:
+                    self._voices.move_to_end(key)
+                    return voice
+                if key not in self._known:
+                    assert False, "unknown rvc voice, use 'load_rvc_settings()' first"
+                loading = self._loading.get(key)
+                if loading is None: #this thread loads it
+                    loading = self._loading[key] = threading.Event()
+                    model_path, index_path, params = self._known[key]
+                    break
+            loading.wait() #loaded by another thread, or its load failed and this thread tries again
+
+        dropped = []
+        try:
+            if index_path != "" and not os.path.isfile(index_path):
+                assert False, f"Index file {index_path} not found."
+            voice = RVCVoice(key, self.runtime, model_path, index_path, params)
+            with self._lock:
+                self._voices[key] = voice
+                dropped = self._evict(keep=key)
+        finally:
+            with self._lock:
+                self._loading.pop(key).set()
+        for old in dropped:
+            self._release(old)
+        return voice
+
+    def _evict(self, keep: tuple) -> list:
+        """removes the least recently used voices over the budget (under '_lock') and returns them for '_release()'"""
+        dropped = []
+        while self.resident_size() > self.memory_budget and len(self._voices) > 1:
+            key = next(iter(self._voices))
+            if key == keep:
+                self._voices.move_to_end(key)
+                continue
+            dropped.append(self._voices.pop(key))
+        return dropped
+
+    def _release(self, voice: RVCVoice) -> None:
+        """frees the model of a voice removed from the registry, after its running conversion (no other lock held)"""
+        with voice.lock:
+            voice.vc = None
+        print(f"Model {os.path.basename(voice.model_path)} unloaded from memory.")
+        try:
+            import torch
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        except ImportError:
+            pass
+
+    def unload(self, key: tuple) -> None:
+        """evicts a voice and forgets it"""
+        with self._lock:
+            voice = self._voices.pop(key, None)
+            self._known.pop(key, None)
+        if voice is not None:
+            self._release(voice)
+
+    def resident(self) -> list:
+        """keys of the resident voices, least recently used first"""
+        with self._lock:
+            return list(self._voices)
+
+    def resident_size(self) -> int:
+        with self._lock:
+            return sum(voice.size for voice in self._voices.values())
+
+    #----------------------------------inference--------------------------------------
+
+    @contextmanager
+    def _use(self, key: tuple):
+        """
+        the resident voice of 'key' with its lock held and the shared models given to it. An eviction can run between 'get()'
+        and the lock ('_release()' sets 'vc' to None under the same lock), the voice is then taken again from the registry, which reloads it.
+        """
+        hubert = self.hubert() #before the voice lock, see the lock order
+        while True:
+            voice = self.get(key)
+            voice.lock.acquire()
+            if voice.vc is not None:
+                break
+            voice.lock.release()
+        try:
+            self._prepare(voice, hubert)
+            yield voice
+        finally:
+            voice.lock.release()
+
+    def _prepare(self, voice: RVCVoice, hubert) -> None:
+        """gives the shared models to the voice before a conversion"""
+        voice.vc.hubert_model = hubert
+        if self._rmvpe is not None and not hasattr(voice.vc.pipeline, "model_rmvpe"):
+            voice.vc.pipeline.model_rmvpe = self._rmvpe
+
+    def _keep_shared(self, voice: RVCVoice) -> None:
+        """keeps the rmvpe model loaded by the first conversion for the other voices"""
+        if self._rmvpe is None and hasattr(voice.vc.pipeline, "model_rmvpe"):
+            self._rmvpe = voice.vc.pipeline.model_rmvpe
+
+    def infer_file(self, key: tuple, input_path: str, output_path: str) -> str:
+        """same as 'RVCInference.infer_file' with a resident voice"""
+        from scipy.io import wavfile
+        with self._use(key) as voice:
+            p = voice.params
+            wav_opt = voice.vc.vc_single(
+                sid=0, input_audio_path=input_path, f0_up_key=p.get("f0up_key", 0), f0_method=p.get("f0method", "rmvpe"),
+                file_index=voice.index_path, index_rate=p.get("index_rate", 0.5), filter_radius=p.get("filter_radius", 3),
+                resample_sr=p.get("resample_sr", 0), rms_mix_rate=p.get("rms_mix_rate", 1), protect=p.get("protect", 0.33),
+                f0_file="", file_index2="",
+            )
+            self._keep_shared(voice)
+            wavfile.write(output_path, voice.vc.tgt_sr, wav_opt)
+        return output_path
+
+    def infer_dir(self, key: tuple, input_dir: str, output_dir: str) -> list:
+        """same as 'RVCInference.infer_dir' with a resident voice"""
+        os.makedirs(output_dir, exist_ok=True)
+        processed_files = []
+        for input_audio_path in glob(os.path.join(input_dir, '*.*')):
+            output_filename = os.path.splitext(os.path.basename(input_audio_path))[0] + '.wav'
+            processed_files.append(self.infer_file(key, input_audio_path, os.path.join(output_dir, output_filename)))
+        return processed_files
+
+    def infer_array(self, key: tuple, audio: np.ndarray) -> tuple:
+        """converts 16kHz float32 audio with a resident voice, returns (int16 audio, sr)"""
+        name = f"array{next(_array_ids)}" #the harvest f0 method caches its input by "file" name
+        with self._use(key) as voice:
+            file_index = voice.index_path.strip(' "\n').replace("trained", "added") #same cleanup as 'vc_single'
+            p = voice.params
+            vc = voice.vc
+            try:
+                audio_opt = vc.pipeline.pipeline(
+                    vc.hubert_model, vc.net_g, 0, audio, name, [0, 0, 0],
+                    int(p.get("f0up_key", 0)), p.get("f0method", "rmvpe"), file_index, p.get("index_rate", 0.5), vc.if_f0,
+                    p.get("filter_radius", 3), vc.tgt_sr, p.get("resample_sr", 0), p.get("rms_mix_rate", 1), vc.version, p.get("protect", 0.33), "",
+                )
+            finally:
+                lazy_import("rvc_python.modules.vc.pipeline").input_audio_path2wav.pop(name, None)
+            self._keep_shared(voice)
+            resample_sr = p.get("resample_sr", 0)
+            tgt_sr = resample_sr if vc.tgt_sr != resample_sr >= 16000 else vc.tgt_sr
+        return audio_opt, tgt_sr
+
+_array_ids = itertools.count() #unique names for the harvest f0 cache of rvc
 
-def load_rvc_settings(settings_file="./settings.json"):
+def voice_key(model_path: str, index_path: str = "", params: dict = None) -> tuple:
+    """the registry key of a voice, also used in the audio cache keys"""
+    return (model_path, index_path, tuple(sorted(({} if params is None else params).items())))
+
+# makes the rvc registry global, the voices are loaded by 'load_rvc_settings()'
+registry = RVCRegistry(models_dir="./model",device="cuda:0")
+_active = None #key of the voice used when none is given
+_service = None #rvc_service.RVCService when the conversions run in worker processes
+
+def start_service(workers: int = 1, device: str = "cuda:0"):
     """_summary_
-    loads all the settings needed for rvc speech to speech converstion
+    runs the conversions in 'workers' worker processes from now on (the voices are loaded there, not in this process).
+    Calling it again returns the running service.
+    Returns:
+        rvc_service.RVCService: _description_. the running service
+    """
+    global _service
+    if _service is None:
+        import rvc_service #imported here because the workers import this module
+        _service = rvc_service.RVCService(workers, device).start()
+        atexit.register(stop_service) #the workers remove their shared memory
+        if _active is not None: #voice loaded before the service
+            _service.load(_active)
+    return _service
+
+def get_service_settings(settings_file="./settings.json") -> tuple:
+    """_summary_
+    reads the optional "rvc_workers" (0 converts in this process) and "rvc_device" of the model settings
+    Returns:
+        tuple (workers,device): | workers: worker processes of 'start_service()' | device: their torch device
+    """
+    with open(settings_file, "r") as f:
+        model_settings = json.load(f)["model_settings"]
+    return model_settings.get("rvc_workers", 0),model_settings.get("rvc_device", "cuda:0")
+
+def stop_service() -> None:
+    """stops the worker processes, the next conversions run in this process again"""
+    global _service
+    if _service is not None:
+        service, _service = _service, None
+        service.stop()
+
+def load_rvc_settings(settings_file="./settings.json") -> tuple:
+    """_summary_
+    loads all the settings needed for rvc speech to speech converstion and makes it the active voice.
+    Loading settings that are already resident is almost instant.
     Args:
         settings_file (str, optional): _description_. Defaults to "./settings.json".
+    Returns:
+        tuple: _description_. key of the voice in the registry, to give to 'convertToAI()' when several voices are used
+    """
+    global _active
+    if _service is not None: #loaded and warmed up in the worker processes
+        _active = voice_key(*read_rvc_settings(settings_file))
+        _service.load(_active)
+    else:
+        _active = registry.load(*read_rvc_settings(settings_file))
+    return _active
+
+def read_rvc_settings(settings_file="./settings.json") -> tuple:
+    """_summary_
+    reads the rvc settings without loading the model
+    Returns:
+        tuple (model_path,index_path,params): | model_path: the '.pth' | index_path: the '.index' | params: conversion parameters
     """
     with open(settings_file, "r") as f:
         settings = json.load(f)
         
-    rvc.load_model(model_path_or_name="models/"+settings["model_files"]["name"],
-                   index_path="models/"+settings["model_files"]["index"])
-    
-    rvc.set_params(index_rate = settings["model_settings"]["index_rate"],
-                   filter_radius = settings["model_settings"]["filter_radius"],
-                   protect = settings["model_settings"]["protect"],
-                   f0method = settings["model_settings"]["f0method"],
-                   f0up_key = settings["model_settings"]["f0up_key"],
-                   resample_sr = settings["model_settings"]["resample_sr"],
-                   rms_mix_rate = settings["model_settings"]["rms_mix_rate"])
+    model_settings = settings["model_settings"]
+    params = dict(index_rate = model_settings["index_rate"],
+                  filter_radius = model_settings["filter_radius"],
+                  protect = model_settings["protect"],
+                  f0method = model_settings["f0method"],
+                  f0up_key = model_settings["f0up_key"],
+                  resample_sr = model_settings["resample_sr"],
+                  rms_mix_rate = model_settings["rms_mix_rate"])
+    return "models/"+settings["model_files"]["name"],"models/"+settings["model_files"]["index"],params
+
+def active_voice():
+    """key of the last loaded voice (None if no voice is loaded)"""
+    return _active
+
+def _voice_key(voice):
+    key = _active if voice is None else voice
+    if key is None:
+        assert False, "no rvc model loaded, use 'load_rvc_settings()' first"
+    return key
     
-def convertToAI(input_path=None,output_path=None):
+def convertToAI(input_path=None,output_path=None,voice=None):
     """_summary_
     -Using the loaded settings convert the audios with ai in '.wav' in "./audio_input" to "./audio_output" if nothing is specified
     -Can also convert a single file if the file path is specified
+    -'voice' is a key returned by 'load_rvc_settings()', defaults to the last loaded voice
     """
-    if input_path == None or output_path == None:
-        rvc.infer_dir(input_dir="./audio_input",output_dir="./audio_output")
-    else:
-        rvc.infer_file(input_path,output_path)
+    with tracing.span("rvc"):
+        if _service is not None: #the files are read and written by the workers
+            if input_path == None or output_path == None:
+                os.makedirs("./audio_output", exist_ok=True)
+                files = glob(os.path.join("./audio_input", '*.*'))
+                outputs = [os.path.join("./audio_output", os.path.splitext(os.path.basename(path))[0] + '.wav') for path in files]
+                with ThreadPoolExecutor(len(_service)) as pool: #one file per worker at a time
+                    list(pool.map(lambda paths: _service.convert_file(_voice_key(voice), *paths), zip(files, outputs)))
+            else:
+                _service.convert_file(_voice_key(voice),input_path,output_path)
+        elif input_path == None or output_path == None:
+            registry.infer_dir(_voice_key(voice),input_dir="./audio_input",output_dir="./audio_output")
+        else:
+            registry.infer_file(_voice_key(voice),input_path,output_path)
 
-def unload_rvc_settings():
-    rvc.unload_model()
\ No newline at end of file
+def convertToAI_array(audio: np.ndarray, sr: int, voice=None) -> tuple:
+    """_summary_
+    Converts a mono float32 audio array with the loaded model without writing any file.
+    Does what 'convertToAI' does but feeds the array directly to the rvc pipeline instead of loading and saving '.wav' files.
+    Args:
+        audio (np.ndarray): _description_. mono audio in [-1, 1]
+        sr (int): _description_. sample rate of 'audio'
+        voice (tuple): _description_. key returned by 'load_rvc_settings()'. Defaults to the last loaded voice.
+    Returns:
+        tuple (audio,sr): | audio: converted float32 audio | sr: its sample rate (the model's or 'resample_sr')
+    """
+    key = _voice_key(voice)
+
+    if _service is not None: #resampled and converted in a worker process, this one only waits
+        with tracing.span("rvc", seconds=round(len(audio) / sr, 3), service=True):
+            return _service.convert(audio, sr, key)
+
+    with tracing.span("rvc", seconds=round(len(audio) / sr, 3)):
+        #rvc works on 16kHz audio normalized under 0.95
+        audio = np.asarray(audio, dtype=np.float32)
+        if sr != 16000:
+            audio = lazy_import("librosa").resample(audio, orig_sr=sr, target_sr=16000)
+        peak = np.abs(audio).max() / 0.95 if audio.size > 0 else 0
+        if peak > 1:
+            audio = audio / peak
+
+        audio_opt, tgt_sr = registry.infer_array(key, audio)
+        return np.multiply(audio_opt, 1 / 32768, dtype=np.float32), tgt_sr
+
+def unload_rvc_settings(voice=None):
+    """removes a voice from the registry, defaults to the last loaded voice"""
+    global _active
+    key = _voice_key(voice)
+    if _service is not None:
+        _service.unload(key)
+    else:
+        registry.unload(key)
+    if key == _active:
+        _active = None
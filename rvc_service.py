@@ -0,0 +1,246 @@
+"""
+Runs the rvc conversions in worker processes so they never hold the GIL of the chat, tts and screen threads.
+- Every worker is a process with its own 'rvc_converter.registry': the voices stay loaded between conversions.
+- Requests go to an idle worker over its pipe, the audio does not: it is written in a shared memory buffer of the worker
+  (one input buffer owned by this process, one output buffer owned by the worker, both grown when a clip does not fit),
+  so a conversion costs two memory copies and no wav file.
+- A worker that dies is started again with the voices it had and gets the request again, it fails if the worker dies a second time.
+'rvc_converter' sends its conversions here once 'rvc_converter.start_service()' was called, nothing else changes for the callers.
+Classes:
+    - RVCService:
+        The pool of worker processes. exemple_ | service = RVCService(workers=2, device="cpu").start() | service.load(key) | service.convert(audio, sr, key)
+"""
+
+import os
+import queue
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+#imports---------------------------------------------------------------
+
+WARMUP_SECONDS = 1.0 #noise converted by every worker when a voice is loaded, the first real conversion does not pay for the warm up
+
+#----------------------------------worker process--------------------------------------
+
+def _serve(conn, device: str, threads: int) -> None:
+    """loop of a worker process: one request at a time from 'conn', a ("ok", ...) or ("error", message) reply for each"""
+    import rvc_converter
+    if threads > 0:
+        try:
+            import torch
+            torch.set_num_threads(threads) #the workers share the cores
+        except ImportError:
+            pass
+    rvc_converter.registry.device = device
+    inputs = None #shared memory of the input audio, owned by the main process
+    output = None #shared memory of the converted audio, owned by this process
+    try:
+        while True:
+            try:
+                request = conn.recv()
+            except EOFError: #main process gone
+                break
+            op = request[0]
+            if op == "stop":
+                break
+            try:
+                if op == "load":
+                    key, warmup = request[1], request[2]
+                    rvc_converter.registry.load(key[0], key[1], dict(key[2]))
+                    if warmup:
+                        noise = np.random.uniform(-1, 1, int(16000 * WARMUP_SECONDS)).astype(np.float32)
+                        rvc_converter.convertToAI_array(noise, 16000, key)
+                    conn.send(("ok",))
+                elif op == "unload":
+                    rvc_converter.registry.unload(request[1])
+                    conn.send(("ok",))
+                elif op == "convert":
+                    key, name, samples, sr = request[1:]
+                    if inputs is None or inputs.name != name: #the main process grew its buffer
+                        if inputs is not None:
+                            inputs.close()
+                        inputs = shared_memory.SharedMemory(name=name)
+                    rvc_converter.registry.load(key[0], key[1], dict(key[2])) #instant when resident
+                    audio = np.ndarray((samples,), dtype=np.float32, buffer=inputs.buf)
+                    converted, tgt_sr = rvc_converter.convertToAI_array(audio, sr, key)
+                    del audio #no view may outlive the buffer
+                    if output is None or output.size < converted.nbytes:
+                        if output is not None:
+                            output.close()
+                            output.unlink()
+                        output = shared_memory.SharedMemory(create=True, size=max(int(converted.nbytes * 1.5), 1 << 20))
+                    np.ndarray(converted.shape, dtype=np.float32, buffer=output.buf)[:] = converted
+                    conn.send(("ok", output.name, len(converted), tgt_sr))
+                elif op == "file":
+                    key, input_path, output_path = request[1:]
+                    rvc_converter.registry.load(key[0], key[1], dict(key[2]))
+                    rvc_converter.convertToAI(input_path, output_path, key)
+                    conn.send(("ok",))
+                else:
+                    conn.send(("error", f"unknown request {op}"))
+            except Exception as e: #the worker keeps serving
+                conn.send(("error", f"{e.__class__.__name__}: {e}"))
+    finally:
+        if inputs is not None:
+            inputs.close()
+        if output is not None:
+            output.close()
+            output.unlink()
+
+#----------------------------------main process----------------------------------------
+
+class _Worker:
+    """one worker process, its pipe and the shared memory buffers seen from the main process"""
+    def __init__(self, index: int):
+        self.index = index
+        self.lock = threading.Lock() #one request at a time on the pipe
+        self.conn = None
+        self.process = None
+        self.input = None #owned by the main process
+        self.output = None #attached, owned by the worker
+
+    def start(self, context, device: str, threads: int) -> None:
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=_serve, args=(child, device, threads), name=f"rvc-{self.index}", daemon=True)
+        self.process.start()
+        child.close()
+
+    def call(self, *request) -> tuple:
+        """sends a request and waits for the reply (the caller holds 'lock')"""
+        self.conn.send(request)
+        reply = self.conn.recv() #the GIL is released while waiting
+        if reply[0] == "error":
+            assert False, f"rvc worker {self.index}: {reply[1]}"
+        return reply
+
+    def write_input(self, audio: np.ndarray) -> str:
+        """copies 'audio' into the input buffer (grown if needed) and returns its name"""
+        if self.input is None or self.input.size < audio.nbytes:
+            if self.input is not None:
+                self.input.close()
+                self.input.unlink()
+            self.input = shared_memory.SharedMemory(create=True, size=max(int(audio.nbytes * 1.5), 1 << 20))
+        np.ndarray(audio.shape, dtype=np.float32, buffer=self.input.buf)[:] = audio
+        return self.input.name
+
+    def read_output(self, name: str, samples: int) -> np.ndarray:
+        """copy of the converted audio of the output buffer of the worker"""
+        if self.output is None or self.output.name != name:
+            if self.output is not None:
+                self.output.close()
+            self.output = shared_memory.SharedMemory(name=name)
+        return np.ndarray((samples,), dtype=np.float32, buffer=self.output.buf).copy()
+
+    def close(self) -> None:
+        if self.output is not None:
+            self.output.close()
+            self.output = None
+        if self.input is not None:
+            self.input.close()
+            self.input.unlink()
+            self.input = None
+
+class RVCService:
+    """
+    Pool of rvc worker processes.\n
+    - load(key) loads (and warms up) a voice in every worker, convert() sends a clip to the first idle worker.
+    - 'device' is the torch device of the workers ("cuda:0" with 1 or 2 workers, "cpu" with one worker per core).\n
+    exemple_ | service = RVCService(workers=1).start() | service.load(key) | audio, sr = service.convert(audio, 24000, key) | service.stop()
+    """
+    def __init__(self, workers: int = 1, device: str = "cuda:0"):
+        self.device = device
+        self.threads = max((os.cpu_count() or 1) // workers, 1) if device == "cpu" else 0
+        self._context = multiprocessing.get_context("spawn") #torch and cuda do not survive a fork
+        self._workers = [_Worker(i) for i in range(max(workers, 1))]
+        self._idle = queue.Queue()
+        self._voices = {} #key -> warmup, loaded again in a restarted worker
+        self._lock = threading.Lock()
+
+    def start(self) -> "RVCService":
+        for worker in self._workers:
+            worker.start(self._context, self.device, self.threads)
+            self._idle.put(worker)
+        return self
+
+    def stop(self) -> None:
+        for worker in self._workers:
+            with worker.lock:
+                try:
+                    worker.conn.send(("stop",))
+                except (OSError, ValueError):
+                    pass
+                worker.process.join(10)
+                if worker.process.is_alive():
+                    worker.process.kill()
+                worker.close()
+                worker.conn.close()
+
+    def __len__(self) -> int:
+        return len(self._workers)
+
+    def _restart(self, worker: _Worker) -> None:
+        print(f"[WARN] rvc worker {worker.index} died, starting it again")
+        if worker.output is not None: #the dead worker can not remove its buffer anymore, the input buffer is this process' and stays
+            worker.output.close()
+            worker.output.unlink()
+            worker.output = None
+        worker.conn.close()
+        worker.start(self._context, self.device, self.threads)
+        with self._lock:
+            voices = list(self._voices.items())
+        for key, warmup in voices:
+            worker.call("load", key, warmup)
+
+    def _call(self, worker: _Worker, *request) -> tuple:
+        """'worker.call()' that starts the worker again and retries once if it died"""
+        for attempt in range(2):
+            try:
+                return worker.call(*request)
+            except (EOFError, OSError):
+                self._restart(worker)
+        assert False, f"rvc worker {worker.index} died twice on the same request"
+
+    def _broadcast(self, *request) -> None:
+        """sends a request to every worker at the same time (each one waits for its running conversion)"""
+        def send(worker):
+            with worker.lock:
+                self._call(worker, *request)
+        with ThreadPoolExecutor(len(self._workers)) as pool:
+            for result in [pool.submit(send, worker) for worker in self._workers]:
+                result.result()
+
+    def load(self, key: tuple, warmup: bool = True) -> None:
+        """loads the voice 'key' (from 'rvc_converter.voice_key()') in every worker"""
+        with self._lock:
+            self._voices[key] = warmup
+        self._broadcast("load", key, warmup)
+
+    def unload(self, key: tuple) -> None:
+        with self._lock:
+            self._voices.pop(key, None)
+        self._broadcast("unload", key)
+
+    def convert(self, audio: np.ndarray, sr: int, key: tuple) -> tuple:
+        """same as 'rvc_converter.convertToAI_array()' in the first idle worker, returns (float32 audio, sr)"""
+        audio = np.ascontiguousarray(audio, dtype=np.float32)
+        worker = self._idle.get()
+        try:
+            with worker.lock:
+                name = worker.write_input(audio)
+                _, output, samples, tgt_sr = self._call(worker, "convert", key, name, len(audio), sr)
+                return worker.read_output(output, samples), tgt_sr
+        finally:
+            self._idle.put(worker)
+
+    def convert_file(self, key: tuple, input_path: str, output_path: str) -> str:
+        """same as 'rvc_converter.convertToAI(input_path, output_path)' in the first idle worker"""
+        worker = self._idle.get()
+        try:
+            with worker.lock:
+                self._call(worker, "file", key, os.path.abspath(input_path), os.path.abspath(output_path))
+            return output_path
+        finally:
+            self._idle.put(worker)
@@ -4,19 +4,32 @@ Module for screen capture, image filtering, and AI-based summarization of user a
 Functions:
     screenshot(image_path: str = "./memory/images/screen") -> Image:
         Returns the resized PIL Image object and save it in a directory
-    filter_pictures(image_dir: str = "./memory/images", threshold: int = 8) -> list:
-        Returns a list of filenames for images that are sufficiently different from their predecessor.
-    summarize_images(client: openai.OpenAI, images_paths_list: list) -> str:
-        Returns a summary of user actions with timestamps, as generated by the AI model.
+    filter_pictures(image_dir: str = "./memory/images", threshold: int = 8, keyframes: int = 8) -> list:
+        Returns a list of filenames, in chronological order, for images that are sufficiently different from the recent selected ones.
+    capture_time(path: str) -> float:
+        Returns the capture time of a screenshot from its file name (or its modification time).
+    summarize_images(client: openai.OpenAI, images_paths_list: list, name: str, ...) -> str:
+        Returns a summary of user actions with timestamps, as generated by the AI model from budgeted batches of images sent concurrently.
+    image_tokens(width: int, height: int) -> int:
+        Returns the input tokens of an image for openAI's vision models.
+    phash64(image: Image) -> int:
+        Returns the perceptual hash of an image as a 64-bit integer.
+    hamming(hash1: int, hash2: int) -> int:
+        Returns the number of different bits between two 64-bit hashes.
+For a continuous capture see 'capture.CaptureService'.
 """
 #file/directory manipulation
 import os
-import shutil
-import memory
-#image manipulation
-import mss
-from PIL import Image
-import imagehash
+import screenlog
+import tracing
+import hash_index
+import http_pool
+import threading
+from concurrent.futures import ThreadPoolExecutor
+#image manipulation (mss, PIL and imagehash are imported on first use)
+from startup import lazy_import
+import io
+import math
 import base64
 #date/time
 import re
@@ -25,7 +38,25 @@ from datetime import datetime
 import openai
 
 
-def screenshot(image_path :str = "./memory/images/screen") -> Image:
+DATE_FORMAT = "%Y-%m-%d %Hh%M %Ss %fms" #date written in the screenshot file names
+HASH_INDEX_FILE = "hash_index.npz" #hashes of the images of a folder, see 'hash_index.HashIndex'
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+def phash64(image) -> int:
+    """
+    returns the perceptual hash (imagehash.phash, 8x8 bits) of a PIL image as an int.
+    phash works on a 32x32 grayscale copy so giving it a small thumbnail gives the same hash for much less work.
+    """
+    imagehash = lazy_import("imagehash")
+    bits = imagehash.phash(image).hash.flatten()
+    return int.from_bytes(lazy_import("numpy").packbits(bits).tobytes(), "big")
+
+def hamming(hash1: int, hash2: int) -> int:
+    """number of different bits between two 64-bit hashes (same value as 'imagehash1 - imagehash2')"""
+    return (hash1 ^ hash2).bit_count()
+
+@tracing.traced("screen.screenshot")
+def screenshot(image_path :str = "./memory/images/screen") -> "Image.Image":
     try:
         os.makedirs("./memory/images")
     except:
@@ -44,6 +75,8 @@ def screenshot(image_path :str = "./memory/images/screen") -> Image:
 
     
     
+    mss = lazy_import("mss")
+    Image = lazy_import("PIL.Image")
     with mss.mss() as sct:
         # Capture the primary monitor
         monitor = sct.monitors[1]  # [1] is main screen
@@ -51,7 +84,7 @@ def screenshot(image_path :str = "./memory/images/screen") -> Image:
         
         #gets the time of when the picture was taken
         now = datetime.now()
-        date = now.strftime("%Y-%m-%d %Hh%M %Ss %fms")
+        date = now.strftime(DATE_FORMAT)
 
         # Convert to PIL image
         img = Image.frombytes("RGB", screenshot.size, screenshot.rgb)
@@ -67,110 +100,198 @@ def screenshot(image_path :str = "./memory/images/screen") -> Image:
         
         return img_resized
     
-def filter_pictures(image_dir: str = "./memory/images",threshold : int = 8) -> list:
+def capture_time(path: str) -> float:
+    """capture time of a screenshot: the date of its file name (see DATE_FORMAT), else the modification time of the file"""
+    match = re.search(r'(\d{4}-\d{2}-\d{2} \d{2}h\d{2} \d{2}s \d+ms)', os.path.basename(path))
+    if match:
+        try:
+            return datetime.strptime(match.group(1), DATE_FORMAT).timestamp()
+        except ValueError:
+            pass
+    return os.path.getmtime(path)
+
+def _hash_file(path: str) -> int:
+    Image = lazy_import("PIL.Image")
+    with Image.open(path) as img:
+        img.draft("RGB", (160, 90)) #jpeg: decodes a downscaled image directly, phash only needs 32x32
+        return phash64(img)
+
+@tracing.traced("screen.filter")
+def filter_pictures(image_dir: str = "./memory/images",threshold : int = 8, keyframes: int = 8) -> list:
     """
     Filters images in a directory by perceptual hash similarity.
-    Iterates through all images in the specified directory, computes their perceptual hash (phash),
-    and selects images that are sufficiently different from the previous image based on a hash threshold.
+    The hashes are kept in '{image_dir}/{HASH_INDEX_FILE}' so every image is only opened and hashed once across runs.
+    The images are sorted by capture time and an image is selected when it is sufficiently different from every one
+    of the last 'keyframes' selected images (a screen going back and forth between two states is only selected twice).
     Args:
         image_dir (str): Path to the directory containing images. Defaults to "./memory/images".
         threshold (int): The minimum hash difference required to consider two images as different. Defaults to 8.
+        keyframes (int): Number of previously selected images an image is compared with. Defaults to 8.
     Returns:
-        list: A list of filenames for images that are sufficiently different from their predecessor.
+        list: A list of filenames, in chronological order, for images that are sufficiently different from the recent selected ones.
     """
-    
-    filtered = []
-    prev_hash = None
-    
-    def is_different(hash1, hash2, threshold=5):
-        return abs(hash1 - hash2) > threshold
+    index = hash_index.HashIndex(f"{image_dir}/{HASH_INDEX_FILE}")
+    files = [name for name in os.listdir(image_dir) if name.lower().endswith(IMAGE_EXTENSIONS)]
+    index.prune(set(files))
+
+    new = [name for name in files if name not in index]
+    if new:
+        with ThreadPoolExecutor(max_workers=min(8, len(new))) as pool: #PIL releases the GIL while decoding
+            hashes = pool.map(_hash_file, [f"{image_dir}/{name}" for name in new])
+            for name, h in zip(new, hashes):
+                index.add(name, capture_time(f"{image_dir}/{name}"), h)
+        index.save()
+
+    names, _, hashes = index.ordered()
+    return [names[i] for i in hash_index.select_keyframes(hashes, threshold, keyframes)]
+
+SUMMARY_MODEL = "gpt-4o-mini"
+_QUALITIES = (85, 70, 55, 40) #jpeg qualities tried, best first
+
+def image_tokens(width: int, height: int) -> int:
+    """
+    input tokens of an image for openAI's vision models (detail "high"): the image is fitted in 2048x2048,
+    its shortest side scaled to 768 and it costs 85 tokens + 170 per 512x512 tile
+    """
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+def _read_frame(item, image_dir: str) -> tuple:
+    """returns (jpeg bytes, capture date, capture time) of a file name of 'image_dir' or of an in-memory 'capture.Frame'"""
+    if isinstance(item, str):
+        with open(f"{image_dir}/{item}", "rb") as f:
+            data = f.read()
+        match = re.search(r'(\d{4}-\d{2}-\d{2} \d{2}h\d{2} \d{2}s \d+ms)', item) #search the date in the image file name
+        return data, match.group(1) if match else None, capture_time(f"{image_dir}/{item}")
+    return item.jpeg, item.date, item.time
+
+def _encode_frame(data: bytes, max_side: int, max_bytes: int) -> tuple:
+    """
+    returns (jpeg bytes, width, height) of an image fitted in 'max_side' and, if possible, in 'max_bytes'.
+    The quality is lowered first, then the size. A jpeg is decoded directly at a reduced scale (PIL draft) when it is much bigger than needed.
+    """
+    Image = lazy_import("PIL.Image")
+    img = Image.open(io.BytesIO(data))
+    if max(img.size) <= max_side and len(data) <= max_bytes and img.format == "JPEG": #already fits, sent as is
+        return data, img.size[0], img.size[1]
+    img.draft("RGB", (max_side, max_side))
+    img = img.convert("RGB")
+
+    side = max_side
+    while True:
+        resized = img.copy()
+        resized.thumbnail((side, side), Image.BILINEAR, reducing_gap=2.0)
+        for quality in _QUALITIES:
+            buffer = io.BytesIO()
+            resized.save(buffer, format="JPEG", quality=quality)
+            if buffer.tell() <= max_bytes:
+                return buffer.getvalue(), resized.size[0], resized.size[1]
+        if side <= 256: #gives up on the byte budget rather than sending an unreadable image
+            return buffer.getvalue(), resized.size[0], resized.size[1]
+        side = int(side * 0.75)
+
+def _summarize_batch(client: openai.OpenAI, model: str, images: list, previous: str, part: int, parts: int) -> str:
+    first, last = images[0][1], images[-1][1]
+    span = f" Frames taken from {first} to {last}." if first and last else ""
+    text = "You are looking at a 30sec stream of someones screen, make a summary of what happened, don't add anything else just write a summary"
+    if parts > 1:
+        text += f". This is part {part}/{parts} of the stream, only summarize these images."
+    content = [{"type": "text", "text": text + span}]
+    for jpeg, _ in images:
+        img_b64 = base64.b64encode(jpeg).decode("utf-8") #encode images to b64 for openai
+        content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{img_b64}"}})
 
-    for path in os.listdir(image_dir):
-        h = imagehash.phash(Image.open(f"{image_dir}/{path}"))
-        if prev_hash is None or is_different(prev_hash, h, threshold):
-            filtered.append(path)
-        prev_hash = h
+    messages = [{"role": "user", "content": content}]
+    if previous != "":
+        messages.append({"role": "assistant", "content": [{"type": "text", "text": previous}]})
+    completion = http_pool.for_operation(client, "vision").chat.completions.create(model=model, messages=messages)
+    return completion.choices[0].message.content
 
-    return filtered
+def _merge_summaries(client: openai.OpenAI, model: str, partials: list) -> str:
+    if len(partials) == 1:
+        return partials[0]
+    parts = "\n".join(f"[part {i}]: {text}" for i, text in enumerate(partials, 1))
+    try:
+        completion = http_pool.for_operation(client, "summary").chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": "These are the summaries of consecutive parts of a 30sec stream of someones screen. "
+                                                  "Merge them into one summary, don't add anything else just write the summary.\n" + parts}],
+        )
+        return completion.choices[0].message.content
+    except Exception as e: #the partial summaries are still worth keeping
+        print(f"[WARN] could not merge the screen summaries: {e}")
+        return "\n".join(partials)
+
+def _remove_files(paths: list) -> None:
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError: #still opened or already removed, the next summary will try again
+            pass
 
-def summarize_images(client: openai.OpenAI,images_paths_list: list,name: str) -> str:
+@tracing.traced("screen.summarize")
+def summarize_images(client: openai.OpenAI,images_paths_list: list,name: str, image_dir: str = "./memory/images",
+                     max_batch_bytes: int = 4 * 1024**2, max_batch_tokens: int = 8000, max_side: int = 1024,
+                     max_concurrency: int = 4, memory_tokens: int = 1000, model: str = SUMMARY_MODEL, clean: bool = True, save: bool = True) -> str:
     """
     Summarizes a sequence of screen images by sending them to the OpenAI API for analysis.
-    Each image is encoded in base64 and sent along with its timestamp (extracted from the filename) 
-    to the AI model, which generates a concise summary of user actions observed in the images, 
-    formatted with timestamps. Images deemed not useful by the model are skipped in the summary.
-    After processing, the images directory is cleared and recreated.
+    The images are split in chronological batches that stay under 'max_batch_bytes' (base64 payload) and 'max_batch_tokens' (image tokens).
+    Every image is downscaled to 'max_side' and re-encoded with the best jpeg quality that fits its share of the batch, in a thread pool.
+    The batches are summarized concurrently and the partial summaries are merged into one.
+    After reading the images, the files of 'image_dir' are removed in a background thread.
     Args:
         client (openai.OpenAI): An initialized OpenAI API client.
-        images_paths_list (list): List of image filenames to be summarized.
+        images_paths_list (list): List of image filenames of 'image_dir' (or in-memory 'capture.Frame') to be summarized, in chronological order.
+        name (str): Name of the model, the most recent entries of its 'screenlog.ScreenLog' ('memory_tokens' at most) are given as context.
+        image_dir (str): Directory of the images. Defaults to "./memory/images".
+        max_concurrency (int): Number of batch requests sent at the same time. Defaults to 4.
+        clean (bool): Removes the image files once read. Defaults to True.
+        save (bool): Adds the summary to the screen log of the model, dated with the capture time of the first and last image. Defaults to True.
     Returns:
         str: A summary of user actions with timestamps, as generated by the AI model.
     """
-    
-    time = None
-    
-    #instructions for ai model
-    gpt_message = [
-        {
-            "role": "user",
-            "content": [
-                {
-                    "type": "text",
-                    #"text": "You are looking at a 30 sec stream of someones screen but it's cut in multiple images that represents the main changes, summarize in simples sentences what happened with moderate detail. Remember you need to add context because you are one itteration of multiple so put in '[context]:' everything that will be important because after your analysis you wiil loose memory so add everything you wish to remember inside like for exemple: 'what game he is currently playing, why did he stopped splaying, what is he working on, he switch from this game to this game. he quit playing 10min for work ago so his break had ended' ect..."
-                    "text": "You are looking at a 30sec stream of someones screen, make a summary of what happened, don't add anything else just write a summary"
-                },
-            ]
-            
-        },
-        {
-            "role": "assistant",
-            "content": [{"type": "text", "text": memory.get_memory("screenlogs",name)}]
-        },
-    ]
-    
-    nb = 0 #counter
-    for image in images_paths_list:
-        nb += 1
-        with open(f"./memory/images/{image}", "rb") as f:
-            img_b64 = base64.b64encode(f.read()).decode("utf-8") #encode images to b64 for openai
-            match = re.search(r'(\d{4}-\d{2}-\d{2} \d{2}h\d{2} \d{2}s \d+ms)', image) #search the date in the image file name
-        if match:
-            time = match.group(1)
-        # gpt_message[0]["content"].append( 
-        #     {"type": "text", "text": f"image{nb} Taken at: {time}"}, #adds context with to the image with the order and time of when it was taken
-        # )
-        #adds the image for openai model to read
-        gpt_message[0]["content"].append( 
-            {
-                
-                "type": "image_url",
-                "image_url": {"url": f"data:image/jpeg;base64,{img_b64}"}
-            }
-        )
-        
-    # deletes and remake the images folder to delete all his content
-    def dir_is_empty(path):
-        try:
-            return not any(os.scandir(path))
-        except FileNotFoundError:
-            pass
-    
-    while dir_is_empty("./memory/images") == False:
-        print("trying to remove ./memory/images")
-        try:
-            shutil.rmtree("./memory/images")
-            print("dirrectory removed successfully")
-        except:
-            print("fail")
-            continue
-    os.makedirs("./memory/images")
-    print("clean dirrectory created")
-    
-    # send request to summarize to openai api
-    completion = client.chat.completions.create(
-    model="gpt-4o-mini",
-    messages = gpt_message,
-    )
-    
-    text = completion.choices[0].message.content
-    return "\n"+text
\ No newline at end of file
+    to_remove = []
+    if clean and os.path.isdir(image_dir): #files present now, the screenshots taken during the summary are kept for the next one
+        to_remove = [f"{image_dir}/{file}" for file in os.listdir(image_dir) if file.lower().endswith(IMAGE_EXTENSIONS)]
+
+    frames = [_read_frame(item, image_dir) for item in images_paths_list]
+    if clean:
+        threading.Thread(target=_remove_files, args=(to_remove,), daemon=True).start()
+    if not frames:
+        return ""
+
+    #share of a batch given to every image
+    per_image_tokens = image_tokens(max_side, max_side * 9 // 16)
+    per_batch = max(1, min(len(frames), max_batch_tokens // per_image_tokens))
+    per_batch = math.ceil(len(frames) / math.ceil(len(frames) / per_batch)) #same number of images in every batch
+    per_image_bytes = max_batch_bytes * 3 // 4 // per_batch #base64 is 4/3 bigger
+
+    with tracing.span("screen.encode", images=len(frames)), ThreadPoolExecutor(max_workers=min(8, len(frames))) as pool: #PIL releases the GIL while decoding and encoding
+        encoded = list(pool.map(lambda frame: _encode_frame(frame[0], max_side, per_image_bytes), frames))
+
+    batches = []
+    batch, batch_bytes, batch_tokens = [], 0, 0
+    for (jpeg, width, height), (_, date, _) in zip(encoded, frames):
+        size = (len(jpeg) + 2) // 3 * 4
+        tokens = image_tokens(width, height)
+        if batch and (len(batch) >= per_batch or batch_bytes + size > max_batch_bytes or batch_tokens + tokens > max_batch_tokens):
+            batches.append(batch)
+            batch, batch_bytes, batch_tokens = [], 0, 0
+        batch.append((jpeg, date))
+        batch_bytes += size
+        batch_tokens += tokens
+    batches.append(batch)
+
+    log = screenlog.get_log(name, client)
+    previous = log.prompt(memory_tokens)
+    with tracing.span("screen.requests", batches=len(batches)), ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(batches)))) as pool:
+        futures = [pool.submit(_summarize_batch, client, model, images, previous, i, len(batches)) for i, images in enumerate(batches, 1)]
+        partials = [future.result() for future in futures]
+
+    text = _merge_summaries(client, model, partials)
+    if save:
+        log.add(text, frames[0][2], frames[-1][2])
+    return "\n"+text
@@ -0,0 +1,298 @@
+"""
+Structured, time indexed store of the screen summaries of a model ('./memory/{name}Screen.jsonl').
+Every summary is one entry (start, end, level, text). The entries are kept sorted by time so a time range is found with a binary search
+instead of reading the whole log, and the old entries are rolled up into coarser digests so the log (and the prompts built from it) stay bounded:
+    - "entry": one summary of 'summarize_images', kept for 'entry_retention' seconds,
+    - "hour": digest of the entries of one hour, kept for 'hour_retention' seconds,
+    - "day": digest of the hours of one day, kept forever (one line per day).
+Classes:
+    - ScreenLog:
+        The log of one model.
+Functions:
+    - get_log(name: str) -> ScreenLog:
+        Returns the shared ScreenLog of a model, opening it on first use.
+    - close_log(name: str) -> None:
+        Closes the log of a model and drops it from the cache.
+"""
+
+import os
+import json
+import time
+import threading
+from datetime import datetime
+import numpy as np
+import context
+import http_pool
+
+#imports---------------------------------------------------------------
+
+LEVELS = ("entry", "hour", "day")
+
+class ScreenLog:
+    """
+    Time indexed screen summaries of a model, rolled up into hourly and daily digests.\n
+    New entries are appended to the file, it is only rewritten by a rollup. Digests are written by 'client' ('model') when given,
+    else they are the concatenation of the rolled up texts cut to 'digest_chars'.\n
+    exemple_ | log = ScreenLog("./memory/tetoScreen.jsonl") | log.add(text,start,end) | log.last(600) | log.between(t1,t2) | log.prompt(1000)
+    """
+    def __init__(self, path: str, client=None, model: str = "gpt-4o-mini", entry_retention: float = 6 * 3600,
+                 hour_retention: float = 7 * 24 * 3600, digest_chars: int = 2000):
+        self.path = path
+        self.client = client
+        self.model = model
+        self.entry_retention = entry_retention
+        self.hour_retention = hour_retention
+        self.digest_chars = digest_chars
+
+        self._lock = threading.Lock()
+        self._entries = [] #dicts {"start","end","level","text"} sorted by start
+        self._starts = np.empty(0, dtype=np.float64) #time index of '_entries'
+        self._ends = np.empty(0, dtype=np.float64) #running max of the ends, for the range queries
+        self._rollup = None #running rollup thread
+        self._next_due = float("inf") #time of the next rollup
+        self._load()
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def _load(self) -> None:
+        directory = os.path.dirname(self.path)
+        if directory != "":
+            os.makedirs(directory, exist_ok=True)
+        entries = []
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError: #half written line of a crash
+                        pass
+        except FileNotFoundError:
+            pass
+        entries.sort(key=lambda entry: entry["start"])
+        self._entries = entries
+        self._reindex()
+
+    def _reindex(self) -> None:
+        self._starts = np.array([entry["start"] for entry in self._entries], dtype=np.float64)
+        self._ends = np.maximum.accumulate(np.array([entry["end"] for entry in self._entries], dtype=np.float64)) if self._entries else np.empty(0, dtype=np.float64)
+        self._next_due = min((self._due_time(entry) for entry in self._entries), default=float("inf"))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    #----------------------------------writes-----------------------------------------
+
+    def add(self, text: str, start: float = None, end: float = None) -> None:
+        """adds a summary of the screen between 'start' and 'end' (time.time(), both default to now)"""
+        text = text.strip()
+        if text == "":
+            return
+        end = time.time() if end is None else end
+        start = end if start is None else start
+        entry = {"start": start, "end": end, "level": "entry", "text": text}
+        with self._lock:
+            self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self._file.flush()
+            if self._entries and start < self._entries[-1]["start"]: #out of order, rare
+                self._entries.append(entry)
+                self._entries.sort(key=lambda entry: entry["start"])
+                self._reindex()
+            else:
+                self._entries.append(entry)
+                self._starts = np.append(self._starts, start)
+                self._ends = np.append(self._ends, max(end, self._ends[-1]) if len(self._ends) else end)
+                self._next_due = min(self._next_due, self._due_time(entry))
+        self.rollup(wait=False)
+
+    def close(self) -> None:
+        self.wait()
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+    #----------------------------------reads------------------------------------------
+
+    def between(self, start: float, end: float, levels: tuple = LEVELS) -> list:
+        """entries (copies) that overlap [start, end], oldest first"""
+        with self._lock:
+            first = int(np.searchsorted(self._ends, start, side="left")) #first entry that may end after 'start'
+            stop = int(np.searchsorted(self._starts, end, side="right"))
+            return [dict(entry) for entry in self._entries[first:stop] if entry["end"] >= start and entry["level"] in levels]
+
+    def last(self, seconds: float, levels: tuple = LEVELS) -> list:
+        """entries of the last 'seconds' seconds"""
+        now = time.time()
+        return self.between(now - seconds, now, levels)
+
+    def prompt(self, max_tokens: int = 1000) -> str:
+        """
+        the most recent entries that fit in 'max_tokens', as dated lines, oldest first.
+        The old days and hours come as their digests, so a few lines cover a long time.
+        """
+        with self._lock:
+            entries = list(self._entries)
+        lines = []
+        left = max_tokens
+        for entry in reversed(entries):
+            line = f"[{_format_time(entry)}]: {entry['text']}\n"
+            tokens = context.count_tokens(line)
+            if tokens > left:
+                break
+            left -= tokens
+            lines.append(line)
+        return "".join(reversed(lines))
+
+    #----------------------------------rollups----------------------------------------
+
+    def rollup(self, now: float = None, wait: bool = True) -> None:
+        """
+        folds the entries older than 'entry_retention' into hourly digests and the hours older than 'hour_retention' into daily digests.
+        With 'wait=False' it runs in a background thread, and only when something is due.
+        """
+        now = time.time() if now is None else now
+        if not self._due(now):
+            return
+        if wait:
+            self.wait()
+            self._roll(now)
+            return
+        if self._rollup is not None and self._rollup.is_alive():
+            return
+        self._rollup = threading.Thread(target=self._roll, args=(now,), daemon=True)
+        self._rollup.start()
+
+    def wait(self, timeout: float = None) -> None:
+        """waits for the running rollup, if any"""
+        thread = self._rollup
+        if thread is not None:
+            thread.join(timeout)
+
+    def _due(self, now: float) -> bool:
+        """True when a whole hour (or day) is past its retention, so a rollup makes at least one digest"""
+        return now >= self._next_due
+
+    def _due_time(self, entry: dict) -> float:
+        """time from which the bucket of an entry can be rolled up"""
+        if entry["level"] == "entry":
+            return _bucket(entry["start"], "hour") + 3600 + self.entry_retention
+        if entry["level"] == "hour":
+            return _bucket(entry["start"], "day") + 24 * 3600 + self.hour_retention
+        return float("inf")
+
+    def _roll(self, now: float) -> None:
+        try:
+            with self._lock:
+                snapshot = list(self._entries)
+            #the digests are written without the lock, 'add' keeps working meanwhile
+            entries = self._fold(snapshot, "entry", "hour", now - self.entry_retention)
+            entries = self._fold(entries, "hour", "day", now - self.hour_retention)
+            with self._lock:
+                seen = {id(entry) for entry in snapshot}
+                entries += [entry for entry in self._entries if id(entry) not in seen] #added during the rollup
+                entries.sort(key=lambda entry: entry["start"])
+                self._write(entries)
+        except Exception as e:
+            print(f"[WARN] could not roll up the screen log: {e}")
+
+    def _fold(self, entries: list, level: str, into: str, before: float) -> list:
+        """replaces the 'level' entries of the buckets ('into' long) that ended before 'before' by one digest per bucket"""
+        length = 3600 if into == "hour" else 24 * 3600
+        groups = {}
+        for entry in entries:
+            if entry["level"] == level:
+                bucket = _bucket(entry["start"], into)
+                if bucket + length <= before:
+                    groups.setdefault(bucket, []).append(entry)
+        if not groups:
+            return entries
+        for entry in entries: #a digest already written for the bucket is folded again with the late entries
+            if entry["level"] == into and _bucket(entry["start"], into) in groups:
+                groups[_bucket(entry["start"], into)].append(entry)
+        for group in groups.values():
+            group.sort(key=lambda entry: entry["start"])
+        folded = {id(entry) for group in groups.values() for entry in group}
+        result = [entry for entry in entries if id(entry) not in folded]
+        for bucket, group in groups.items():
+            result.append({"start": group[0]["start"], "end": max(entry["end"] for entry in group), "level": into, "text": self._digest(group, into)})
+        result.sort(key=lambda entry: entry["start"])
+        return result
+
+    def _digest(self, group: list, level: str) -> str:
+        texts = "\n".join(f"[{_format_time(entry)}]: {entry['text']}" for entry in group)
+        if self.client is not None:
+            try:
+                completion = http_pool.for_operation(self.client,"summary").chat.completions.create(
+                    model=self.model,
+                    messages=[{"role": "user", "content": f"These are the summaries of someones screen during one {level}. "
+                                                          "Merge them into one short summary of what they did, keep names of apps, games and projects, "
+                                                          "don't add anything else just write the summary.\n" + texts}],
+                )
+                return completion.choices[0].message.content.strip()[:self.digest_chars]
+            except Exception as e: #falls back to the plain text
+                print(f"[WARN] could not write the screen digest: {e}")
+        return " ".join(entry["text"] for entry in group)[:self.digest_chars]
+
+    def _write(self, entries: list) -> None:
+        """replaces the file by 'entries' (called with the lock)"""
+        temp = f"{self.path}.tmp"
+        with open(temp, "w", encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._file.close()
+        os.replace(temp, self.path)
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._entries = entries
+        self._reindex()
+
+def _bucket(timestamp: float, level: str) -> float:
+    """start of the hour or of the day (local time) of a timestamp"""
+    date = datetime.fromtimestamp(timestamp)
+    date = date.replace(minute=0, second=0, microsecond=0)
+    if level == "day":
+        date = date.replace(hour=0)
+    return date.timestamp()
+
+def _format_time(entry: dict) -> str:
+    start = datetime.fromtimestamp(entry["start"])
+    if entry["level"] == "day":
+        return start.strftime("%Y-%m-%d")
+    if entry["level"] == "hour":
+        return start.strftime("%Y-%m-%d %Hh")
+    return start.strftime("%Y-%m-%d %Hh%M %Ss")
+
+_logs = {}
+_logs_lock = threading.Lock()
+
+def _log_path(name: str) -> str:
+    return f"./memory/{name}Screen.jsonl"
+
+def get_log(name: str = None, client=None) -> ScreenLog:
+    """returns the shared ScreenLog of a model, opening it on first use. 'client' is used for the digests"""
+    assert name != None and name != "", "missing model name"
+    path = _log_path(name)
+    with _logs_lock:
+        log = _logs.get(path)
+        if log is None:
+            new = not os.path.exists(path)
+            log = ScreenLog(path, client)
+            if new:
+                _import_legacy(log, f"./memory/{name}Screen.txt")
+            _logs[path] = log
+        elif client is not None and log.client is None:
+            log.client = client
+        return log
+
+def _import_legacy(log: ScreenLog, legacy_path: str) -> None:
+    """keeps the end of an old plain text screen memory as one entry dated with the file"""
+    try:
+        with open(legacy_path, "r", encoding="utf-8", errors="replace") as f:
+            text = f.read()
+        date = os.path.getmtime(legacy_path)
+    except OSError:
+        return
+    log.add(text[-log.digest_chars:], date, date)
+
+def close_log(name: str) -> None:
+    with _logs_lock:
+        log = _logs.pop(_log_path(name), None)
+    if log is not None:
+        log.close()
@@ -0,0 +1,335 @@
+"""
+HTTP + WebSocket server that hosts the characters of './settings' for many users at the same time.
+Every session gets its own AsyncModel and its own memory folder ('./memory/sessions/{session}/'), so users never see nor delete each other's history.
+Routes:
+    - POST   /sessions                   {"character": "teto"}     -> {"session": id}
+    - POST   /sessions/{session}/messages {"message": "hi"}         -> {"reply": text}
+    - WS     /sessions/{session}/stream   send {"message": "hi", "voice": true}, receive:
+                {"type": "text", "delta": str}                                  for every text delta
+                {"type": "audio", "text": str, "sr": int, "samples": int}      followed by a binary frame of float32 little-endian samples
+                {"type": "done"} at the end of the turn, {"type": "error", "detail": str} on failure
+                a message sent while a turn is running interrupts it: {"type": "cancelled"}, then the new turn starts
+    - DELETE /sessions/{session}                                          deletes the session and its memory
+    - GET    /metrics   p50/p95/p99 of the traced stages (Prometheus text), GET /latency the same in json (run with --trace),
+                        plus the queued turns and the cancelled ones (always on)
+Limits:
+    - a session without a turn nor a websocket for 'session_ttl' seconds expires: its memory files are closed and deleted (404 afterwards).
+    - 'per_session_limit' turns at the same time per session, the next ones are refused (429 / error event).
+    - 'max_concurrent_turns' turns at the same time on the server, the next ones wait for a slot (backpressure)
+      and are refused (503) once 'max_queued' of them are waiting.
+Usage:
+    python server.py --port 8000 [--voice] [--rvc-workers 1 --rvc-device cuda:0]
+    With --voice rvc runs in '--rvc-workers' worker processes ('rvc_service.py'), 0 runs it in the server process.
+    Set OPENAI_BASE_URL to test against a local stand-in of the openAI api.
+"""
+
+import re
+import json
+import time
+import asyncio
+import secrets
+import argparse
+import numpy as np
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel
+import memory
+import audio_cache
+import tracing
+import rvc_converter
+import turn_runtime
+import rate_limits
+from model import AsyncModel
+
+#imports---------------------------------------------------------------
+
+class NewSession(BaseModel):
+    character: str
+
+class Message(BaseModel):
+    message: str
+
+class Busy(Exception):
+    """raised when a turn is refused because of a limit, 'status' is the http status to send"""
+    def __init__(self, status: int, detail: str):
+        super().__init__(detail)
+        self.status = status
+        self.detail = detail
+
+class Session:
+    def __init__(self, session_id: str, character: str, model: AsyncModel, limit: int):
+        self.id = session_id
+        self.character = character
+        self.model = model
+        self.limit = limit
+        self.running = 0 #turns running for this session
+        self.connections = 0 #open websockets
+        self.last_used = time.time()
+
+    def idle(self, now: float) -> float:
+        """seconds since the session was last used, 0 while a turn or a websocket is using it"""
+        if self.running > 0 or self.connections > 0:
+            return 0.0
+        return now - self.last_used
+
+class SessionManager:
+    """
+    Keeps the sessions and enforces the turn limits.\n
+    exemple_ | async with manager.turn(session): ...
+    """
+    def __init__(self, settings_dir: str = "./settings", voice: bool = False, max_sessions: int = 1000,
+                 per_session_limit: int = 1, max_concurrent_turns: int = 64, max_queued: int = 256, key_check_ttl: float = 24 * 3600,
+                 session_ttl: float = 3600.0, sweep_interval: float = 60.0):
+        self.settings_dir = settings_dir
+        self.voice = voice
+        self.max_sessions = max_sessions
+        self.session_ttl = session_ttl #0 keeps the sessions until they are deleted
+        self.sweep_interval = sweep_interval
+        self.per_session_limit = per_session_limit
+        self.max_queued = max_queued
+        self.key_check_ttl = key_check_ttl
+
+        self.sessions = {}
+        self._slots = asyncio.Semaphore(max_concurrent_turns)
+        self._queued = 0
+        self._warm = set() #characters whose rvc voice was already warmed up
+        self._swept = time.time()
+        self.expired = 0
+
+    async def expire_idle(self, force: bool = False) -> int:
+        """
+        deletes the sessions idle for more than 'session_ttl' seconds (at most once per 'sweep_interval' unless 'force')
+        so their memory files do not stay open, returns how many expired
+        """
+        now = time.time()
+        if self.session_ttl <= 0 or (not force and now - self._swept < self.sweep_interval):
+            return 0
+        self._swept = now
+        idle = [session for session in self.sessions.values() if session.idle(now) > self.session_ttl]
+        for session in idle:
+            self.sessions.pop(session.id, None)
+            await asyncio.to_thread(memory.delete_memory, session.model.memory_name) #closes its stores
+        self.expired += len(idle)
+        return len(idle)
+
+    async def create(self, character: str) -> Session:
+        if not re.fullmatch(r"[A-Za-z0-9_-]{1,64}", character):
+            raise HTTPException(400, "invalid character name")
+        await self.expire_idle(force=len(self.sessions) >= self.max_sessions) #a new session needs file descriptors too
+        if len(self.sessions) >= self.max_sessions:
+            raise HTTPException(503, "too many sessions")
+        settings_file = f"{self.settings_dir}/{character}.json"
+        session_id = secrets.token_urlsafe(12)
+        try:
+            model = await AsyncModel.create(settings_file, key_check_ttl=self.key_check_ttl, session=session_id)
+        except AssertionError as e:
+            raise HTTPException(404 if "does not exist" in str(e) else 502, str(e))
+        if self.voice:
+            await model.load_model(warmup=character not in self._warm)
+            self._warm.add(character)
+        session = Session(session_id, character, model, self.per_session_limit)
+        self.sessions[session_id] = session
+        return session
+
+    def get(self, session_id: str) -> Session:
+        session = self.sessions.get(session_id)
+        if session is None:
+            raise HTTPException(404, "unknown session")
+        return session
+
+    async def delete(self, session_id: str) -> None:
+        session = self.sessions.pop(session_id, None)
+        if session is None:
+            raise HTTPException(404, "unknown session")
+        await asyncio.to_thread(memory.delete_memory, session.model.memory_name)
+
+    def turn(self, session: Session):
+        return _Turn(self, session)
+
+class _Turn:
+    """one turn of a session: takes a session slot right away (or refuses) then waits for a server slot"""
+    def __init__(self, manager: SessionManager, session: Session):
+        self.manager = manager
+        self.session = session
+
+    async def __aenter__(self):
+        if self.session.running >= self.session.limit:
+            raise Busy(429, "a turn is already running for this session")
+        if self.manager._queued >= self.manager.max_queued:
+            raise Busy(503, "server is busy, try again later")
+        self.session.running += 1
+        self.manager._queued += 1
+        try:
+            await self.manager._slots.acquire()
+        except BaseException:
+            self.session.running -= 1
+            raise
+        finally:
+            self.manager._queued -= 1
+        self.session.last_used = time.time()
+        return self.session.model
+
+    async def __aexit__(self, *exc):
+        self.manager._slots.release()
+        self.session.running -= 1
+
+INVALID_REQUEST = 'invalid request, expected a json object like {"message": "hi", "voice": true}'
+
+async def _receive_text(websocket: WebSocket) -> str:
+    """next frame of the websocket as text ("" for a binary frame), raises WebSocketDisconnect when the client is gone"""
+    frame = await websocket.receive()
+    if frame["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(frame.get("code", 1000))
+    return frame.get("text") or ""
+
+def _parse_request(text: str) -> dict:
+    """the request of a websocket frame, None if it is not a json object with a text "message" (or none)"""
+    try:
+        request = json.loads(text)
+    except ValueError:
+        return None
+    if not isinstance(request, dict) or not isinstance(request.get("message", ""), str):
+        return None
+    return request
+
+def create_app(manager: SessionManager = None) -> FastAPI:
+    manager = SessionManager() if manager is None else manager
+    app = FastAPI(title="Ai girlfriend")
+    app.state.manager = manager
+
+    @app.get("/health")
+    async def health():
+        await manager.expire_idle()
+        return {"sessions": len(manager.sessions), "expired_sessions": manager.expired, "queued": manager._queued, "audio_cache": audio_cache.get_cache().stats(),
+                "rate_limits": rate_limits.get_limiter().stats()}
+
+    @app.get("/metrics", response_class=PlainTextResponse)
+    async def metrics():
+        queued = ["# HELP ai_girlfriend_turns_queued turns waiting for a server slot", "# TYPE ai_girlfriend_turns_queued gauge",
+                  f"ai_girlfriend_turns_queued {manager._queued}"]
+        return tracing.prometheus_text() + turn_runtime.get_runtime().prometheus_text() + "\n".join(queued) + "\n"
+
+    @app.get("/latency")
+    async def latency():
+        return {"enabled": tracing.is_enabled(), "spans": tracing.rollups()}
+
+    @app.post("/sessions")
+    async def new_session(body: NewSession):
+        session = await manager.create(body.character)
+        return {"session": session.id, "character": session.character}
+
+    @app.post("/sessions/{session_id}/messages")
+    async def send_message(session_id: str, body: Message):
+        session = manager.get(session_id)
+        if body.message == "":
+            raise HTTPException(400, "missing message")
+        try:
+            async with manager.turn(session) as model:
+                reply = await model.chat(body.message)
+        except Busy as e:
+            raise HTTPException(e.status, e.detail)
+        return {"reply": reply}
+
+    @app.delete("/sessions/{session_id}")
+    async def delete_session(session_id: str):
+        await manager.delete(session_id)
+        return {"deleted": session_id}
+
+    @app.websocket("/sessions/{session_id}/stream")
+    async def stream(websocket: WebSocket, session_id: str):
+        session = manager.sessions.get(session_id)
+        if session is None:
+            await websocket.close(code=4404)
+            return
+        await websocket.accept()
+
+        async def run_turn(message: str, voice: bool) -> None:
+            try:
+                async with manager.turn(session) as model:
+                    if voice:
+                        async for event in model.stream_chat_voice(message):
+                            if event["type"] == "text":
+                                await websocket.send_json(event)
+                            else: #every send waits for the socket, a slow client slows its own turn down
+                                audio = np.ascontiguousarray(event["audio"], dtype="<f4")
+                                await websocket.send_json({"type": "audio", "text": event["text"], "sr": event["sr"], "samples": len(audio)})
+                                await websocket.send_bytes(audio.tobytes())
+                    else:
+                        async for delta in model.stream_chat(message):
+                            await websocket.send_json({"type": "text", "delta": delta})
+                await websocket.send_json({"type": "done"})
+            except Busy as e:
+                await websocket.send_json({"type": "error", "detail": e.detail})
+            except (WebSocketDisconnect, asyncio.CancelledError):
+                raise
+            except Exception as e:
+                await websocket.send_json({"type": "error", "detail": str(e)})
+
+        #the socket is read while a turn runs, so a new message (or a disconnect) interrupts it
+        session.connections += 1
+        receive = asyncio.ensure_future(_receive_text(websocket))
+        turn = None
+        try:
+            while True:
+                request = _parse_request(await receive)
+                receive = asyncio.ensure_future(_receive_text(websocket))
+                if request is None:
+                    await websocket.send_json({"type": "error", "detail": INVALID_REQUEST})
+                    continue
+                message = request.get("message", "")
+                if message == "":
+                    await websocket.send_json({"type": "error", "detail": "missing message"})
+                    continue
+                turn = asyncio.ensure_future(run_turn(message, bool(request.get("voice", False))))
+                while True:
+                    await asyncio.wait([turn, receive], return_when=asyncio.FIRST_COMPLETED)
+                    if turn.done() or receive.exception() is not None or _parse_request(receive.result()) is not None:
+                        break
+                    await websocket.send_json({"type": "error", "detail": INVALID_REQUEST}) #a bad frame does not interrupt the turn
+                    receive = asyncio.ensure_future(_receive_text(websocket))
+                if turn.done():
+                    turn.result() #raises the disconnect
+                    continue
+                cancelled = time.perf_counter()
+                turn.cancel()
+                await asyncio.wait([turn]) #the stream, tts and rvc of the turn are stopped
+                turn_runtime.get_runtime().record_cancel(time.perf_counter() - cancelled)
+                if receive.exception() is None: #a new message, not a disconnect
+                    await websocket.send_json({"type": "cancelled"})
+        except WebSocketDisconnect:
+            pass
+        finally:
+            session.connections -= 1
+            session.last_used = time.time()
+            receive.cancel()
+            if turn is not None and not turn.done():
+                turn.cancel()
+
+    return app
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="serves the characters of ./settings over http and websocket")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--settings-dir", default="./settings")
+    parser.add_argument("--voice", action="store_true", help="converts the voice with rvc (needs the models in ./models)")
+    parser.add_argument("--rvc-workers", type=int, default=1, help="rvc worker processes with --voice, 0 converts in the server process")
+    parser.add_argument("--rvc-device", default="cuda:0", help="torch device of the rvc workers (cpu with one worker per core)")
+    parser.add_argument("--max-sessions", type=int, default=1000)
+    parser.add_argument("--per-session-limit", type=int, default=1)
+    parser.add_argument("--max-concurrent-turns", type=int, default=64)
+    parser.add_argument("--max-queued", type=int, default=256)
+    parser.add_argument("--session-ttl", type=float, default=3600, help="seconds before an idle session expires, 0: never")
+    parser.add_argument("--trace", nargs="?", const="./memory/traces.jsonl", default=None, help="records the latency of every stage (jsonl file)")
+    args = parser.parse_args()
+    if args.trace is not None:
+        tracing.enable(args.trace)
+    if args.voice and args.rvc_workers > 0:
+        rvc_converter.start_service(args.rvc_workers, args.rvc_device)
+        AsyncModel.configure_rvc(args.rvc_workers) #one waiting thread per worker
+
+    manager = SessionManager(args.settings_dir, args.voice, args.max_sessions, args.per_session_limit, args.max_concurrent_turns, args.max_queued,
+                             session_ttl=args.session_ttl)
+    uvicorn.run(create_app(manager), host=args.host, port=args.port) #one worker: the sessions live in this process
@@ -0,0 +1,77 @@
+"""
+This module keeps track of the startup time of the program and imports the heavy libraries (audio, vision, rvc) only when they are first used.
+Functions:
+    - timed(label: str):
+        Context manager that records how long a startup step took.
+    - lazy_import(name: str):
+        Imports a module the first time it is needed and records how long the import took.
+    - report(as_json: bool = False) -> str:
+        Returns the recorded steps as a table (or as json) so startup regressions show up.
+Usage:
+    python startup.py ./settings/teto.json          -> times 'import model' and 'Model(...)' and prints the report
+    python startup.py ./settings/teto.json --voice  -> also times the rvc model loading
+    python startup.py ./settings/teto.json --json   -> prints the report as json
+"""
+
+import sys
+import time
+import json
+import importlib
+from contextlib import contextmanager
+
+#imports---------------------------------------------------------------
+
+_timings = [] #(label, seconds) in the order they finished
+
+@contextmanager
+def timed(label: str):
+    """
+    records the time spent in the 'with' block under 'label'\n
+    exemple_ | with timed("openai settings"): ...
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _timings.append((label, time.perf_counter() - start))
+
+def lazy_import(name: str):
+    """
+    returns the module 'name', importing it on first use. Only the first import is timed, the next calls are a dict lookup.\n
+    exemple_ | sounddevice = lazy_import("sounddevice")
+    """
+    module = sys.modules.get(name)
+    if module is not None and not getattr(getattr(module, "__spec__", None), "_initializing", False): #another thread may still be importing it
+        return module
+    with timed(f"import {name}"):
+        return importlib.import_module(name)
+
+def timings() -> list:
+    """returns a copy of the recorded (label, seconds)"""
+    return list(_timings)
+
+def report(as_json: bool = False) -> str:
+    """returns the recorded steps, slowest first"""
+    steps = sorted(_timings, key=lambda step: step[1], reverse=True)
+    if as_json:
+        return json.dumps([{"step": label, "seconds": round(seconds, 4)} for label, seconds in steps], indent=2)
+    width = max([len(label) for label, _ in steps] + [4])
+    lines = [f"{'step':<{width}}  seconds", f"{'-' * width}  -------"]
+    lines += [f"{label:<{width}}  {seconds:7.3f}" for label, seconds in steps]
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python startup.py <settings.json> [--voice] [--json]")
+        sys.exit(1)
+
+    with timed("total startup"):
+        with timed("import model"):
+            from model import Model
+        with timed("Model()"):
+            character = Model(sys.argv[1])
+        if "--voice" in sys.argv:
+            with timed("Model.load_model()"):
+                character.load_model()
+
+    print(report(as_json="--json" in sys.argv))
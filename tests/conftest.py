@@ -0,0 +1,49 @@
+"""
+Tests of the project, run with 'python -m pytest tests' from the root of the repository.
+They never touch the network, the gpu nor the real './memory': the openAI api is 'fake_openai.FakeOpenAI'
+and every test that writes files runs in its own temporary folder (see 'workdir').
+"""
+
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) #the modules are at the root
+
+#imports---------------------------------------------------------------
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """runs the test in an empty folder, './memory' and the caches are created there"""
+    import memory
+    monkeypatch.chdir(tmp_path)
+    yield tmp_path
+    memory._close_all_stores() #the stores are shared by relative path, the next test must not reuse them
+
+@pytest.fixture(scope="session")
+def fake_api():
+    """one fake openAI server for the whole run, every client of 'http_pool' goes to it (its clients are cached per key)"""
+    from fake_openai import FakeOpenAI
+    with FakeOpenAI(first_token_delay=0.02, token_interval=0.001, tts_delay=0.01, chat_delay=0.01) as fake:
+        previous = os.environ.get("OPENAI_BASE_URL")
+        os.environ["OPENAI_BASE_URL"] = fake.base_url
+        yield fake
+        if previous is None:
+            os.environ.pop("OPENAI_BASE_URL", None)
+        else:
+            os.environ["OPENAI_BASE_URL"] = previous
+
+@pytest.fixture
+def settings(workdir, fake_api):
+    """a character settings file for the fake api, in the test folder"""
+    import json
+    settings = {
+        "model_files": {"name": "tester.pth", "index": ""},
+        "model_settings": {"openAI_text_model": "gpt-5", "streaming": True, "reasoning": "minimal", "context_tokens": 4000, "recall_turns": 4},
+        "model_description": {"description": ["You are a test."], "voice_description": ["calm"]},
+        "user": {"openAI_apiKey": "fake"},
+    }
+    os.makedirs("./settings", exist_ok=True)
+    with open("./settings/tester.json", "w") as f:
+        json.dump(settings, f)
+    return "./settings/tester.json"
@@ -0,0 +1,45 @@
+"""AsyncModel turns against the fake openAI server"""
+
+import asyncio
+import numpy as np
+import pytest
+from model import AsyncModel
+
+#imports---------------------------------------------------------------
+
+def _stub(audio, sr, voice=None):
+    return np.asarray(audio, dtype=np.float32), sr
+
+async def _turn(model, message: str) -> list:
+    return [event async for event in model.stream_chat_voice(message)]
+
+def test_stream_chat_voice_delivers_every_sentence_in_order(settings):
+    async def run():
+        model = await AsyncModel.create(settings, key_check_ttl=0)
+        model.audio_cache = None
+        model.convert = _stub
+        return await asyncio.wait_for(_turn(model, "hi"), 30)
+    events = asyncio.run(run())
+    text = "".join(event["delta"] for event in events if event["type"] == "text")
+    spoken = [event["text"] for event in events if event["type"] == "audio"]
+    assert spoken and " ".join(" ".join(spoken).split()) == " ".join(text.split())
+
+def test_stream_chat_voice_raises_a_failed_voice_instead_of_hanging(settings):
+    """the reply has many more sentences than 'max_pending': the failure must stop the turn, not block the producer"""
+    calls = []
+    def failing(audio, sr, voice=None):
+        calls.append(1)
+        if len(calls) == 2:
+            raise RuntimeError("rvc failed")
+        return _stub(audio, sr)
+
+    async def run():
+        model = await AsyncModel.create(settings, key_check_ttl=0, max_pending=1)
+        model.audio_cache = None
+        model.convert = failing
+        with pytest.raises(RuntimeError, match="rvc failed"):
+            await asyncio.wait_for(_turn(model, "tell me a long story"), 30)
+        #the next turn of the session still works
+        events = await asyncio.wait_for(_turn(model, "hi"), 30)
+        assert events[-1]["type"] == "audio"
+    asyncio.run(run())
@@ -0,0 +1,69 @@
+"""AudioCache keys, tiers and sample rate changes, and when the voice pipeline uses it"""
+
+import os
+import glob
+import numpy as np
+import audio_cache
+
+#imports---------------------------------------------------------------
+
+def _files(directory):
+    return sorted(glob.glob(os.path.join(directory, "*", "*.npy")))
+
+def test_key_ignores_whitespace_and_tells_voices_apart():
+    key = audio_cache.audio_key("Hello  there ", "tts-1", "nova", "calm", ("a.pth", ""))
+    assert key == audio_cache.audio_key("Hello there", "tts-1", "nova", "calm", ("a.pth", ""))
+    assert key != audio_cache.audio_key("Hello there", "tts-1", "nova", "calm", ("b.pth", ""))
+    assert key != audio_cache.audio_key("Hello there", "tts-1", "nova", "calm", None)
+    assert key != audio_cache.audio_key("Hello there", "tts-1", "nova", "cheerful", ("a.pth", ""))
+
+def test_put_get_and_reopen(workdir):
+    cache = audio_cache.AudioCache("./cache")
+    key = audio_cache.audio_key("hi", "tts-1", "nova", "", None)
+    assert cache.get(key) is None
+    audio = np.arange(100, dtype=np.float32)
+    cache.put(key, audio, 24000)
+    assert cache.get(key)[1] == 24000 and cache.stats()["hits_hot"] == 1
+
+    reopened = audio_cache.AudioCache("./cache")
+    got, sr = reopened.get(key)
+    assert sr == 24000 and np.array_equal(got, audio) and reopened.stats()["hits_disk"] == 1
+
+def test_rate_change_replaces_the_old_file(workdir):
+    cache = audio_cache.AudioCache("./cache")
+    key = audio_cache.audio_key("hi", "tts-1", "nova", "", None)
+    cache.put(key, np.zeros(100, dtype=np.float32), 24000)
+    cache.put(key, np.zeros(200, dtype=np.float32), 40000)
+    assert [os.path.basename(path) for path in _files("./cache")] == [f"{key}_40000.npy"]
+    assert cache.stats()["disk_entries"] == 1 and cache.stats()["disk_bytes"] == os.path.getsize(_files("./cache")[0])
+
+def test_scan_keeps_the_newest_rate(workdir):
+    cache = audio_cache.AudioCache("./cache")
+    key = audio_cache.audio_key("hi", "tts-1", "nova", "", None)
+    cache.put(key, np.zeros(100, dtype=np.float32), 24000)
+    old = _files("./cache")[0]
+    newer = old.replace("_24000", "_40000")
+    np.save(newer, np.zeros(200, dtype=np.float32))
+    os.utime(old, (1, 1)) #left behind by an older run
+
+    reopened = audio_cache.AudioCache("./cache")
+    assert _files("./cache") == [newer] and reopened.get(key)[1] == 40000
+
+def test_disk_tier_evicts_the_least_recently_used(workdir):
+    audio = np.zeros(1000, dtype=np.float32)
+    cache = audio_cache.AudioCache("./cache", max_bytes=int(audio.nbytes * 2.5), hot_bytes=0)
+    keys = [audio_cache.audio_key(f"line {i}", "tts-1", "nova", "", None) for i in range(3)]
+    cache.put(keys[0], audio, 24000)
+    cache.put(keys[1], audio, 24000)
+    assert cache.get(keys[0]) is not None #keys[1] is now the oldest
+    cache.put(keys[2], audio, 24000)
+    assert cache.get(keys[1]) is None and cache.get(keys[0]) is not None and cache.get(keys[2]) is not None
+
+def test_pipeline_skips_the_cache_with_a_custom_convert(workdir):
+    from voice_pipeline import VoicePipeline
+    cache = audio_cache.AudioCache("./cache")
+    default = VoicePipeline(object(), "calm", "test", cache=cache, play=False, voice=("a.pth", ""))
+    custom = VoicePipeline(object(), "calm", "test", cache=cache, play=False, voice=("a.pth", ""), convert=lambda audio, sr, voice: (audio, sr))
+    assert default._cache_key("hello") is not None
+    assert custom._cache_key("hello") is None
+    assert default._cache_key("x" * 1000) is None
@@ -0,0 +1,84 @@
+"""RingBuffer wraparound and the AudioOutput callback and crossfade, without an audio device"""
+
+import numpy as np
+import audio_output
+
+#imports---------------------------------------------------------------
+
+def test_write_and_read_wrap_around():
+    ring = audio_output.RingBuffer(8)
+    out = np.zeros(8, dtype=np.float32)
+    assert ring.write(np.arange(6, dtype=np.float32)) == 6
+    assert ring.read_into(out[:5]) == 5
+    assert ring.write(np.arange(10, 20, dtype=np.float32)) == 7 #full, the rest is left to the writer
+    assert ring.available() == 8 and ring.space() == 0 and ring.position() == 13
+    assert ring.read_into(out) == 8
+    assert out.tolist() == [5, 10, 11, 12, 13, 14, 15, 16]
+    assert ring.read_into(out) == 0
+
+def test_many_laps_keep_the_order():
+    ring = audio_output.RingBuffer(7)
+    source = np.arange(1000, dtype=np.float32)
+    played = []
+    out = np.zeros(3, dtype=np.float32)
+    written = 0
+    while len(played) < len(source):
+        written += ring.write(source[written:written + 5])
+        played.extend(out[:ring.read_into(out)].tolist())
+    assert played == source.tolist()
+
+def test_rewrite_across_the_end_of_the_ring():
+    ring = audio_output.RingBuffer(8)
+    out = np.zeros(6, dtype=np.float32)
+    ring.write(np.zeros(6, dtype=np.float32))
+    ring.read_into(out)
+    ring.write(np.ones(6, dtype=np.float32)) #frames 6..11, stored at 6, 7, 0, 1, 2, 3
+    assert ring.rewrite(3, lambda frames: frames * 2, margin=2)
+    assert not ring.rewrite(3, lambda frames: frames * 2, margin=4) #the reader could reach them
+    assert ring.read_into(out) == 6 and out.tolist() == [1, 1, 1, 2, 2, 2]
+
+def test_skip_never_passes_the_writer():
+    ring = audio_output.RingBuffer(8)
+    ring.write(np.ones(5, dtype=np.float32))
+    ring.skip(3)
+    assert ring.available() == 2
+    ring.skip(100)
+    assert ring.available() == 0
+    ring.skip(1) #never goes back
+    assert ring.available() == 0
+
+def _output(samplerate=1000, fade_ms=10.0):
+    """an AudioOutput with its ring but no device, the test plays the callback"""
+    output = audio_output.AudioOutput(samplerate=samplerate, buffer_seconds=1.0, fade_ms=fade_ms)
+    output._stream = object() #'open()' does nothing
+    output.ring = audio_output.RingBuffer(samplerate)
+    output._fade = int(samplerate * fade_ms / 1000)
+    output._block = 4
+    return output
+
+def test_clips_are_crossfaded_in_the_ring():
+    output = _output()
+    output.play(np.ones(100, dtype=np.float32), 1000)
+    output.play(np.ones(100, dtype=np.float32), 1000)
+    assert output.ring.available() == 190 #the 10 frames of the fade overlap
+    frames = np.zeros(200, dtype=np.float32)
+    output.ring.read_into(frames)
+    assert np.allclose(frames[85:105], 1.0, atol=0.11) #no dip between the clips
+    assert frames[0] < 0.2 and frames[189] < 0.2
+
+def test_callback_counts_the_underruns_of_a_reply():
+    output = _output()
+    output.play(np.ones(50, dtype=np.float32), 1000)
+    block = np.zeros((32, 1), dtype=np.float32)
+    output._callback(block, 32, None, None)
+    assert output.underruns == 0 and output.min_fill == 50
+    output._callback(block, 32, None, None) #18 frames left
+    assert output.underruns == 1 and output.underrun_frames == 14 and output.played == 50
+
+def test_clear_skips_what_is_not_played():
+    output = _output()
+    output.play(np.ones(500, dtype=np.float32), 1000)
+    output.clear()
+    block = np.zeros((32, 1), dtype=np.float32)
+    output._callback(block, 32, None, None) #fades the current block out
+    assert block[-1, 0] < block[0, 0] and output.ring.available() == 0
@@ -0,0 +1,77 @@
+"""ContextWindow token budget, recall of old turns and the layout of the memory text"""
+
+import pytest
+import memory
+import context
+
+#imports---------------------------------------------------------------
+
+HEADERS = [context.SUMMARY_HEADER, context.RECENT_HEADER, context.RECALL_HEADER]
+
+@pytest.fixture
+def chat(workdir):
+    """a memory file of 60 filler turns with one old fact"""
+    memory.add_memory("chatlogs", "tester", "[USER] my cat is named Miso\n[YOU] what a cute name\n")
+    for i in range(60):
+        memory.add_memory("chatlogs", "tester", f"[USER] tell me about topic number {i}\n[YOU] topic {i} is quite interesting\n")
+    return memory.get_store("chatlogs", "tester")
+
+def _sections(text):
+    """the text of the three sections, checking the headers are all there and in order"""
+    positions = [text.index(header) for header in HEADERS]
+    assert positions == sorted(positions) and positions[0] == 0
+    bounds = positions + [len(text)]
+    return [text[bounds[i] + len(HEADERS[i]):bounds[i + 1]] for i in range(3)]
+
+def test_sections_of_an_empty_memory(workdir):
+    window = context.ContextWindow(None, "empty", budget=200)
+    assert _sections(window.build("hi")) == ["", "", ""]
+
+def test_recent_turns_fit_in_the_budget(chat):
+    window = context.ContextWindow(None, "tester", budget=200, recall_turns=0)
+    summary, recent, recalled = _sections(window.build("hello"))
+    assert summary == "" and recalled == ""
+    turns = chat.turns()
+    kept = [turn for turn in turns if turn in recent]
+    assert 0 < len(kept) < len(turns) and recent == "".join(turns[-len(kept):])
+    headers = context.count_tokens("".join(HEADERS))
+    assert sum(map(context.count_tokens, kept)) <= 200 - headers < sum(map(context.count_tokens, turns[-len(kept) - 1:]))
+
+def test_a_huge_last_turn_is_still_sent(chat):
+    chat.append("[USER] " + "words " * 500 + "\n")
+    window = context.ContextWindow(None, "tester", budget=100, recall_turns=0)
+    _, recent, _ = _sections(window.build("hello"))
+    assert recent == chat.turn(-1)
+
+def test_recalls_an_old_turn_out_of_the_budget(chat):
+    window = context.ContextWindow(None, "tester", budget=200, recall_turns=2)
+    _, recent, recalled = _sections(window.build("what is the name of my cat?"))
+    assert "Miso" not in recent
+    assert recalled.startswith(chat.turn(0))
+
+def test_recall_respects_its_token_budget(chat):
+    window = context.ContextWindow(None, "tester", budget=200, recall_turns=4, recall_tokens=1)
+    _, _, recalled = _sections(window.build("what is the name of my cat?"))
+    assert recalled == ""
+
+def test_new_turns_are_counted_once(chat):
+    window = context.ContextWindow(None, "tester", budget=200)
+    window.build("hello")
+    chat.append("[USER] the weather is nice\n[YOU] indeed\n")
+    _, recent, _ = _sections(window.build("hello"))
+    assert recent.endswith("indeed\n") and len(window._counts) == len(chat) == len(window._index)
+
+def test_old_turns_are_folded_into_the_summary(chat, fake_api):
+    import http_pool
+    window = context.ContextWindow(http_pool.get_client("fake"), "tester", budget=200, summary_tokens=50, recall_turns=0)
+    first = window.build("hello")
+    window.wait(5)
+    assert window.summary != "" and 0 < window._summarized < len(chat)
+    assert window._summary_count == context.count_tokens(window.summary)
+
+    summary, recent, _ = _sections(window.build("hello"))
+    assert summary == window.summary + "\n"
+    assert len(recent) < len(_sections(first)[1]) #the summary takes part of the budget
+
+    window.reset()
+    assert window.summary == "" and window._summarized == 0 and window._counts == []
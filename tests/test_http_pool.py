@@ -0,0 +1,81 @@
+"""Network options per character and hedged requests"""
+
+import json
+import time
+import asyncio
+import threading
+import http_pool
+
+#imports---------------------------------------------------------------
+
+def _network(path, **network):
+    with open(path, "w") as f:
+        json.dump({"network": network}, f)
+    return http_pool.configure(path)
+
+def test_each_character_keeps_its_options(workdir):
+    fast = _network("fast.json", tts_timeout=5, retries=0, hedge_tts_chars=0)
+    slow = _network("slow.json", tts_timeout=40)
+    fast_client = http_pool.get_client("key", "http://localhost:1", network=fast)
+    slow_client = http_pool.get_client("key", "http://localhost:1", network=slow)
+    assert fast_client is not slow_client and fast_client._client is slow_client._client #one connection pool
+
+    fast_tts = http_pool.for_operation(fast_client, "tts")
+    slow_tts = http_pool.for_operation(slow_client, "tts")
+    assert fast_tts.timeout.read == 5 and fast_tts.max_retries == 0
+    assert slow_tts.timeout.read == 40 and slow_tts.max_retries == http_pool.OPERATIONS["tts"][1]
+    assert http_pool.hedge_chars(fast_client) == 0 and http_pool.hedge_chars(slow_client) == http_pool.HEDGE_CHARS
+    assert http_pool.OPERATIONS["tts"][0] == 20.0 #the defaults are never changed
+
+    again = _network("again.json", tts_timeout=5, retries=0, hedge_tts_chars=0)
+    assert http_pool.get_client("key", "http://localhost:1", network=again) is fast_client
+
+def test_async_clients_share_the_pool_of_the_loop(workdir):
+    fast = _network("fast.json", chat_timeout=7)
+    async def clients():
+        return http_pool.get_async_client("key", "http://localhost:1", network=fast), http_pool.get_async_client("key", "http://localhost:1")
+    fast_client, default_client = asyncio.run(clients())
+    assert fast_client.timeout.read == 7 and default_client.timeout.read == http_pool.OPERATIONS["chat"][0]
+    assert fast_client._client is default_client._client
+
+def test_hedge_delay_follows_the_slow_tail():
+    hedge = http_pool.Hedge(min_samples=20, min_delay=0.05, max_delay=2.0)
+    assert hedge.delay() == hedge.default
+    for _ in range(95):
+        hedge.observe(0.1)
+    for _ in range(5):
+        hedge.observe(1.0)
+    assert 0.1 <= hedge.delay() <= 0.3 #3 times the median at most
+    hedge.observe(0.01, censored=True) #a lost first request counts as a slow one
+    assert hedge._latencies[-1] == hedge.max_delay
+
+def test_hedged_returns_the_duplicate_of_a_slow_call():
+    hedge = http_pool.Hedge(default=0.05)
+    calls = []
+    release = threading.Event()
+    def request():
+        calls.append(True)
+        if len(calls) == 1:
+            release.wait(5) #the first call is stuck
+            return "first"
+        return "second"
+    start = time.perf_counter()
+    assert http_pool.hedged(request, hedge) == "second"
+    assert time.perf_counter() - start < 1 and len(calls) == 2
+    release.set()
+
+def test_ahedged_cancels_the_slower_request():
+    hedge = http_pool.Hedge(default=0.05)
+    calls = []
+    async def request():
+        calls.append(True)
+        if len(calls) == 1:
+            await asyncio.sleep(5)
+            return "first"
+        return "second"
+    async def run():
+        result = await asyncio.wait_for(http_pool.ahedged(request, hedge), 1)
+        await asyncio.sleep(0) #lets the cancelled first request finish
+        return result
+    assert asyncio.run(run()) == "second"
+    assert len(calls) == 2 and hedge._latencies[-1] == hedge.max_delay
@@ -0,0 +1,63 @@
+"""MemoryStore appends, index, reads and syncs"""
+
+import os
+import time
+import memory
+
+#imports---------------------------------------------------------------
+
+TURNS = ["[USER] hi\n[YOU] hello\n", "[USER] café ☕ ?\n[YOU] oui 🙂\n", "[USER] bye\n[YOU] see you\n"]
+
+def _store(path="./memory/test.txt", **kwargs):
+    store = memory.MemoryStore(path, **kwargs)
+    for text in TURNS:
+        store.append(text)
+    return store
+
+def test_append_and_read(workdir):
+    store = _store()
+    assert len(store) == 3 and store.append("") == -1
+    assert store.read() == "".join(TURNS)
+    assert store.turns() == TURNS and store.turns(1, 2) == TURNS[1:2] and store.turns(2, 1) == []
+    assert store.turn(1) == TURNS[1] and store.turn(-1) == TURNS[2]
+    assert store.tail(2) == "".join(TURNS[1:]) and store.tail(10) == "".join(TURNS) and store.tail(0) == ""
+    store.close()
+
+def test_reopen_uses_the_index(workdir):
+    _store().close()
+    store = memory.MemoryStore("./memory/test.txt")
+    assert store.turns() == TURNS and store.append("[USER] again\n") == 3
+    assert store.tail(1) == "[USER] again\n"
+    store.close()
+
+def test_index_is_rebuilt_after_a_crash(workdir):
+    _store().close()
+    with open("./memory/test.idx", "r+b") as f: #the last offset was written past the end of the text
+        f.seek(0, os.SEEK_END)
+        f.write((10**6).to_bytes(8, "little"))
+    store = memory.MemoryStore("./memory/test.txt")
+    assert store.turns() == TURNS
+    store.close()
+
+def test_file_without_index_is_one_turn(workdir):
+    os.makedirs("./memory")
+    with open("./memory/old.txt", "w", encoding="utf-8") as f:
+        f.write("".join(TURNS))
+    store = memory.MemoryStore("./memory/old.txt")
+    assert len(store) == 1 and store.turn(0) == "".join(TURNS)
+    store.close()
+
+def test_the_last_appends_are_synced_by_the_timer(workdir, monkeypatch):
+    synced = []
+    monkeypatch.setattr(memory.os, "fsync", lambda fd: synced.append(fd))
+    store = _store(fsync_every=100, fsync_interval=0.05)
+    assert store._pending > 0
+    deadline = time.monotonic() + 2
+    while store._pending and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert store._pending == 0 and len(synced) >= 2 #text and index
+    before = len(synced)
+
+    store.append("[USER] one more\n")
+    store.close()
+    assert store._pending == 0 and len(synced) == before + 2 and store._timer is None
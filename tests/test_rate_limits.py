@@ -0,0 +1,76 @@
+"""Token buckets, priority classes and 429s of the rate limiter"""
+
+import rate_limits
+
+#imports---------------------------------------------------------------
+
+def test_bucket_refills_over_a_minute():
+    bucket = rate_limits._Bucket(60)
+    bucket.take(60)
+    assert bucket.level == 0 and bucket.wait(1, 0.0) == 1.0 #one per second
+    bucket.refill(bucket.updated + 30)
+    assert bucket.level == 30
+    bucket.refill(bucket.updated + 600)
+    assert bucket.level == 60 #never above the capacity
+
+def test_bucket_reserve_and_large_requests():
+    bucket = rate_limits._Bucket(100)
+    bucket.take(30)
+    assert bucket.wait(60, 0.0) == 0.0 and bucket.wait(60, 0.2) > 0 #20 are kept out of reach of the background
+    assert bucket.wait(1000, 0.0) == 18.0 #larger than the bucket: waits for a full one, not forever
+    bucket.refill(bucket.updated + 18)
+    assert bucket.wait(1000, 0.0) == 0.0
+    bucket.take(1000)
+    assert bucket.level == 0
+
+def test_bucket_without_limit_never_waits():
+    bucket = rate_limits._Bucket()
+    assert bucket.wait(10**9, 0.5) == 0.0
+    bucket.correct("100", "40") #the first answer tells the limit
+    assert bucket.capacity == 100 and bucket.level == 40
+    bucket.correct(None, "70") #the local count is already lower
+    assert bucket.level == 40
+
+def test_interactive_requests_go_first():
+    limiter = rate_limits.RateLimiter({"m": {"rpm": 10, "tpm": 10000}}, background_reserve=0.2)
+    for _ in range(8):
+        assert limiter._try("m", 100, "background") == 0
+    assert limiter._try("m", 100, "background") > 0 #the last 20% are kept for the interactive ones
+    assert limiter._try("m", 100, "interactive") == 0
+
+    limiter = rate_limits.RateLimiter({"m": {"rpm": 10, "tpm": 10000}})
+    limiter._waiting("m", "interactive", 1)
+    assert limiter._try("m", 100, "background") > 0 and limiter._try("m", 100, "interactive") == 0
+
+def test_429_blocks_the_model_until_retry_after():
+    limiter = rate_limits.RateLimiter()
+    limiter.observe("m", 429, {"retry-after-ms": "300"})
+    wait = limiter._try("m", 10, "interactive")
+    assert 0.2 < wait <= 0.3 and limiter.rate_limited == 1
+    assert limiter.acquire("m", 10) >= 0.2
+    limiter.observe("other", 429, {"x-ratelimit-reset-requests": "1m30s", "x-ratelimit-reset-tokens": "20ms"})
+    assert limiter._try("other", 10, "interactive") > 80
+
+def test_headers_set_the_limits():
+    limiter = rate_limits.RateLimiter()
+    assert limiter.acquire("m", 500) == 0.0 #unknown limits: never held back
+    limiter.observe("m", 200, {"x-ratelimit-limit-requests": "100", "x-ratelimit-remaining-requests": "0",
+                               "x-ratelimit-limit-tokens": "1000", "x-ratelimit-remaining-tokens": "900"})
+    stats = limiter.stats()["models"]["m"]
+    assert stats["rpm"] == 100 and stats["tpm"] == 1000 and stats["requests_left"] < 1
+    assert limiter._try("m", 10, "interactive") > 0
+
+def test_disabled_limiter_lets_everything_through():
+    limiter = rate_limits.RateLimiter({"m": {"rpm": 1}}, enabled=False)
+    assert limiter.acquire("m", 10) == limiter.acquire("m", 10) == 0.0
+
+def test_durations():
+    assert rate_limits._seconds("6m0s") == 360 and rate_limits._seconds("20ms") == 0.02
+    assert rate_limits._seconds("1.5") == 1.5 and rate_limits._seconds("soon") is None and rate_limits._seconds(None) is None
+
+def test_estimate_tokens():
+    body = {"instructions": "x" * 400, "input": [{"role": "user", "content": [{"type": "input_text", "text": "y" * 400},
+                                                                              {"type": "input_image", "image_url": "data:image/png;base64,AAAA"}]}],
+            "max_output_tokens": 50}
+    assert rate_limits.estimate_tokens(body) == 100 + 100 + rate_limits.IMAGE_TOKENS + 50
+    assert rate_limits.estimate_tokens({"messages": [{"role": "user", "content": "z" * 40}]}) == 10 + rate_limits.OUTPUT_TOKENS
@@ -0,0 +1,33 @@
+"""TurnIndex ranking and the words too common to search"""
+
+import retrieval
+
+#imports---------------------------------------------------------------
+
+def _index(turns, **kwargs):
+    index = retrieval.TurnIndex(**kwargs)
+    for text in turns:
+        index.add(text)
+    return index
+
+def test_finds_the_turn_of_a_rare_word():
+    index = _index([f"[USER] filler number {i}\n[YOU] ok" for i in range(50)] + ["[USER] my cat is named Miso\n[YOU] cute"])
+    assert index.search("what is the name of my cat Miso", k=1)[0][0] == 50
+    assert index.search("Miso", before=50) == []
+
+def test_keeps_the_words_of_a_short_history():
+    """'cat' is in 10% of the turns, above 'max_df' but under 'min_common': it still decides between the two gardens"""
+    turns = [f"[USER] filler number {i}\n[YOU] ok" for i in range(100)]
+    for i in range(10):
+        turns[i] = f"[USER] my cat number {i}\n[YOU] ok"
+    turns[5] = "[USER] my cat sleeps in the garden\n[YOU] ok"
+    turns[60] = "[USER] my dog sleeps in the garden\n[YOU] ok"
+    found = _index(turns).search("cat garden", k=2)
+    assert found[0][0] == 5 and found[0][1] > found[1][1]
+
+def test_common_words_are_skipped_past_the_floor():
+    turns = [f"[USER] filler number {i}\n[YOU] ok" for i in range(100)]
+    turns[5] = "[USER] my cat sleeps in the garden\n[YOU] ok"
+    turns[60] = "[USER] my dog sleeps in the garden\n[YOU] ok"
+    found = _index(turns, min_common=0).search("number garden", k=2)
+    assert sorted(turn for turn, _ in found) == [5, 60] #'number' is in 98 turns, only 'garden' is searched
@@ -0,0 +1,99 @@
+"""RVCRegistry residency and its locks, with fake voices (no rvc_python nor torch)"""
+
+import threading
+from types import SimpleNamespace
+import pytest
+import rvc_converter
+
+#imports---------------------------------------------------------------
+
+class FakeVoice:
+    """stand-in of RVCVoice: loading it takes 'load_seconds', it weighs 1 byte"""
+    loads = 0
+    load_event = None
+
+    def __init__(self, key, runtime, model_path, index_path, params):
+        FakeVoice.loads += 1
+        if FakeVoice.load_event is not None:
+            FakeVoice.load_event.wait(5)
+        self.key = key
+        self.model_path = model_path
+        self.index_path = index_path
+        self.params = params
+        self.size = 1
+        self.lock = threading.Lock()
+        self.vc = SimpleNamespace(pipeline=SimpleNamespace())
+
+@pytest.fixture
+def registry(monkeypatch):
+    FakeVoice.loads = 0
+    FakeVoice.load_event = None
+    monkeypatch.setattr(rvc_converter, "RVCVoice", FakeVoice)
+    registry = rvc_converter.RVCRegistry(memory_budget=1) #one resident voice at a time
+    registry._runtime = object()
+    registry._hubert = object()
+    return registry
+
+def _run(target) -> threading.Thread:
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    return thread
+
+def test_lru_eviction_and_reload(registry):
+    a = registry.load("a.pth")
+    b = registry.load("b.pth")
+    assert registry.resident() == [b]
+    voice = registry.get(a) #reloaded, evicts b
+    assert voice.vc is not None and registry.resident() == [a]
+    assert FakeVoice.loads == 3
+
+def test_eviction_waits_for_the_running_conversion(registry):
+    """a conversion holding its voice can still use the registry while another thread loads a voice that evicts it (no deadlock)"""
+    a = registry.load("a.pth")
+    b = registry.load("b.pth")
+    registry.get(a)
+    converting, evicting = threading.Event(), threading.Event()
+    seen = {}
+
+    def convert():
+        with registry._use(a) as voice:
+            converting.set()
+            evicting.wait(5)
+            threading.Event().wait(0.2) #the other thread is now waiting for this voice
+            seen["resident"] = registry.resident() #takes the registry lock while holding the voice
+            seen["hubert"] = registry.hubert()
+            seen["vc"] = voice.vc
+
+    def load_other():
+        converting.wait(5)
+        evicting.set()
+        registry.get(b)
+
+    threads = [_run(convert), _run(load_other)]
+    for thread in threads:
+        thread.join(5)
+    assert not any(thread.is_alive() for thread in threads), "deadlock between a conversion and an eviction"
+    assert seen["vc"] is not None #the model was freed after the conversion, not during it
+    assert registry.resident() == [b]
+
+def test_conversion_after_eviction_reloads_the_voice(registry):
+    a = registry.load("a.pth")
+    voice = registry.get(a)
+    registry.load("b.pth") #evicts a
+    assert voice.vc is None
+    with registry._use(a) as reloaded:
+        assert reloaded is not voice and reloaded.vc is not None
+
+def test_a_voice_is_loaded_once_for_concurrent_callers(registry):
+    a = registry.load("a.pth")
+    registry.unload(a)
+    registry._known[a] = ("a.pth", "", {})
+    FakeVoice.loads = 0
+    FakeVoice.load_event = threading.Event()
+    results = []
+    threads = [_run(lambda: results.append(registry.get(a))) for _ in range(4)]
+    assert registry.resident() == [] #still loading, the registry lock is free
+    FakeVoice.load_event.set()
+    for thread in threads:
+        thread.join(5)
+    assert FakeVoice.loads == 1 and len(results) == 4 and len({id(voice) for voice in results}) == 1
@@ -0,0 +1,58 @@
+"""TaskRuntime scheduling and cancellation, and voice pipelines on a small pool"""
+
+import queue
+import threading
+import numpy as np
+import pytest
+import turn_runtime
+
+#imports---------------------------------------------------------------
+
+def test_cancel_runs_the_callbacks_and_skips_the_jobs_not_started():
+    runtime = turn_runtime.TaskRuntime(max_workers=1)
+    scope = turn_runtime.TurnScope("test")
+    closed = []
+    scope.on_cancel(lambda: closed.append(True))
+    release = threading.Event()
+    first = runtime.submit(scope, release.wait, 5)
+    second = runtime.submit(scope, lambda: "ran")
+    scope.cancel()
+    release.set()
+    assert first.result(5) is True
+    with pytest.raises(turn_runtime.TurnCancelled):
+        second.result(5)
+    assert closed == [True] and scope.wait(5) and runtime.stats()["skipped"] == 1
+
+def test_spawned_stages_do_not_starve_the_pool():
+    """many turns of two stages linked by a bounded queue, on a pool of one worker: 'spawn()' never deadlocks"""
+    runtime = turn_runtime.TaskRuntime(max_workers=1)
+    def producer(box):
+        for i in range(20):
+            box.put(i)
+        box.put(None)
+    def consumer(box):
+        total = 0
+        while (item := box.get()) is not None:
+            total += item
+        return total
+    turns = []
+    for _ in range(8):
+        scope = turn_runtime.TurnScope("test")
+        box = queue.Queue(1)
+        turns.append((runtime.spawn(scope, consumer, box), runtime.spawn(scope, producer, box)))
+    waits = [runtime.submit(turn_runtime.TurnScope("wait"), consumer_future.result, 10) for consumer_future, _ in turns]
+    assert [wait.result(10) for wait in waits] == [190] * 8
+
+def test_voice_pipelines_on_a_pool_smaller_than_their_stages(fake_api, monkeypatch):
+    import http_pool
+    from voice_pipeline import VoicePipeline
+    runtime = turn_runtime.TaskRuntime(max_workers=2)
+    monkeypatch.setattr(turn_runtime, "_runtime", runtime)
+    client = http_pool.get_client("fake")
+    stub = lambda audio, sr, voice=None: (np.asarray(audio, dtype=np.float32), sr)
+    pipelines = [VoicePipeline(client, "calm", f"test{i}", convert=stub, play=False) for i in range(6)]
+    for pipeline in pipelines:
+        pipeline.speak(["Hello there, how are you today? ", "I am fine, thank you very much for asking."], echo=False)
+    waits = [runtime.submit(pipeline.scope, pipeline.wait) for pipeline in pipelines] #like 'Model.run_chat_voice()'
+    assert all(wait.result(30) is not None for wait in waits)
+    assert all(not pipeline.errors for pipeline in pipelines)
@@ -0,0 +1,234 @@
+"""
+Per-turn latency tracing: every stage of a turn (memory, request, first/last delta, tts, rvc, playback, screen) records a span,
+so a slow turn shows which stage was slow.
+Spans are written as json lines and kept in a rolling window per span name for the p50/p95/p99 rollups,
+which are also exported in the Prometheus text format (GET /metrics of 'server.py').
+Disabled by default: a disabled 'span()' returns a shared object that does nothing, the cost is one function call.
+Enable it with 'tracing.enable()' or the AI_GF_TRACE environment variable (path of the .jsonl file).
+Functions:
+    - enable(path: str = "./memory/traces.jsonl", window: int = 1024) / disable() / is_enabled() -> bool
+    - turn(kind: str): context manager, the spans recorded inside (also in the threads started with 'run_in_turn()') belong to the turn.
+    - span(name: str, **attrs): context manager timing a stage, 'set(**attrs)' adds attributes (bytes, sentence...).
+    - record(name: str, seconds: float, **attrs): adds a span measured by the caller (time to first delta...).
+    - traced(name: str): decorator, a span around every call of the function.
+    - rollups() -> dict: count and p50/p95/p99 (ms) of every span name.
+    - prometheus_text() -> str: the rollups in the Prometheus text format.
+"""
+
+import os
+import json
+import time
+import functools
+import itertools
+import threading
+import contextvars
+from collections import deque
+import numpy as np
+
+#imports---------------------------------------------------------------
+
+_enabled = False
+_lock = threading.Lock()
+_file = None
+_window = 1024
+_durations = {} #span name -> deque of the last durations (seconds)
+_totals = {} #span name -> [count, sum of durations] since enable()
+_turn_ids = itertools.count(1)
+_current = contextvars.ContextVar("tracing_turn", default=None)
+
+class Turn:
+    """one traced turn: id, kind ("chat", "voice"...) and start time"""
+    __slots__ = ("id", "kind", "start")
+
+    def __init__(self, kind: str):
+        self.id = next(_turn_ids)
+        self.kind = kind
+        self.start = time.perf_counter()
+
+class _Noop:
+    """returned by 'span()' and 'turn()' when tracing is disabled"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs) -> None:
+        pass
+
+_NOOP = _Noop()
+
+class _Span:
+    __slots__ = ("name", "attrs", "turn", "start")
+
+    def __init__(self, name: str, attrs: dict):
+        self.name = name
+        self.attrs = attrs
+        self.turn = _current.get()
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        _finish(self.name, self.start, time.perf_counter() - self.start, self.turn, self.attrs)
+        return False
+
+    def set(self, **attrs) -> None:
+        self.attrs.update(attrs)
+
+class _TurnScope:
+    __slots__ = ("turn", "token")
+
+    def __init__(self, kind: str):
+        self.turn = Turn(kind)
+
+    def __enter__(self):
+        self.token = _current.set(self.turn)
+        return self.turn
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            _current.reset(self.token)
+        except ValueError: #async generator closed from an other context
+            pass
+        attrs = {"error": exc_type.__name__} if exc_type is not None else {}
+        _finish(f"turn.{self.turn.kind}", self.turn.start, time.perf_counter() - self.turn.start, self.turn, attrs)
+        with _lock:
+            if _file is not None:
+                _file.flush()
+        return False
+
+#----------------------------------control----------------------------------------
+
+def enable(path: str = "./memory/traces.jsonl", window: int = 1024) -> None:
+    """starts recording, the spans are appended to 'path' (None keeps them in memory only) and the last 'window' ones per name are used for the rollups"""
+    global _enabled, _file, _window
+    with _lock:
+        if _file is not None:
+            _file.close()
+            _file = None
+        if path is not None:
+            directory = os.path.dirname(path)
+            if directory != "":
+                os.makedirs(directory, exist_ok=True)
+            _file = open(path, "a", encoding="utf-8")
+        _window = window
+        _durations.clear()
+        _totals.clear()
+        _enabled = True
+
+def disable() -> None:
+    global _enabled, _file
+    with _lock:
+        _enabled = False
+        if _file is not None:
+            _file.close()
+            _file = None
+
+def is_enabled() -> bool:
+    return _enabled
+
+#----------------------------------recording----------------------------------------
+
+def turn(kind: str):
+    """context manager of a turn, returns the Turn (or a no-op object when disabled). A turn inside a turn is part of it"""
+    if not _enabled or _current.get() is not None:
+        return _NOOP
+    return _TurnScope(kind)
+
+def current_turn():
+    return _current.get()
+
+def run_in_turn(target, *args):
+    """returns a function running 'target(*args)' in a copy of the current context, for 'threading.Thread(target=...)', so its spans belong to the turn"""
+    context = contextvars.copy_context()
+    return lambda: context.run(target, *args)
+
+def span(name: str, **attrs):
+    """
+    context manager timing a stage.\n
+    exemple_ | with tracing.span("tts", chars=len(text)) as s: ... s.set(bytes=len(data))
+    """
+    if not _enabled:
+        return _NOOP
+    return _Span(name, attrs)
+
+def traced(name: str):
+    """decorator: records a span 'name' around every call of the function"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Span(name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def record(name: str, seconds: float, start: float = None, **attrs) -> None:
+    """adds a span measured by the caller, 'start' is its time.perf_counter() start (defaults to now - seconds)"""
+    if not _enabled:
+        return
+    _finish(name, time.perf_counter() - seconds if start is None else start, seconds, _current.get(), attrs)
+
+def _finish(name: str, start: float, seconds: float, turn, attrs: dict) -> None:
+    line = None
+    if _file is not None:
+        entry = {"time": time.time() - (time.perf_counter() - start), "span": name, "ms": round(seconds * 1000, 3), "thread": threading.current_thread().name}
+        if turn is not None:
+            entry["turn"] = turn.id
+            entry["offset_ms"] = round((start - turn.start) * 1000, 3)
+        if attrs:
+            entry.update(attrs)
+        line = json.dumps(entry, default=str) + "\n"
+    with _lock:
+        if not _enabled:
+            return
+        durations = _durations.get(name)
+        if durations is None:
+            durations = _durations[name] = deque(maxlen=_window)
+            _totals[name] = [0, 0.0]
+        durations.append(seconds)
+        totals = _totals[name]
+        totals[0] += 1
+        totals[1] += seconds
+        if line is not None and _file is not None:
+            _file.write(line)
+
+#----------------------------------exports------------------------------------------
+
+def rollups() -> dict:
+    """{span name: {"count", "p50_ms", "p95_ms", "p99_ms", "mean_ms"}} over the last 'window' spans of each name"""
+    with _lock:
+        windows = {name: np.array(durations, dtype=np.float64) for name, durations in _durations.items()}
+        totals = {name: list(total) for name, total in _totals.items()}
+    result = {}
+    for name, values in sorted(windows.items()):
+        if len(values) == 0:
+            continue
+        p50, p95, p99 = np.percentile(values, [50, 95, 99]) * 1000
+        result[name] = {"count": totals[name][0], "p50_ms": float(p50), "p95_ms": float(p95), "p99_ms": float(p99), "mean_ms": float(values.mean() * 1000)}
+    return result
+
+def prometheus_text(prefix: str = "ai_girlfriend") -> str:
+    """the rollups as a Prometheus summary ('{prefix}_span_seconds')"""
+    with _lock:
+        windows = {name: np.array(durations, dtype=np.float64) for name, durations in _durations.items()}
+        totals = {name: list(total) for name, total in _totals.items()}
+    metric = f"{prefix}_span_seconds"
+    lines = [f"# HELP {metric} duration of the stages of the turns", f"# TYPE {metric} summary"]
+    for name, values in sorted(windows.items()):
+        if len(values) == 0:
+            continue
+        label = name.replace("\\", "\\\\").replace('"', '\\"')
+        for quantile, value in zip(("0.5", "0.95", "0.99"), np.percentile(values, [50, 95, 99])):
+            lines.append(f'{metric}{{span="{label}",quantile="{quantile}"}} {value:.6f}')
+        lines.append(f'{metric}_sum{{span="{label}"}} {totals[name][1]:.6f}')
+        lines.append(f'{metric}_count{{span="{label}"}} {totals[name][0]}')
+    return "\n".join(lines) + "\n"
+
+if os.environ.get("AI_GF_TRACE"):
+    enable(os.environ["AI_GF_TRACE"])
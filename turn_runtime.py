@@ -0,0 +1,253 @@
+"""
+Shared task runtime of the turns: a bounded pool of threads instead of one new thread per job, and a cancellation scope per turn,
+so a new message (or ':q') stops what is left of the previous answer instead of letting it burn cpu and quota in the background.
+- Every job of a turn is submitted with the TurnScope of the turn. Cancelling the scope runs its 'on_cancel()' callbacks
+  (close the openAI stream, drop the audio not played yet), the jobs that did not start are skipped
+  and the running ones stop at their next 'cancelled' check.
+- Jobs that wait for each other (the stages of a voice pipeline, linked by bounded queues) are started with 'spawn()' in their own thread:
+  in the bounded pool enough turns at the same time would fill every worker with stages waiting for stages that can not start.
+- Errors stay in the returned Future ('result()' raises them) and are printed, nothing fails silently.
+- The queue depth (jobs waiting for a thread) and the cancellation latency (cancel -> last job of the turn finished)
+  are in 'stats()' and 'prometheus_text()', and traced as 'runtime.queue_wait' / 'turn.cancel'.
+Classes:
+    - TurnCancelled:
+        Raised by 'TurnScope.check()' and by the jobs of a turn cancelled before they started.
+    - TurnScope:
+        Cancellation scope of one turn. exemple_ | scope.on_cancel(stream.close) | scope.cancel() | scope.wait()
+    - TaskRuntime:
+        The bounded pool. exemple_ | scope = runtime.next_turn(scope) | runtime.submit(scope, func, arg) | runtime.spawn(scope, stage_loop)
+Functions:
+    - get_runtime() -> TaskRuntime:
+        The runtime shared by the whole process.
+"""
+
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+import numpy as np
+import tracing
+
+#imports---------------------------------------------------------------
+
+class TurnCancelled(Exception):
+    """the turn was cancelled"""
+
+class TurnScope:
+    """
+    Cancellation scope of one turn.\n
+    - 'cancel()' can be called from any thread, more than once. The 'on_cancel()' callbacks run once, in the cancelling thread.
+    - The jobs check 'cancelled' between two pieces of work (a sentence, a delta) or call 'check()'.
+    - 'wait()' returns once every job submitted with this scope is finished.\n
+    exemple_ | scope = TurnScope("voice") | scope.on_cancel(response.close) | if scope.cancelled: return
+    """
+    def __init__(self, kind: str = "turn"):
+        self.kind = kind
+        self.cancelled_at = None #time.perf_counter() of the cancel
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._callbacks = []
+        self._tasks = 0 #jobs submitted and not finished
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def check(self) -> None:
+        """raises TurnCancelled if the turn was cancelled"""
+        if self._event.is_set():
+            raise TurnCancelled(f"{self.kind} turn cancelled")
+
+    def on_cancel(self, callback) -> None:
+        """calls 'callback()' when the turn is cancelled, right away if it already is"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        _call(callback)
+
+    def cancel(self) -> bool:
+        """cancels the turn, returns False if it already was"""
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self.cancelled_at = time.perf_counter()
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            _call(callback)
+        return True
+
+    def pending(self) -> int:
+        """jobs of the turn not finished yet"""
+        return self._tasks
+
+    def wait(self, timeout: float = None) -> bool:
+        """waits for every job of the turn, returns False if some are still running after 'timeout' seconds"""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._tasks == 0, timeout)
+
+    def _add(self) -> None:
+        with self._lock:
+            self._tasks += 1
+
+    def _finished(self) -> None:
+        with self._idle:
+            self._tasks -= 1
+            if self._tasks == 0:
+                self._idle.notify_all()
+
+def _call(callback) -> None:
+    try:
+        callback()
+    except Exception as e: #a failed clean up does not stop the others
+        print(f"[WARN] turn cancel callback: {e}")
+
+class TaskRuntime:
+    """
+    Bounded pool of threads shared by the turns.\n
+    - At most 'max_workers' jobs of 'submit()' run at the same time, the next ones wait in the queue ('queued').
+      They must not wait for another job of the pool: long lived jobs that wait for each other go to 'spawn()' (one thread each).
+    - 'next_turn(previous)' cancels the previous turn of a conversation, waits for its jobs and returns the scope of the new one.\n
+    exemple_ | runtime = get_runtime() | scope = runtime.next_turn(scope, "voice") | future = runtime.submit(scope, func, arg)
+    """
+    def __init__(self, max_workers: int = 32, window: int = 256):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="turn")
+        self._lock = threading.Lock()
+        self.queued = 0 #jobs waiting for a thread
+        self.running = 0
+        self.failed = 0
+        self.skipped = 0 #jobs of a cancelled turn that never started
+        self.cancelled_turns = 0
+        self._cancel_latencies = deque(maxlen=window) #seconds from the cancel to the last job of the turn finished
+
+    def _job(self, scope: TurnScope, func, args: tuple, kwargs: dict):
+        """'func' wrapped as a job of 'scope': skipped if the turn is already cancelled, counted and its error printed"""
+        def run():
+            with self._lock:
+                self.running += 1
+            try:
+                if scope.cancelled:
+                    with self._lock:
+                        self.skipped += 1
+                    scope.check()
+                return func(*args, **kwargs)
+            except TurnCancelled:
+                raise
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                print(f"[WARN] {getattr(func, '__name__', 'task')} failed: {e}")
+                raise
+            finally:
+                with self._lock:
+                    self.running -= 1
+                scope._finished()
+        return run
+
+    def submit(self, scope: TurnScope, func, *args, **kwargs) -> Future:
+        """runs 'func(*args, **kwargs)' in the pool as a job of 'scope' (and of the traced turn of the caller)"""
+        submitted = time.perf_counter()
+        job = self._job(scope, func, args, kwargs)
+        def run():
+            with self._lock:
+                self.queued -= 1
+            tracing.record("runtime.queue_wait", time.perf_counter() - submitted, submitted)
+            return job()
+
+        scope._add()
+        with self._lock:
+            self.queued += 1
+        try:
+            return self._executor.submit(tracing.run_in_turn(run))
+        except RuntimeError: #interpreter shutting down
+            with self._lock:
+                self.queued -= 1
+            scope._finished()
+            raise
+
+    def spawn(self, scope: TurnScope, func, *args, name: str = "turn-stage", **kwargs) -> Future:
+        """
+        runs 'func(*args, **kwargs)' in a new thread as a job of 'scope', for the jobs that wait for other jobs (never queued, never blocks the pool).
+        Returns a Future like 'submit()'.
+        """
+        future = Future()
+        job = tracing.run_in_turn(self._job(scope, func, args, kwargs))
+        def run():
+            if not future.set_running_or_notify_cancel():
+                scope._finished()
+                return
+            try:
+                future.set_result(job())
+            except BaseException as e:
+                future.set_exception(e)
+
+        scope._add()
+        threading.Thread(target=run, name=name, daemon=True).start()
+        return future
+
+    def cancel(self, scope: TurnScope, timeout: float = 5.0) -> float:
+        """
+        cancels the turn and waits up to 'timeout' seconds for its jobs.
+        Returns the cancellation latency in seconds (None when the turn had nothing running or did not stop in time).
+        """
+        busy = scope.pending()
+        scope.cancel()
+        if busy == 0:
+            return None
+        start = scope.cancelled_at
+        if not scope.wait(timeout):
+            print(f"[WARN] the cancelled {scope.kind} turn still has {scope.pending()} jobs running after {timeout}s")
+            return None
+        latency = time.perf_counter() - start
+        self.record_cancel(latency, jobs=busy)
+        return latency
+
+    def record_cancel(self, seconds: float, **attrs) -> None:
+        """adds the latency of a cancelled turn (also used by the asyncio turns of 'server.py')"""
+        with self._lock:
+            self.cancelled_turns += 1
+            self._cancel_latencies.append(seconds)
+        tracing.record("turn.cancel", seconds, **attrs)
+
+    def next_turn(self, previous: TurnScope = None, kind: str = "turn", timeout: float = 5.0) -> TurnScope:
+        """cancels 'previous' (the last turn of the same conversation) if it is still running and returns the scope of the new turn"""
+        if previous is not None:
+            self.cancel(previous, timeout)
+        return TurnScope(kind)
+
+    #----------------------------------metrics--------------------------------------------
+
+    def stats(self) -> dict:
+        """queue depth, running and failed jobs, cancelled turns and their cancellation latency (ms)"""
+        with self._lock:
+            latencies = np.array(self._cancel_latencies, dtype=np.float64) * 1000
+            stats = {"workers": self.max_workers, "queued": self.queued, "running": self.running, "failed": self.failed,
+                     "skipped": self.skipped, "cancelled_turns": self.cancelled_turns}
+        stats["cancel_p50_ms"] = float(np.percentile(latencies, 50)) if len(latencies) > 0 else None
+        stats["cancel_max_ms"] = float(latencies.max()) if len(latencies) > 0 else None
+        return stats
+
+    def prometheus_text(self, prefix: str = "ai_girlfriend") -> str:
+        """queue depth and running jobs (gauges), failed jobs and cancelled turns (counters)"""
+        stats = self.stats()
+        lines = []
+        for name, kind, value, description in (("runtime_queued", "gauge", stats["queued"], "jobs waiting for a thread"),
+                                               ("runtime_running", "gauge", stats["running"], "jobs running"),
+                                               ("runtime_failed_total", "counter", stats["failed"], "jobs that raised an error"),
+                                               ("turns_cancelled_total", "counter", stats["cancelled_turns"], "turns interrupted by a new one")):
+            lines += [f"# HELP {prefix}_{name} {description}", f"# TYPE {prefix}_{name} {kind}", f"{prefix}_{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+_runtime = None
+_runtime_lock = threading.Lock()
+
+def get_runtime() -> TaskRuntime:
+    """returns the runtime shared by the whole process, created on first use"""
+    global _runtime
+    with _runtime_lock:
+        if _runtime is None:
+            _runtime = TaskRuntime()
+        return _runtime
@@ -0,0 +1,231 @@
+"""
+Renders a script of lines of a character into a folder of converted clips (a "voice pack"), without any chat.
+    lines (.txt: one line per clip | .jsonl: {"text": ..., "id": optional file name, "voice_description": optional tone})
+    -> [openAI tts, 'tts_concurrency' requests at a time] -> [rvc, one worker process per core, the model loaded once per process] -> '{out}/{id}.wav'
+Every finished clip is appended to '{out}/manifest.jsonl', a rerun skips the clips already in it (resume after a crash or a ctrl+c),
+and '{out}/manifest.json' lists every clip of the script in order once the run is done.
+A clip is identified by the same key as the audio cache (text, tts, voice description, rvc model and params),
+so a line already said in a conversation is taken from the cache and '--warm-cache' makes the conversations reuse the pack.
+Functions:
+    - read_lines(path: str, voice_description: str) -> list:
+        The clips of a .txt or .jsonl script.
+    - render(lines_file: str, settings_file: str, out_dir: str = None, ...) -> dict:
+        Renders the missing clips and returns the counts.
+Usage:
+    python voice_pack.py lines.txt --settings settings/teto.json [--out ./voice_packs/teto] [--workers 4] [--tts-concurrency 4] [--device cpu]
+"""
+
+import os
+import re
+import json
+import time
+import argparse
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import numpy as np
+from startup import lazy_import
+import audio_cache
+import rvc_converter
+
+#imports---------------------------------------------------------------
+
+MANIFEST_FILE = "manifest.jsonl"
+
+def _file_name(name: str) -> str:
+    return re.sub(r"[^\w\-]+", "_", name).strip("_")[:100]
+
+def read_lines(path: str, voice_description: str) -> list:
+    """_summary_
+    reads the clips of a script: a .txt (one clip per non empty line) or a .jsonl ({"text", "id", "voice_description"} per line)
+
+    Returns:
+        list: _description_. dicts with "text", "id" (None when not given) and "voice_description"
+    """
+    if not os.path.isfile(path):
+        assert False, f"File does not exist: {path}"
+    items = []
+    with open(path, "r", encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if line == "":
+                continue
+            if path.endswith(".jsonl"):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    assert False, f"{path}:{number} is not valid json"
+                if not isinstance(entry, dict) or not entry.get("text"):
+                    assert False, f"{path}:{number} has no \"text\""
+                items.append({"text": entry["text"], "id": entry.get("id"), "voice_description": entry.get("voice_description", voice_description)})
+            else:
+                items.append({"text": line, "id": None, "voice_description": voice_description})
+    return items
+
+def _read_manifest(path: str, out_dir: str) -> dict:
+    """key -> entry of the clips already rendered (whose file still exists)"""
+    done = {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError: #last line cut by a crash
+                    continue
+                if os.path.isfile(os.path.join(out_dir, entry["file"])):
+                    done[entry["key"]] = entry
+    except FileNotFoundError:
+        pass
+    return done
+
+#----------------------------------worker processes-----------------------------------
+
+_convert = None #conversion function of the worker process
+
+def _init_worker(settings_file: str, device: str, threads: int, convert) -> None:
+    """loads the rvc model once in the worker process"""
+    global _convert
+    if threads > 0:
+        try:
+            lazy_import("torch").set_num_threads(threads) #the workers share the cores instead of all using every core
+        except ImportError:
+            pass
+    if convert is not None:
+        _convert = convert
+        return
+    rvc_converter.registry.device = device
+    key = rvc_converter.load_rvc_settings(settings_file)
+    _convert = lambda audio, sr: rvc_converter.convertToAI_array(audio, sr, key)
+
+def _write_wav(audio: np.ndarray, sr: int, path: str) -> None:
+    from scipy.io import wavfile
+    temp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    wavfile.write(temp, sr, (np.clip(audio, -1, 1) * 32767).astype(np.int16))
+    os.replace(temp, path) #a clip is never half written
+
+def _convert_clip(audio: np.ndarray, sr: int, path: str, keep: bool) -> tuple:
+    """converts one clip and writes it as 16-bit wav, returns (sr, seconds, converted audio if 'keep' else None)"""
+    audio, sr = _convert(audio, sr)
+    _write_wav(audio, sr, path)
+    return sr, len(audio) / sr, audio if keep else None
+
+#----------------------------------render---------------------------------------------
+
+def render(lines_file: str, settings_file: str, out_dir: str = None, workers: int = None, tts_concurrency: int = 4, device: str = "cpu",
+           client = None, convert = None, warm_cache: bool = False) -> dict:
+    """_summary_
+    renders the clips of 'lines_file' that are not in '{out_dir}/manifest.jsonl' yet.
+    Args:
+        out_dir (str): _description_. Defaults to './voice_packs/{name of the model}'.
+        workers (int): _description_. rvc worker processes. Defaults to the number of cores.
+        tts_concurrency (int): _description_. tts requests sent at the same time. Defaults to 4.
+        device (str): _description_. torch device of the workers. Defaults to "cpu" (one process per core), use "cuda:0" with few workers.
+        client (openai.OpenAI): _description_. Defaults to the shared client of the api key of the settings.
+        convert (function): _description_. replaces the rvc conversion, (audio, sr) -> (audio, sr), must be picklable (a module level function). Defaults to None.
+        warm_cache (bool): _description_. also puts the clips in the audio cache used by the conversations. Defaults to False.
+    Returns:
+        dict: _description_. "rendered", "skipped", "failed", "seconds" (wall time) and "audio_seconds" (rendered audio)
+    """
+    import chatgpt #imported here so the worker processes do not load the openAI modules
+    import http_pool
+
+    settings = chatgpt.load_settings(settings_file)
+    if client is None:
+        client = http_pool.get_client(settings["api_key"], network=http_pool.configure(settings_file))
+    out_dir = f"./voice_packs/{settings['name']}" if out_dir is None else out_dir
+    workers = (os.cpu_count() or 1) if workers is None else max(workers, 1)
+    os.makedirs(out_dir, exist_ok=True)
+
+    #same key as the live voice pipeline, see 'voice_pipeline.VoicePipeline._cache_key()'
+    rvc_voice = rvc_converter.voice_key(*rvc_converter.read_rvc_settings(settings_file)) if convert is None else None
+    cache = audio_cache.get_cache() if convert is None else None #the cached clips are real rvc conversions
+    manifest_path = os.path.join(out_dir, MANIFEST_FILE)
+    done = _read_manifest(manifest_path, out_dir)
+
+    clips = []
+    todo = {} #key -> clip, the same line twice is rendered once
+    for item in read_lines(lines_file, settings["voice_description"]):
+        key = audio_cache.audio_key(item["text"], chatgpt.TTS_MODEL, chatgpt.TTS_VOICE, item["voice_description"], rvc_voice)
+        name = _file_name(item["id"]) if item["id"] else ""
+        clip = {**item, "key": key, "file": f"{name or key[:16]}.wav"}
+        clips.append(clip)
+        if key not in done:
+            todo.setdefault(key, clip)
+    print(f"[INFO] {len(clips)} clips, {len(clips) - len(todo)} already rendered, {len(todo)} to render with {workers} workers")
+
+    start = time.perf_counter()
+    lock = threading.Lock()
+    tts_slots = threading.BoundedSemaphore(max(tts_concurrency, 1))
+    counts = {"rendered": 0, "skipped": len(clips) - len(todo), "failed": 0, "audio_seconds": 0.0}
+    threads = max((os.cpu_count() or 1) // workers, 1)
+
+    #'tts_concurrency' threads are in the tts and up to 'workers' wait for their conversion, so every process always has a clip
+    context = multiprocessing.get_context("spawn") #torch and cuda do not survive a fork
+    with open(manifest_path, "a", encoding="utf-8") as manifest, \
+         ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker, initargs=(settings_file, device, threads, convert)) as pool, \
+         ThreadPoolExecutor(tts_concurrency + workers, thread_name_prefix="voice-pack") as tasks:
+
+        def render_clip(clip: dict) -> dict:
+            path = os.path.join(out_dir, clip["file"])
+            cached = cache.get(clip["key"]) if cache is not None else None
+            if cached is not None: #already said in a conversation, no tts nor rvc
+                audio, sr = cached
+                _write_wav(audio, sr, path)
+                seconds = len(audio) / sr
+            else:
+                with tts_slots:
+                    audio, sr = chatgpt.voice_pcm(client, clip["text"], clip["voice_description"])
+                sr, seconds, audio = pool.submit(_convert_clip, audio, sr, path, warm_cache and cache is not None).result()
+                if audio is not None:
+                    cache.put(clip["key"], audio, sr)
+            entry = {"key": clip["key"], "file": clip["file"], "text": clip["text"], "voice_description": clip["voice_description"],
+                     "sr": sr, "seconds": round(seconds, 3)}
+            with lock:
+                manifest.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                manifest.flush() #a crash keeps every finished clip
+            return entry
+
+        futures = {tasks.submit(render_clip, clip): clip for clip in todo.values()}
+        try:
+            for future in as_completed(futures):
+                try:
+                    entry = future.result()
+                except Exception as e: #the other clips go on, a rerun tries this one again
+                    counts["failed"] += 1
+                    print(f"[WARN] could not render \"{futures[future]['text'][:40]}\": {e}")
+                    continue
+                done[entry["key"]] = entry
+                counts["rendered"] += 1
+                counts["audio_seconds"] += entry["seconds"]
+                finished = counts["rendered"] + counts["failed"]
+                if finished % 10 == 0 or finished == len(todo):
+                    print(f"[INFO] {finished}/{len(todo)} clips ({counts['rendered'] / (time.perf_counter() - start):.2f} clips/s)", flush=True)
+        except KeyboardInterrupt: #the finished clips are in the manifest, the rerun resumes
+            for future in futures:
+                future.cancel()
+            raise
+
+    #the whole pack in script order
+    pack = [{"id": clip["id"], **done[clip["key"]]} for clip in clips if clip["key"] in done]
+    temp = os.path.join(out_dir, "manifest.json.tmp")
+    with open(temp, "w", encoding="utf-8") as f:
+        json.dump({"settings": settings_file, "clips": pack}, f, ensure_ascii=False, indent=1)
+    os.replace(temp, os.path.join(out_dir, "manifest.json"))
+
+    counts["seconds"] = time.perf_counter() - start
+    return counts
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="renders a script of lines into converted clips (tts + rvc)")
+    parser.add_argument("lines", help=".txt (one line per clip) or .jsonl ({\"text\", \"id\", \"voice_description\"} per line)")
+    parser.add_argument("--settings", default="settings.json")
+    parser.add_argument("--out", default=None, help="defaults to ./voice_packs/{model name}")
+    parser.add_argument("--workers", type=int, default=None, help="rvc worker processes, defaults to the number of cores")
+    parser.add_argument("--tts-concurrency", type=int, default=4)
+    parser.add_argument("--device", default="cpu", help="torch device of the rvc workers (cuda:0 with 1 or 2 workers)")
+    parser.add_argument("--warm-cache", action="store_true", help="also put the clips in the audio cache of the conversations")
+    args = parser.parse_args()
+
+    counts = render(args.lines, args.settings, args.out, args.workers, args.tts_concurrency, args.device, warm_cache=args.warm_cache)
+    print(f"[INFO] {counts['rendered']} rendered, {counts['skipped']} skipped, {counts['failed']} failed "
+          f"in {counts['seconds']:.1f}s ({counts['audio_seconds']:.1f}s of audio)")
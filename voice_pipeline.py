@@ -0,0 +1,269 @@
+"""
+This module turns a streamed answer into voice sentence by sentence, so the first sentence plays while the next ones are still being generated.
+The text deltas are cut into sentences and go through three workers (threads of 'turn_runtime.spawn()') linked by bounded queues:
+    text -> [tts worker] -> [rvc worker] -> [playback worker]
+Cancelling the turn scope of the pipeline stops the workers after their current sentence and drops the audio not played yet.
+The audio stays in memory as float32 NumPy arrays from the tts to the output device, the '.wav' files are only written as a debug dump.
+The playback worker hands the clips to 'audio_output' (one persistent stream fed by a ring buffer), so it never waits for the device.
+Sentences found in the audio cache skip both the tts and rvc.
+Classes:
+    - SentenceSegmenter:
+        Incrementally cuts text deltas into sentences that sound natural for the tts.
+    - VoicePipeline:
+        Runs the tts, rvc and playback workers of one turn and reports the time to first audio.
+"""
+
+import os
+import re
+import queue
+import time
+import chatgpt
+import audio_cache
+import audio_output
+import tracing
+import turn_runtime
+from rvc_converter import convertToAI_array, active_voice
+from startup import lazy_import
+
+#imports---------------------------------------------------------------
+
+class SentenceSegmenter:
+    """
+    Cuts a stream of text deltas into sentences.\n
+    A sentence ends on '.', '!', '?', '…' or ';' followed by a space, or on a new line. Sentences shorter than 'min_chars'
+    are merged with the next one so the tts does not get tiny segments, except for the first one which is sent as soon as possible.\n
+    exemple_ | segmenter = SentenceSegmenter() | for delta in deltas: for sentence in segmenter.feed(delta): ... | last = segmenter.flush()
+    """
+    _boundary = re.compile(r"[.!?…;]+[\"')\]]*\s+|\n+")
+
+    def __init__(self, min_chars: int = 40, first_min_chars: int = 12):
+        self.min_chars = min_chars
+        self.first_min_chars = first_min_chars
+        self._buffer = ""
+        self._scan = 0 #where to look for the next boundary
+        self._count = 0
+
+    def feed(self, delta: str) -> list:
+        """adds a delta and returns the sentences it completed"""
+        self._buffer += delta
+        sentences = []
+        while True:
+            match = self._boundary.search(self._buffer, self._scan)
+            if match is None:
+                break
+            end = match.end()
+            sentence = self._buffer[:end].strip()
+            minimum = self.first_min_chars if self._count == 0 else self.min_chars
+            if len(sentence) < minimum:
+                self._scan = end #too short, waits for the next boundary
+                continue
+            sentences.append(sentence)
+            self._count += 1
+            self._buffer = self._buffer[end:]
+            self._scan = 0
+        if self._scan > len(self._buffer):
+            self._scan = len(self._buffer)
+        return sentences
+
+    def flush(self) -> str:
+        """returns what is left in the buffer at the end of the stream ("" if there is nothing to say)"""
+        sentence = self._buffer.strip()
+        self._buffer = ""
+        self._scan = 0
+        if sentence != "":
+            self._count += 1
+        return sentence
+
+class VoicePipeline:
+    """
+    Speaks a text sentence by sentence with openAI's tts, rvc and one gapless output stream.\n
+    Each stage runs in its own thread and hands its work to the next one through a queue of at most 'max_pending' items,
+    so a slow stage slows the previous ones down instead of piling work in memory.\n
+    With a 'cache' (audio_cache.AudioCache) a sentence already said with the same voice is played from the cache, new ones are added to it
+    (not with a custom 'convert').\n
+    When 'debug_dump' is True every sentence is also saved in './audio_input/{name}{i}.wav' (tts) and './audio_output/{name}{i}.wav' (rvc).\n
+    'convert' replaces the rvc conversion (a function (audio, sr, voice) -> (audio, sr), like the stub of 'benchmark.py')
+    and 'play=False' skips the audio device: the clips are only timed, for benchmarks and headless runs.
+    'output' is the audio_output.AudioOutput the clips go to, defaults to the one shared by the process. 'playback' has its underruns after 'wait()'.\n
+    'scope' is the turn_runtime.TurnScope of the turn: once it is cancelled nothing more is sent to the tts nor rvc and the queued audio is dropped.\n
+    exemple_ | pipeline = VoicePipeline(client,voice_description,"teto") | text = pipeline.speak(deltas) | pipeline.wait()
+    """
+    _done = object() #end of stream marker passed from stage to stage
+
+    def __init__(self, client=None, voice_description: str = None, name: str = "speech", max_pending: int = 3, debug_dump: bool = False, voice=None, cache: audio_cache.AudioCache = None,
+                 convert=None, play: bool = True, output: audio_output.AudioOutput = None, scope: turn_runtime.TurnScope = None):
+        if client == None:
+            assert False, "missing api_key"
+        self.client = client
+        self.voice_description = voice_description
+        self.name = name
+        self.max_pending = max_pending
+        self.debug_dump = debug_dump
+        self.voice = voice #rvc voice key from 'load_rvc_settings()', None for the last loaded one
+        self.cache = cache
+        self.convert = convertToAI_array if convert is None else convert
+        self.play = play
+        self.output = output
+        self.scope = scope
+
+        self.texts = [] #sentences sent to the tts
+        self.start_time = None
+        self.first_audio = None #time to first audio of the turn in seconds
+        self.errors = []
+        self.playback = None #underruns and buffer fill of the turn (audio_output.AudioOutput.stats())
+        self._futures = []
+
+    #----------------------------------stages-----------------------------------------
+
+    def _stage(self, inbox: queue.Queue, outbox: queue.Queue, work) -> None:
+        """runs 'work' on every item of 'inbox' and passes the results to 'outbox', stops at the end of the stream or when the turn is cancelled"""
+        while True:
+            item = inbox.get()
+            if item is self._done or self.scope.cancelled:
+                if outbox is not None:
+                    self._put(outbox, self._done)
+                return
+            try:
+                result = work(item)
+            except Exception as e: #skips the sentence but keeps the turn going
+                print(f"[WARN] voice pipeline: {e}")
+                self.errors.append(e)
+                continue
+            if outbox is not None:
+                self._put(outbox, result)
+
+    def _put(self, box: queue.Queue, item) -> bool:
+        """puts 'item' in 'box', blocks while it is full and gives up (False) if the turn is cancelled meanwhile"""
+        while not self.scope.cancelled:
+            try:
+                box.put(item, timeout=0.05)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _abort(self) -> None:
+        """'on_cancel' of the scope: drops the queued audio and wakes the workers waiting for work"""
+        if self.output is not None:
+            self.output.clear()
+        for box in (self._texts, self._voices, self._converted):
+            try:
+                box.put_nowait(self._done)
+            except queue.Full: #its worker is not waiting, it sees the cancel on its next item
+                pass
+
+    def _cache_key(self, text: str):
+        """key of the sentence in the audio cache, None when it is not cached (no cache, too long, or converted by a custom 'convert' the key can not tell apart)"""
+        if self.cache is None or self.convert is not convertToAI_array or not self.cache.cacheable(text):
+            return None
+        voice = self.voice if self.voice is not None else active_voice()
+        return audio_cache.audio_key(text, chatgpt.TTS_MODEL, chatgpt.TTS_VOICE, self.voice_description, voice)
+
+    def _tts(self, item):
+        i, text = item
+        key = self._cache_key(text)
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return i, cached[0], cached[1], key, True
+        audio, sr = chatgpt.voice_pcm(self.client,text,self.voice_description)
+        if self.debug_dump:
+            lazy_import("soundfile").write(f"./audio_input/{self.name}{i}.wav", audio, sr)
+        return i, audio, sr, key, False
+
+    def _rvc(self, item):
+        i, audio, sr, key, cached = item
+        if cached: #already converted, skips the rvc
+            return item
+        audio, sr = self.convert(audio, sr, self.voice)
+        if key is not None:
+            self.cache.put(key, audio, sr)
+        if self.debug_dump:
+            lazy_import("soundfile").write(f"./audio_output/{self.name}{i}.wav", audio, sr)
+        return i, audio, sr, key, True
+
+    def _play(self, item):
+        i, audio, sr = item[:3]
+        if not self.play:
+            if self.first_audio is None:
+                self.first_audio = time.perf_counter() - self.start_time
+                tracing.record("playback.first_audio", self.first_audio, self.start_time)
+            return
+        if self.output is None:
+            self.output = audio_output.get_output()
+        if self.first_audio is None:
+            self.first_audio = time.perf_counter() - self.start_time
+            tracing.record("playback.first_audio", self.first_audio, self.start_time)
+            print(f"\n[INFO] time to first audio: {self.first_audio:.2f}s")
+        with tracing.span("playback.write", sentence=i, seconds=round(len(audio) / sr, 3)):
+            self.output.play(audio, sr) #queued in the ring buffer, crossfaded with the previous clip
+        if self.scope.cancelled: #cancelled before the output was known to '_abort()'
+            self.output.clear()
+
+    #----------------------------------control----------------------------------------
+
+    def start(self) -> None:
+        """starts the workers, the time to first audio is measured from here"""
+        if self.debug_dump:
+            os.makedirs("./audio_input", exist_ok=True)
+            os.makedirs("./audio_output", exist_ok=True)
+        self.start_time = time.perf_counter()
+        if self.scope is None:
+            self.scope = turn_runtime.TurnScope("voice")
+        self._texts = queue.Queue(self.max_pending)
+        self._voices = queue.Queue(self.max_pending)
+        self._converted = queue.Queue(self.max_pending)
+        self.scope.on_cancel(self._abort)
+        #the workers run in a copy of the caller's context so their spans belong to its traced turn.
+        #they wait for each other through the queues: own threads, not the bounded pool (see 'turn_runtime.TaskRuntime.spawn()')
+        runtime = turn_runtime.get_runtime()
+        self._futures = [
+            runtime.spawn(self.scope, self._stage, self._texts, self._voices, self._tts, name="voice-tts"),
+            runtime.spawn(self.scope, self._stage, self._voices, self._converted, self._rvc, name="voice-rvc"),
+            runtime.spawn(self.scope, self._stage, self._converted, None, self._play, name="voice-play"),
+        ]
+
+    def submit(self, sentence: str) -> None:
+        """queues a sentence for the tts, blocks while the pipeline is full. Does nothing once the turn is cancelled"""
+        if self.start_time is None:
+            self.start()
+        if self._put(self._texts, (len(self.texts), sentence)):
+            self.texts.append(sentence)
+
+    def speak(self, deltas, echo: bool = True) -> str:
+        """
+        reads the text deltas (a generator from 'chatgpt.chat(streaming=True)' or a list of strings),
+        submits every finished sentence and returns the whole text. Prints the deltas when 'echo' is True.
+        """
+        segmenter = SentenceSegmenter()
+        parts = []
+        for delta in deltas:
+            if echo:
+                print(delta,end="",flush=True)
+            parts.append(delta)
+            for sentence in segmenter.feed(delta):
+                self.submit(sentence)
+        last = segmenter.flush()
+        if last != "":
+            self.submit(last)
+        return "".join(parts)
+
+    def wait(self) -> float:
+        """waits for the last sentence to be played (or for the workers to stop if the turn is cancelled) and returns the time to first audio (None if nothing was played)"""
+        if self.start_time is None:
+            return None
+        self._put(self._texts, self._done)
+        for future in self._futures:
+            try:
+                future.result()
+            except turn_runtime.TurnCancelled:
+                pass
+        if self.scope.cancelled:
+            tracing.record("playback.end", time.perf_counter() - self.start_time, self.start_time, sentences=len(self.texts), cancelled=True)
+            return self.first_audio
+        if self.play and self.output is not None and self.first_audio is not None:
+            self.playback = self.output.drain() #plays what is left in the ring buffer
+            if self.playback["underruns"] > 0:
+                tracing.record("playback.underrun", self.playback["underrun_seconds"], underruns=self.playback["underruns"])
+        tracing.record("playback.end", time.perf_counter() - self.start_time, self.start_time, sentences=len(self.texts))
+        return self.first_audio